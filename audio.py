@@ -0,0 +1,83 @@
+import wave
+from array import array
+
+SAMPLE_RATE = 44100
+# The buzzer is a square wave at this frequency. One second of it holds a whole number of periods,
+# so the precomputed buffer can be repeated without a click at the seam.
+BUZZER_HZ = 440
+VOLUME = 0.25
+SAMPLE_WIDTH = 2 # bytes, signed 16 bit mono
+
+
+def square_wave(sample_rate=SAMPLE_RATE, frequency=BUZZER_HZ, volume=VOLUME):
+    """ One second of the buzzer tone as 16 bit PCM bytes. """
+    level = int(volume * 32767)
+    half_periods = 2 * frequency
+    return array("h", (
+        level if sample * half_periods // sample_rate % 2 == 0 else -level
+        for sample in range(sample_rate)
+    )).tobytes()
+
+
+class Buzzer:
+    """
+    Renders a chip's buzzer as 16 bit mono PCM and writes it to output (e.g. a WavWriter) in chunks.
+    It registers as the chip's buzzer_listener, so nothing happens per instruction. On every start or stop
+    the time since the last one is copied out of a precomputed tone or silence buffer. Sample positions come
+    from the virtual clock (cycles), so the audio lines up with recorded frames however fast emulation runs.
+    Call flush() to render up to the chip's current cycle, and close() at the end of the run to close output too.
+    """
+    def __init__(self, chip, output, sample_rate=SAMPLE_RATE):
+        self.chip = chip
+        self.output = output
+        self.sample_rate = sample_rate
+        # Chunks are written as views of these, so rendering copies nothing.
+        self.tone = memoryview(square_wave(sample_rate))
+        self.silence = memoryview(bytes(len(self.tone)))
+        self.on = chip.sound_timer > 0
+        # Samples rendered so far, counted from cycle 0. The tone's phase follows from it.
+        self.samples = chip.cycles * sample_rate // chip.cpu_hz
+        chip.buzzer_listener = self.transition
+
+    def transition(self, cycle, on):
+        self.render(cycle)
+        self.on = on
+
+    def render(self, cycle):
+        """ Write out the samples up to cycle, all with the buzzer in its current state. """
+        end = cycle * self.sample_rate // self.chip.cpu_hz
+        buffer = self.tone if self.on else self.silence
+        while self.samples < end:
+            offset = self.samples % self.sample_rate
+            count = min(end - self.samples, self.sample_rate - offset)
+            self.output.write(buffer[offset * SAMPLE_WIDTH:(offset + count) * SAMPLE_WIDTH])
+            self.samples += count
+
+    def flush(self):
+        self.render(self.chip.cycles)
+
+    def close(self):
+        self.flush()
+        self.chip.buzzer_listener = None
+        self.output.close()
+
+
+class WavWriter:
+    """ A mono 16 bit WAV file that PCM chunks are appended to. """
+    def __init__(self, path, sample_rate=SAMPLE_RATE):
+        self.file = wave.open(path, "wb")
+        self.file.setnchannels(1)
+        self.file.setsampwidth(SAMPLE_WIDTH)
+        self.file.setframerate(sample_rate)
+
+    def write(self, data):
+        self.file.writeframesraw(data)
+
+    def close(self):
+        # Fixes up the header with the final length.
+        self.file.close()
+
+
+def record_wav(chip, path, sample_rate=SAMPLE_RATE):
+    """ Start writing chip's buzzer to a WAV file. Returns the Buzzer, whose close() finishes the file. """
+    return Buzzer(chip, WavWriter(path, sample_rate), sample_rate)
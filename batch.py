@@ -0,0 +1,188 @@
+import argparse
+import csv
+import glob
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from chip8 import Chip8, TIMER_HZ
+from savestate import pack_display
+
+# Rom library folders run by default.
+ROM_DIRS = ("demos", "games", "programs", "hires")
+ROM_LIB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rom-lib")
+
+DEFAULT_FRAMES = 600
+SEED = 0
+ENGINES = ("run", "block")
+
+# How a run ended.
+#   ok              - ran for the whole budget
+#   stack_overflow  - 2NNN with a full stack
+#   stack_underflow - 00EE with an empty stack
+#   memory          - read or write past the end of memory, including running off it
+#   key             - EX9E/EXA1 with a register above 0xF
+#   error           - anything else the core raised
+STATUSES = ("ok", "stack_overflow", "stack_underflow", "memory", "key", "error")
+HANDLER_ERRORS = {
+    "call_subroutine": "stack_overflow",
+    "return_from_subroutine": "stack_underflow",
+    "skip_if_pressed": "key",
+    "skip_if_not_pressed": "key",
+}
+
+CSV_FIELDS = (
+    "rom", "status", "error", "pc", "cycles", "ticks", "seconds", "instructions_per_second",
+    "display_width", "display_height", "display_hash", "unimplemented",
+)
+
+
+def find_roms(dirs=ROM_DIRS, root=ROM_LIB):
+    roms = []
+    for name in dirs:
+        roms += glob.glob(os.path.join(root, name, "**", "*.ch8"), recursive=True)
+    return sorted(roms)
+
+
+def classify(chip, error):
+    """ The status for an exception raised while running chip. The failing instruction is still at chip.pc. """
+    if not isinstance(error, IndexError):
+        return "error"
+    if chip.pc + 1 >= len(chip.memory):
+        return "memory"
+    opcode = chip.memory[chip.pc] << 8 | chip.memory[chip.pc + 1]
+    return HANDLER_ERRORS.get(Chip8.build_dispatch_table(chip.vip_hires)[opcode].__name__, "memory")
+
+
+def run_one(rom_file, frames=DEFAULT_FRAMES, cycles=None, engine="run", seed=SEED, keys=()):
+    """
+    Run one rom headlessly and return its result as a dict (see CSV_FIELDS).
+    Stops after frames 60Hz frames of emulated time, or cycles instructions if that comes first.
+    """
+    chip = Chip8(rom_file, seed=seed)
+    # Unimplemented opcodes are collected in chip.unimplemented instead of being printed.
+    chip.tracer.stream = io.StringIO()
+    for key in keys:
+        chip.press_key(key)
+    budget = chip.tick_cycle(frames) if frames is not None else cycles
+    if cycles is not None:
+        budget = min(budget, cycles)
+
+    status = "ok"
+    error = ""
+    start = time.perf_counter()
+    try:
+        if engine == "block":
+            from translator import BlockEngine
+
+            BlockEngine(chip).run(budget)
+        else:
+            chip.run(cycles=budget)
+    except Exception as exception:
+        status = classify(chip, exception)
+        error = repr(exception)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "rom": rom_file,
+        "status": status,
+        "error": error,
+        "pc": chip.pc,
+        "cycles": chip.cycles,
+        "ticks": chip.ticks,
+        "seconds": elapsed,
+        "instructions_per_second": chip.cycles / elapsed if elapsed else 0.0,
+        "display_width": chip.display_width,
+        "display_height": chip.display_height,
+        "display_hash": hashlib.sha256(pack_display(chip)).hexdigest(),
+        "unimplemented": [f"{opcode:04X}@{pc:#05x}" for opcode, pc in sorted(chip.unimplemented.items())],
+    }
+
+
+def run_batch(roms, jobs=None, **run_args):
+    """ Run every rom in a process pool and return the results in the order of roms. """
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_one, rom, **run_args) for rom in roms]
+        return [future.result() for future in futures]
+
+
+def write_report(results, path):
+    """ Write results as CSV if path ends in .csv, JSON otherwise. """
+    with open(path, "w", newline="") as report:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(report, CSV_FIELDS)
+            writer.writeheader()
+            for result in results:
+                writer.writerow(dict(result, unimplemented=" ".join(result["unimplemented"])))
+        else:
+            json.dump(results, report, indent=2)
+
+
+def compare(results, baseline_path):
+    """ The roms whose status or final display differ from a previous JSON report, as (rom, was, now). """
+    with open(baseline_path) as baseline_file:
+        baseline = {result["rom"]: result for result in json.load(baseline_file)}
+    changes = []
+    for result in results:
+        old = baseline.get(result["rom"])
+        if old is None:
+            continue
+        was = (old["status"], old["display_hash"][:12])
+        now = (result["status"], result["display_hash"][:12])
+        if was != now:
+            changes.append((result["rom"], was, now))
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run every rom in the library headlessly and report how each ended.")
+    parser.add_argument("paths", nargs="*", help=f"Roms or folders to run. Defaults to rom-lib/{{{','.join(ROM_DIRS)}}}.")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES, help=f"{TIMER_HZ}Hz frames to run each rom for.")
+    parser.add_argument("--cycles", type=int, help="Stop each rom after this many instructions instead.")
+    parser.add_argument("--engine", choices=ENGINES, default="run")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--key", type=lambda key: int(key, 16), action="append", default=[],
+                        help="Hex key to hold down. Can be repeated.")
+    parser.add_argument("--jobs", type=int, help="Worker processes. Defaults to one per core.")
+    parser.add_argument("--output", "-o", help="Write the report to this file (.csv for CSV, JSON otherwise).")
+    parser.add_argument("--baseline", help="A previous JSON report to list changed roms against.")
+    args = parser.parse_args()
+
+    roms = []
+    for path in args.paths:
+        roms += find_roms([path], root="") if os.path.isdir(path) else [path]
+    if not args.paths:
+        roms = find_roms()
+    frames = None if args.cycles is not None else args.frames
+
+    start = time.perf_counter()
+    results = run_batch(roms, jobs=args.jobs, frames=frames, cycles=args.cycles, engine=args.engine,
+                        seed=args.seed, keys=args.key)
+    elapsed = time.perf_counter() - start
+
+    for result in results:
+        if result["status"] != "ok" or result["unimplemented"]:
+            detail = result["error"] or "unimplemented " + " ".join(result["unimplemented"])
+            print(f"{result['status']:<16} {os.path.basename(result['rom'])}: {detail}")
+    counts = {status: 0 for status in STATUSES}
+    for result in results:
+        counts[result["status"]] += 1
+    cycles = sum(result["cycles"] for result in results)
+    print(", ".join(f"{count} {status}" for status, count in counts.items() if count))
+    print(f"{len(results)} roms, {cycles:,} instructions in {elapsed:.2f}s")
+
+    if args.output:
+        write_report(results, args.output)
+    if args.baseline:
+        changes = compare(results, args.baseline)
+        for rom, was, now in changes:
+            print(f"changed {os.path.basename(rom)}: {was[0]} {was[1]} -> {now[0]} {now[1]}")
+        print(f"{len(changes)} roms changed since {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
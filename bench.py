@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+from chip8 import Chip8, TIMER_HZ
+from translator import BlockEngine
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Roms run by default. A mix of display heavy demos, games and computation heavy test programs.
+BENCH_ROMS = [os.path.join(ROOT, path) for path in (
+    "roms/ibm-logo.ch8",
+    "roms/SqrtTest.ch8",
+    "roms/Sierpinski.ch8",
+    "roms/ParticleDemo.ch8",
+    "roms/Trip8Demo.ch8",
+    "roms/tetris.ch8",
+    "rom-lib/games/Pong [Paul Vervalin, 1990].ch8",
+    "rom-lib/games/Space Invaders [David Winter].ch8",
+    "rom-lib/games/Brix [Andreas Gustafsson, 1990].ch8",
+    "rom-lib/programs/Life [GV Samways, 1980].ch8",
+)]
+
+# Roms that never sit in an idle loop, so Chip8.run can't skip anything and only its per-instruction work
+# is compared with a step() loop.
+NON_IDLE_ROMS = [os.path.join(ROOT, path) for path in (
+    "roms/ParticleDemo.ch8",
+    "rom-lib/games/Pong [Paul Vervalin, 1990].ch8",
+)]
+
+# Ways of running the core that can be compared.
+#   step   - one Chip8.step() call per instruction
+#   chain  - Chip8.run with the if/elif decoder
+#   table  - Chip8.run with the dispatch table decoder
+#   blocks - translator.BlockEngine
+ENGINES = ("step", "chain", "table", "blocks")
+
+DEFAULT_CYCLES = 200000
+DEFAULT_HISTORY = os.path.join(ROOT, "bench_history.json")
+# A result this much slower than the previous run is reported as a regression.
+DEFAULT_THRESHOLD = 0.10
+SEED = 0
+# The scripted input holds each key for this many frames, cycling through all 16.
+FRAMES_PER_KEY = 30
+
+
+def make_runner(engine, chip):
+    """ Returns a function that executes exactly the given number of instructions on chip. """
+    if engine == "step":
+        def run(cycles):
+            step = chip.step
+            for _ in range(cycles):
+                step()
+        return run
+    if engine == "blocks":
+        return BlockEngine(chip).run
+    return lambda cycles: chip.run(cycles=cycles)
+
+
+def scripted_key_events(chip, cycles):
+    """ Deterministic input for cycles instructions as (cycle, key, pressed): each key held in turn for FRAMES_PER_KEY frames. """
+    events = []
+    for n in range(cycles * TIMER_HZ // chip.cpu_hz // FRAMES_PER_KEY + 1):
+        cycle = chip.tick_cycle(n * FRAMES_PER_KEY)
+        if n:
+            events.append((cycle, (n - 1) % 16, False))
+        events.append((cycle, n % 16, True))
+    return events
+
+
+def bench_rom(rom_file, engine, cycles):
+    chip = Chip8(rom_file, decoder="chain" if engine == "chain" else "table", seed=SEED)
+    chip.tracer.stream = open(os.devnull, "w")
+    run = make_runner(engine, chip)
+    for cycle, key, pressed in scripted_key_events(chip, cycles):
+        chip.queue_key_event(key, pressed, cycle)
+
+    start = time.perf_counter()
+    run(cycles)
+    elapsed = time.perf_counter() - start
+    chip.tracer.stream.close()
+
+    return {
+        "instructions": chip.cycles,
+        "seconds": elapsed,
+        "instructions_per_second": chip.cycles / elapsed,
+        "frames_per_second": chip.ticks / elapsed,
+    }
+
+
+def micro_benchmarks(number=20000):
+    """ Nanoseconds per call for decoding and for the most expensive handlers. """
+    chip = Chip8(BENCH_ROMS[0])
+    # A spread of opcodes, including ones late in the if/elif chain.
+    opcodes = [0x00E0, 0x1234, 0x6A12, 0x8AB4, 0xA123, 0xC0FF, 0xD015, 0xE09E, 0xF065, 0xF155, 0xF233, 0xF01E]
+    table = Chip8.build_dispatch_table()
+    chip.index = 0x300
+    chip.registers[0] = 5
+    chip.registers[1] = 7
+
+    def reset_pc(handler):
+        def call():
+            chip.pc = 0x200
+            handler()
+        return call
+
+    cases = {
+        "decode_chain": lambda: [chip.decode(opcode) for opcode in opcodes],
+        "decode_table": lambda: [table[opcode] for opcode in opcodes],
+        "draw_sprite": reset_pc(lambda: chip.draw_sprite(0xD01F)),
+        "mem_dump": reset_pc(lambda: chip.mem_dump(0xFF55)),
+        "mem_read": reset_pc(lambda: chip.mem_read(0xFF65)),
+        "disp_clear": reset_pc(lambda: chip.disp_clear(0x00E0)),
+    }
+    results = {}
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=number, repeat=3))
+        per_call = seconds / number
+        if name.startswith("decode"):
+            per_call /= len(opcodes)
+        results[name] = per_call * 1e9
+    return results
+
+
+def loop_benchmarks(cycles, repeat=7):
+    """
+    Nanoseconds per instruction for Chip8.run and for a step() loop on NON_IDLE_ROMS, the best of repeat runs.
+    The two take turns, so a machine that speeds up or slows down part way through doesn't favour either.
+    """
+    results = {}
+    for rom_file in NON_IDLE_ROMS:
+        name = os.path.basename(rom_file)
+        times = {"run_loop": [], "step_loop": []}
+        for _ in range(repeat):
+            for engine, label in (("table", "run_loop"), ("step", "step_loop")):
+                chip = Chip8(rom_file, seed=SEED)
+                run = make_runner(engine, chip)
+                start = time.perf_counter()
+                run(cycles)
+                times[label].append(time.perf_counter() - start)
+        for label, seconds in times.items():
+            results[f"{label} {name}"] = min(seconds) / cycles * 1e9
+    return results
+
+
+def find_slow_run_loops(micro):
+    """ Describe every rom in NON_IDLE_ROMS that Chip8.run executes more slowly than a step() loop. """
+    slow = []
+    for rom_file in NON_IDLE_ROMS:
+        name = os.path.basename(rom_file)
+        run_ns, step_ns = micro[f"run_loop {name}"], micro[f"step_loop {name}"]
+        if run_ns > step_ns:
+            slow.append(f"run() is slower than step() on {name}: {run_ns:.0f} > {step_ns:.0f} ns/instruction")
+    return slow
+
+
+def startup_benchmark(runs=5):
+    """
+    Nanoseconds a fresh process takes to import the core and execute a rom's first instruction,
+    as reported by headless.py --startup. The best of runs processes.
+    """
+    times = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "headless.py", BENCH_ROMS[0], "--startup"],
+            capture_output=True, text=True, check=True, cwd=ROOT,
+        )
+        times.append(float(output.stdout.split()[0]) * 1e6)
+    return min(times)
+
+
+def git_revision():
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=ROOT)
+        return output.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def find_regressions(previous, current, threshold):
+    """ Compare two history entries and describe every metric that got worse by more than threshold. """
+    regressions = []
+    for key, result in current["roms"].items():
+        old = previous["roms"].get(key)
+        if old and result["instructions_per_second"] < old["instructions_per_second"] * (1 - threshold):
+            regressions.append(
+                f"{key}: {old['instructions_per_second']:,.0f} -> {result['instructions_per_second']:,.0f} instructions/s"
+            )
+    for name, nanoseconds in current["micro"].items():
+        old = previous["micro"].get(name)
+        if old and nanoseconds > old * (1 + threshold):
+            regressions.append(f"{name}: {old:.0f} -> {nanoseconds:.0f} ns")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Chip8 core headlessly.")
+    parser.add_argument("roms", nargs="*", default=BENCH_ROMS)
+    parser.add_argument("--engines", default=",".join(ENGINES), help="Comma separated list of engines to run.")
+    parser.add_argument("--cycles", type=int, default=DEFAULT_CYCLES, help="Instructions to run per rom.")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="JSON file results are appended to.")
+    parser.add_argument("--no-save", action="store_true", help="Don't append the results to the history file.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    engines = args.engines.split(",")
+    for engine in engines:
+        assert engine in ENGINES, f"Engine must be one of {ENGINES}."
+
+    entry = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cycles": args.cycles,
+        "roms": {},
+        "micro": {},
+    }
+    for rom_file in args.roms:
+        name = os.path.basename(rom_file)
+        for engine in engines:
+            result = bench_rom(rom_file, engine, args.cycles)
+            entry["roms"][f"{name} [{engine}]"] = result
+            print(f"{name:<50} {engine:<7} {result['instructions_per_second']:>12,.0f} instr/s"
+                  f" {result['frames_per_second']:>10,.0f} frames/s")
+
+    entry["micro"] = micro_benchmarks()
+    entry["micro"].update(loop_benchmarks(args.cycles))
+    entry["micro"]["startup"] = startup_benchmark()
+    for name, nanoseconds in entry["micro"].items():
+        print(f"{name:<58} {nanoseconds:>12,.0f} ns")
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as history_file:
+            history = json.load(history_file)
+
+    regressions = find_regressions(history[-1], entry, args.threshold) if history else []
+    regressions += find_slow_run_loops(entry["micro"])
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    if not args.no_save:
+        history.append(entry)
+        with open(args.history, "w") as history_file:
+            json.dump(history, history_file, indent=2)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+from chip8 import is_vip_hires
+from disasm import PROGRAM_START, analyze
+
+# Directories scanned for roms, relative to this file.
+ROM_DIRS = ("roms", "rom-lib")
+ROM_EXTENSION = ".ch8"
+DEFAULT_INDEX = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".rom-index.json")
+INDEX_VERSION = 2
+
+# Rom variants.
+CHIP8 = "chip8"
+VIP_HIRES = "vip-hires" # 64x64 two page mode, started by a jump to the display patch (see chip8.VIP_HIRES_JUMP)
+SUPERCHIP = "superchip" # 128x64 SUPER-CHIP, detected by its hires/lores switching opcodes
+
+# rom-lib names look like "Title [Author, Year] (alt)", "Title (Author, Year)" or "Title (2008) [Author]".
+GROUP_PATTERN = re.compile(r"\s*([\[\(])([^\]\)]*)[\]\)]")
+YEAR_PATTERN = re.compile(r"^(19|20)\d[\dx]$")
+# "Key : value" lines in the Revival Studios style .txt files.
+FIELD_PATTERN = re.compile(r"^(?P<key>[A-Za-z][A-Za-z ]*?)\s*:\s*(?P<value>.+)$")
+# Number of characters of free text kept as a description.
+DESCRIPTION_LENGTH = 300
+
+
+def parse_name(path):
+    """
+    Title, author, year and note from a rom's file name.
+    [...] groups are credits, as are (...) groups holding a year or a comma; any other (...) is a note like "alt".
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    info = {"title": GROUP_PATTERN.split(stem, 1)[0].strip() or stem, "author": None, "year": None, "note": None}
+    for bracket, text in GROUP_PATTERN.findall(stem):
+        parts = [part.strip() for part in text.split(",")]
+        if bracket == "(" and len(parts) == 1 and not YEAR_PATTERN.match(parts[0]):
+            info["note"] = text
+            continue
+        if YEAR_PATTERN.match(parts[-1]):
+            info["year"] = parts.pop()
+        if parts:
+            info["author"] = ", ".join(parts)
+    return info
+
+
+def normalize(stem):
+    """ Loose form of a rom name used to pair roms with notes that are bracketed differently. """
+    return re.sub(r"[^a-z0-9]+", " ", stem.lower()).strip()
+
+
+def parse_notes(path):
+    """ Metadata from a rom's .txt notes: any "Key : value" fields plus the start of the free text. """
+    with open(path, "rb") as notes_file:
+        text = notes_file.read().decode("latin-1")
+    fields = {}
+    description = []
+    for line in text.splitlines():
+        line = line.strip()
+        match = FIELD_PATTERN.match(line)
+        if match and len(match.group("key")) < 20:
+            fields[match.group("key").strip().lower()] = match.group("value").strip()
+        elif line and any(char.isalnum() for char in line) and not line.startswith("www."):
+            description.append(line)
+    return {"fields": fields, "description": " ".join(description)[:DESCRIPTION_LENGTH]}
+
+
+def detect_variant(data):
+    if is_vip_hires(data):
+        return VIP_HIRES
+    # Only reachable code counts, so sprite and other data bytes aren't mistaken for the switching opcodes.
+    for pc in analyze(data)["code"]:
+        if data[pc - PROGRAM_START:pc - PROGRAM_START + 2] in (b"\x00\xfe", b"\x00\xff"):
+            return SUPERCHIP
+    return CHIP8
+
+
+def find_notes(rom_path, notes):
+    """ The .txt that goes with a rom: same name, or same name ignoring brackets and an "(alt)" suffix. """
+    stem = os.path.splitext(rom_path)[0]
+    if stem + ".txt" in notes.values():
+        return stem + ".txt"
+    directory = os.path.dirname(rom_path)
+    name = normalize(os.path.basename(stem))
+    for candidate in (name, normalize(re.sub(r"\(alt\)", "", os.path.basename(stem)))):
+        match = notes.get((directory, candidate))
+        if match:
+            return match
+    return None
+
+
+class Catalog:
+    """
+    An index of every rom under ROM_DIRS, persisted as JSON.
+    Entries are keyed by path and hold the rom's sha1, size, mtime, name parts, notes and variant.
+    Rescanning only rereads files whose size or mtime changed.
+    """
+    def __init__(self, root=None, index_file=DEFAULT_INDEX):
+        self.root = root or os.path.dirname(os.path.abspath(__file__))
+        self.index_file = index_file
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as index:
+                data = json.load(index)
+            if data.get("version") == INDEX_VERSION:
+                self.entries = data["entries"]
+
+    def save(self):
+        with open(self.index_file, "w") as index:
+            json.dump({"version": INDEX_VERSION, "entries": self.entries}, index, indent=1)
+
+    def scan(self):
+        """ Bring the index up to date with the files on disk. Returns True if anything changed. """
+        roms = []
+        notes = {}
+        for rom_dir in ROM_DIRS:
+            for directory, _, files in os.walk(os.path.join(self.root, rom_dir)):
+                for file_name in files:
+                    path = os.path.relpath(os.path.join(directory, file_name), self.root)
+                    if file_name.endswith(ROM_EXTENSION):
+                        roms.append(path)
+                    elif file_name.endswith(".txt"):
+                        stem = os.path.splitext(file_name)[0]
+                        notes[(os.path.dirname(path), normalize(stem))] = path
+
+        changed = False
+        entries = {}
+        for path in roms:
+            stat = os.stat(os.path.join(self.root, path))
+            entry = self.entries.get(path)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                entry = self.index_rom(path, stat, notes)
+                changed = True
+            entries[path] = entry
+        changed = changed or entries.keys() != self.entries.keys()
+        self.entries = entries
+        if changed:
+            self.save()
+        return changed
+
+    def index_rom(self, path, stat, notes):
+        with open(os.path.join(self.root, path), "rb") as rom:
+            data = rom.read()
+        entry = {
+            "path": path,
+            "sha1": hashlib.sha1(data).hexdigest(),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "category": os.path.basename(os.path.dirname(path)),
+            "variant": detect_variant(data),
+            "notes": None,
+        }
+        entry.update(parse_name(path))
+        notes_path = find_notes(path, notes)
+        if notes_path:
+            entry["notes"] = parse_notes(os.path.join(self.root, notes_path))
+            entry["notes"]["path"] = notes_path
+        return entry
+
+    def find(self, query, rescan=True):
+        """
+        Entries matching a sha1 prefix, an exact path, or a case insensitive part of the file name.
+        Only falls back to rescanning the rom directories when the index has no match, and rescan is set.
+        """
+        matches = self.match(query)
+        if not matches and rescan and self.scan():
+            matches = self.match(query)
+        return matches
+
+    def match(self, query):
+        query_lower = query.lower()
+        if query in self.entries:
+            return [self.entries[query]]
+        by_hash = [entry for entry in self.entries.values() if entry["sha1"].startswith(query_lower)]
+        if by_hash and len(query) >= 6:
+            return by_hash
+        return [entry for entry in self.entries.values() if query_lower in os.path.basename(entry["path"]).lower()]
+
+    def resolve(self, query, rescan=True):
+        """ Absolute path of the single rom matching query. Raises LookupError if there are none or several. """
+        matches = self.find(query, rescan)
+        if len(matches) > 1:
+            # Prefer the rom whose title is exactly the query, and the original over "(alt)" versions.
+            exact = [entry for entry in matches if entry["title"].lower() == query.lower() and not entry["note"]]
+            if exact:
+                matches = exact
+        # Copies of the same rom in both directories aren't ambiguous.
+        if len({entry["sha1"] for entry in matches}) == 1:
+            matches = matches[:1]
+        if not matches:
+            raise LookupError(f"No rom matches '{query}'.")
+        if len(matches) > 1:
+            names = "\n".join(f"  {entry['sha1'][:8]} {entry['path']}" for entry in matches)
+            raise LookupError(f"'{query}' matches several roms:\n{names}")
+        return os.path.join(self.root, matches[0]["path"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List and search the rom catalog.")
+    parser.add_argument("query", nargs="?", help="Part of a rom name, or a sha1 prefix.")
+    parser.add_argument("--rescan", action="store_true", help="Check the rom directories for changes first.")
+    args = parser.parse_args()
+
+    catalog = Catalog()
+    if args.rescan or not catalog.entries:
+        catalog.scan()
+    entries = catalog.find(args.query) if args.query else catalog.entries.values()
+    for entry in sorted(entries, key=lambda entry: entry["path"]):
+        credit = ", ".join(part for part in (entry["author"], entry["year"]) if part)
+        print(f"{entry['sha1'][:8]}  {entry['variant']:<10} {entry['size']:>5}  {entry['path']}"
+              + (f"  ({credit})" if credit else ""))
+
+
+if __name__ == "__main__":
+    main()
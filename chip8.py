@@ -1,24 +1,153 @@
 import random
-from utils import byte_to_bits, sprite_to_bytes, SPRITE_DATA
+import time
+from array import array
+from collections import namedtuple
+from utils import sprite_to_bytes, SPRITE_DATA
+from tracing import Tracer, TRACE_OFF, TRACE_REGISTERS, INDEX_REGISTER
 DISPLAY_WIDTH = 64
 DISPLAY_HEIGHT = 32
-DEBUG = False
+BLANK_DISPLAY = (0,) * DISPLAY_HEIGHT
+# Bit mask with one bit set for every display row.
+ALL_ROWS = (1 << DISPLAY_HEIGHT) - 1
+# SUPER-CHIP high resolution mode, switched on by 00FF and off by 00FE.
+HIRES_WIDTH = 128
+HIRES_HEIGHT = 64
+# VIP hires roms start with a jump to the display patch at 0x260, with their program following at 0x2C0.
+# Emulators skip the patch and run the program on a 64x64 display.
+VIP_HIRES_JUMP = 0x1260
+VIP_HIRES_START = 0x2C0
+VIP_HIRES_HEIGHT = 64
+# VIP hires roms clear their display by calling the machine code routine at 0x230. Only decoded for those roms.
+VIP_HIRES_CLEAR = 0x0230
+
+# Opcode decoders that can be selected when constructing a Chip8.
+# "chain" walks the masked comparisons in Chip8.decode for every instruction.
+# "table" looks the handler up in a dispatch table built once per class.
+DECODERS = ("chain", "table")
+
+# Instructions executed per second of emulated time, unless a Chip8 is created with another cpu_hz.
+DEFAULT_CPU_HZ = 500
+# The delay and sound timers count down at this rate.
+TIMER_HZ = 60
+
+# Why Chip8.run returned.
+STOP_CYCLES = "cycles" # The cycle budget was used up.
+STOP_PC = "pc" # The pc reached one of the requested addresses.
+STOP_DRAW = "draw" # An instruction changed the display.
+STOP_TICK = "tick" # A 60Hz timer tick happened.
+STOP_KEY = "key" # Waiting for a key press (FX0A) and nothing else can happen within the cycle budget.
+RunResult = namedtuple("RunResult", ["reason", "cycles"])
+
+# Handlers that only read memory and only change registers, I and pc. A backward jump loop made of nothing
+# else that leaves registers, I and keys unchanged after a pass will repeat that pass until something outside
+# the loop changes, so run() can skip those passes (see Chip8.skip_idle_loop).
+IDLE_HANDLERS = frozenset((
+    "jump_to_constant",
+    "skip_if_equal",
+    "skip_if_not_equal",
+    "skip_if_reg_equal",
+    "skip_if_not_equal_registers",
+    "skip_if_pressed",
+    "skip_if_not_pressed",
+    "set_register_const",
+    "set_register_register",
+    "set_register_timer",
+    "set_index",
+))
+# Idle loops are only skipped when at least this many instructions could be saved, so short waits
+# (e.g. the few instructions left before the next tick) don't pay for checking the loop.
+IDLE_MIN_SKIP = 64
+# In wall clock mode real time is checked for due ticks once every this many instructions.
+WALL_CLOCK_POLL = 64
+
+# Assembly mnemonic for each handler. Formatted with the opcode and its x, y, n, nn, nnn operands.
+MNEMONICS = {
+    "disp_clear": "CLS",
+    "return_from_subroutine": "RET",
+    "jump_to_constant": "JP {nnn:#05x}",
+    "call_subroutine": "CALL {nnn:#05x}",
+    "skip_if_equal": "SE V{x:X}, {nn:#04x}",
+    "skip_if_not_equal": "SNE V{x:X}, {nn:#04x}",
+    "skip_if_reg_equal": "SE V{x:X}, V{y:X}",
+    "set_register_const": "LD V{x:X}, {nn:#04x}",
+    "add_register_const": "ADD V{x:X}, {nn:#04x}",
+    "set_register_register": "LD V{x:X}, V{y:X}",
+    "or_registers": "OR V{x:X}, V{y:X}",
+    "and_registers": "AND V{x:X}, V{y:X}",
+    "xor_registers": "XOR V{x:X}, V{y:X}",
+    "add_registers": "ADD V{x:X}, V{y:X}",
+    "sub_registers": "SUB V{x:X}, V{y:X}",
+    "shift_right": "SHR V{x:X}",
+    "shift_left": "SHL V{x:X}",
+    "skip_if_not_equal_registers": "SNE V{x:X}, V{y:X}",
+    "set_index": "LD I, {nnn:#05x}",
+    "set_register_random": "RND V{x:X}, {nn:#04x}",
+    "draw_sprite": "DRW V{x:X}, V{y:X}, {n}",
+    "draw_large_sprite": "DRW V{x:X}, V{y:X}, 0",
+    "scroll_down": "SCD {n}",
+    "scroll_right": "SCR",
+    "scroll_left": "SCL",
+    "set_lores": "LOW",
+    "set_hires": "HIGH",
+    "skip_if_pressed": "SKP V{x:X}",
+    "skip_if_not_pressed": "SKNP V{x:X}",
+    "set_register_timer": "LD V{x:X}, DT",
+    "set_delay_timer": "LD DT, V{x:X}",
+    "set_sound_timer": "LD ST, V{x:X}",
+    "add_index": "ADD I, V{x:X}",
+    "set_index_to_sprite": "LD F, V{x:X}",
+    "store_bcd": "LD B, V{x:X}",
+    "mem_dump": "LD [I], V{x:X}",
+    "mem_read": "LD V{x:X}, [I]",
+    "wait_for_key": "LD V{x:X}, K",
+    "not_implemented_instr": "DW {opcode:#06x}",
+}
+
+def is_vip_hires(data):
+    """ Whether rom data is a VIP hires rom, which Chip8.load_rom runs on a 64x64 display. """
+    return data[:2] == VIP_HIRES_JUMP.to_bytes(2, "big")
+
+def disassemble(opcode, vip_hires=False):
+    handler = Chip8.build_dispatch_table(vip_hires)[opcode]
+    return MNEMONICS[handler.__name__].format(
+        opcode=opcode,
+        x=(opcode & 0x0F00) >> 8,
+        y=(opcode & 0x00F0) >> 4,
+        n=opcode & 0x000F,
+        nn=opcode & 0x00FF,
+        nnn=opcode & 0x0FFF,
+    )
 
 class Chip8:
-    def __init__(self, rom_file):
+    # Maps every possible 16 bit opcode straight to its (unbound) handler. Built lazily by build_dispatch_table.
+    dispatch_table = None
+    # The same for VIP hires roms, which also decode VIP_HIRES_CLEAR.
+    vip_hires_dispatch_table = None
+    # Set by load_rom. Left False on the class, so the class-wide table only has opcodes every rom decodes.
+    vip_hires = False
+
+    def __init__(self, rom_file, decoder="table", trace_level=TRACE_OFF, cpu_hz=DEFAULT_CPU_HZ, wall_clock=False,
+                 seed=None):
         # 0x000-0x1FF - Chip 8 interpreter (contains font set in emu)
         # 0x050-0x0A0 - Used for the built in 4x5 pixel font set (0-F)
         # 0x200-0xFFF - Program ROM and work RAM
-        self.memory = [0] * 4096
+        self.memory = bytearray(4096)
 
         # Black and white display. 64 x 32 pixels (2048 total)
+        # Each row is stored as one display_width bit integer, the most significant bit is the left most pixel.
         # 0 - off
         # 1 - on
-        self.video_memory = self.gen_blank_video_memory()
+        # VIP hires roms and SUPER-CHIP hires mode change the size, see set_display_size.
+        self.display = list(BLANK_DISPLAY)
+        self.display_width = DISPLAY_WIDTH
+        self.display_height = DISPLAY_HEIGHT
+        self.all_rows = ALL_ROWS
         self.should_draw = False
+        # Bit N is set when row N changed since the last call to take_dirty_rows.
+        self.dirty_rows = ALL_ROWS
 
         # V0, V1,,, VE
-        self.registers = [0] * 16
+        self.registers = bytearray(16)
 
         # I
         self.index = 0
@@ -26,28 +155,113 @@ class Chip8:
         # Both timers count down to 0 at 60Hz.
         self.delay_timer = 0
         self.sound_timer = 0
+        # The buzzer sounds while the sound timer is above 0. If set, buzzer_listener is called as
+        # buzzer_listener(cycle, on) whenever it starts or stops, so audio only has to change on those transitions.
+        self.buzzer_listener = None
+        # A start or stop from FX18 that process_events hasn't passed on to buzzer_listener yet.
+        self.buzzer_change = None
+
+        # Virtual clock. Time is measured in executed instructions (cycles), with cpu_hz cycles per second.
+        # Timer ticks happen on the cycle numbers returned by tick_cycle, so emulated time doesn't depend
+        # on how fast the host runs. In wall clock mode ticks come from real time instead: next_tick_cycle is
+        # the cycle on which real time is next checked, see sync_wall_clock.
+        self.cpu_hz = cpu_hz
+        self.wall_clock = wall_clock
+        self.wall_clock_start = time.perf_counter()
+        self.cycles = 0
+        self.ticks = 0
+        self.next_tick_cycle = WALL_CLOCK_POLL if wall_clock else self.tick_cycle(1)
+        # Key presses and releases that haven't happened yet, as (cycle, key, pressed) in cycle order.
+        self.key_events = []
+        # The cycle on which the next tick or key event is due. run() and step() only look at events from then on.
+        self.next_event_cycle = self.next_tick_cycle
+        # Addresses of backward jumps whose loops were checked by skip_idle_loop. Busy loops do real work and
+        # are never checked again. Timer loops poll the delay timer, so they can't be skipped past a tick.
+        self.busy_loops = set()
+        self.timer_loops = set()
+
+        # Unimplemented opcodes that were executed, mapped to the address each was first hit at.
+        self.unimplemented = {}
 
         self.opcode = None
         self.pc = 0x200 # Program rom gets loaded into memory starting at 0x200
 
         # Chip 8 doesn't actually specify a stack, but it does have opcodes to call a subroutine and return from one.
         # A stack and stack pointer is a straightforward implemenation to support this behavior.
-        self.stack = [0] * 16
+        self.stack = array("H", [0] * 16)
         self.stack_pointer = 0
 
         # Hex based keypad.
         # Store the state of each key (False = not pressed, True = pressed)
         self.keys = [False] * 16
+        # While FX0A waits for a key press, the register the key goes into. None the rest of the time.
+        self.key_wait = None
+
+        # Each machine has its own random number generator so its state can be saved and restored.
+        # Without a seed one is picked at random, so that any run can be logged and replayed.
+        self.seed = random.randrange(1 << 32) if seed is None else seed
+        self.rng = random.Random(self.seed)
+
+        assert decoder in DECODERS, f"Decoder must be one of {DECODERS}."
+        self.decoder = decoder
+
+        # Functions wrapped around step for this instance only (tracing, profiling), innermost first. See wrap_step.
+        self.step_wrappers = []
+        self.tracer = Tracer()
+        self.untraced_step = None
+        self.set_trace_level(trace_level)
 
         self.load_rom(rom_file)
         self.load_sprites()
 
-    def load_rom(self, file_name):
-        with open(file_name, "rb") as rom:
-            mem_index = 0x200 # Program rom gets loaded into memory starting at 0x200
-            for byte in rom.read():
-                self.memory[mem_index] = byte
-                mem_index += 1
+    @classmethod
+    def build_dispatch_table(cls, vip_hires=False):
+        """
+        Build the opcode -> handler table from decode so the two decoders can never disagree.
+        decode only looks up attributes on self, so calling it with the class returns plain functions.
+        Outside the 0NNN family the X nibble is always a register operand that decode ignores, so only
+        opcodes with X = 0 are decoded and their handlers repeated for the other 15 registers. That cuts
+        the cost of the first Chip8() in a process by about 8x.
+        With vip_hires, returns the table for VIP hires roms, which also maps VIP_HIRES_CLEAR like decode does for them.
+        """
+        if cls.dispatch_table is None:
+            table = [cls.decode(cls, opcode) for opcode in range(0x1000)]
+            for family in range(0x1000, 0x10000, 0x1000):
+                table.extend([cls.decode(cls, family | low) for low in range(0x100)] * 16)
+            cls.dispatch_table = tuple(table)
+        if not vip_hires:
+            return cls.dispatch_table
+        if cls.vip_hires_dispatch_table is None:
+            table = list(cls.dispatch_table)
+            table[VIP_HIRES_CLEAR] = cls.disp_clear
+            cls.vip_hires_dispatch_table = tuple(table)
+        return cls.vip_hires_dispatch_table
+
+    def load_rom(self, rom_file):
+        """ Load a rom from a file, or straight from its bytes. """
+        if isinstance(rom_file, (bytes, bytearray)):
+            data = bytes(rom_file)
+        else:
+            with open(rom_file, "rb") as rom:
+                data = rom.read()
+        assert len(data) <= len(self.memory) - 0x200, "Rom is too large to fit in memory."
+        # Program rom gets loaded into memory starting at 0x200
+        self.memory[0x200:0x200 + len(data)] = data
+        self.vip_hires = is_vip_hires(data)
+        self.tracer.vip_hires = self.vip_hires
+        if self.vip_hires:
+            self.set_display_size(DISPLAY_WIDTH, VIP_HIRES_HEIGHT)
+            self.pc = VIP_HIRES_START
+        if self.decoder == "table":
+            self.dispatch_table = self.build_dispatch_table(self.vip_hires)
+
+    def set_display_size(self, width, height):
+        """ Switch to a blank display of width x height pixels. """
+        self.display_width = width
+        self.display_height = height
+        self.all_rows = (1 << height) - 1
+        self.display[:] = [0] * height
+        self.dirty_rows = self.all_rows
 
     def load_sprites(self):
         for sprite_index, sprite in enumerate(SPRITE_DATA):
@@ -56,45 +270,421 @@ class Chip8:
             for index, byte in enumerate(sprite_bytes):
                 self.memory[mem_index + index] = byte
 
-    def set_key(self, key):
-        """ Sets a key to 'pressed'. The key handling opcode is responsible for setting it back to 'not pressed'."""
-        print(f"Set key {key}")
+    def press_key(self, key, cycle=None):
+        """ Press a key now, or when the clock reaches cycle. It stays down until it's released. """
+        self.queue_key_event(key, True, cycle)
+
+    def release_key(self, key, cycle=None):
+        """ Release a key now, or when the clock reaches cycle. """
+        self.queue_key_event(key, False, cycle)
+
+    def queue_key_event(self, key, pressed, cycle):
         assert 0 <= key and 15 >= key, "Key must be between 0 and 15."
-        self.keys[key] = True
+        if cycle is None or cycle <= self.cycles:
+            self.apply_key_event(key, pressed)
+            return
+        # Events usually arrive in order, so this is normally an append.
+        events = self.key_events
+        position = len(events)
+        while position and events[position - 1][0] > cycle:
+            position -= 1
+        events.insert(position, (cycle, key, pressed))
+        self.schedule_events()
+
+    def apply_key_event(self, key, pressed):
+        self.keys[key] = pressed
+        if pressed and self.key_wait is not None:
+            # Finish the FX0A that was waiting for this press.
+            self.registers[self.key_wait] = key
+            self.key_wait = None
+            self.pc += 2
+
+    def schedule_events(self):
+        """ Work out when the next tick or key event is due. """
+        if self.key_events:
+            self.next_event_cycle = min(self.next_tick_cycle, self.key_events[0][0])
+        else:
+            self.next_event_cycle = self.next_tick_cycle
+
+    def process_events(self):
+        """ Run the timer ticks and apply the key events that are due on the current cycle. """
+        if self.buzzer_change is not None:
+            # FX18 ran on the cycle before this one.
+            self.buzzer_listener(self.cycles - 1, self.buzzer_change)
+            self.buzzer_change = None
+        if self.cycles >= self.next_tick_cycle and self.wall_clock:
+            self.sync_wall_clock()
+        elif self.cycles >= self.next_tick_cycle:
+            # Tick n happens on cycle ceil(n * cpu_hz / TIMER_HZ), so every tick up to floor(cycles * TIMER_HZ / cpu_hz)
+            # is due. Below TIMER_HZ that's more than one per cycle.
+            self.tick(self.cycles * TIMER_HZ // self.cpu_hz - self.ticks)
+        else:
+            self.schedule_events()
+        events = self.key_events
+        if events and events[0][0] <= self.cycles:
+            while events and events[0][0] <= self.cycles:
+                _, key, pressed = events.pop(0)
+                self.apply_key_event(key, pressed)
+            self.schedule_events()
+
+    def wait(self, budget, until_tick=False):
+        """
+        While FX0A waits for a key, let time pass in one go: up to the next key event, or the next tick if until_tick,
+        or for budget cycles if that's sooner. Only a key event can end the wait, so the ticks on the way are run
+        together by process_events.
+        Returns the number of cycles that passed, which is 0 if nothing can happen within the budget.
+        """
+        target = self.cycles + budget
+        if self.key_events:
+            target = min(target, self.key_events[0][0])
+        if until_tick:
+            target = min(target, self.next_tick_cycle)
+        if target == float("inf"):
+            return 0
+        passed = target - self.cycles
+        self.advance(passed)
+        return passed
 
     def dump_memory(self):
         # Words are 16 bits each.
         # Print in hex
+        words = []
         mem_index = 0
         while mem_index < 4096:
             value = self.memory[mem_index] << 8 | self.memory[mem_index + 1]
-            print(format(value, '02x'), end=',')
+            words.append(format(value, '02x') + ",")
             mem_index += 2
-        print()
+        self.tracer.write("".join(words))
 
     def dump_registers(self):
-        print("Registers: ")
+        lines = ["Registers: "]
         for index, reg in enumerate(self.registers):
-            print(f"{index}: {reg}")
-        print()
+            lines.append(f"{index}: {reg}")
+        self.tracer.write("\n".join(lines) + "\n")
+
+    def wrap_step(self, wrapper):
+        """
+        Wrap this instance's step, e.g. for tracing or profiling. wrapper(inner_step) returns the step to use
+        instead, which calls inner_step. Wrappers can be added and removed in any order, see unwrap_step.
+        """
+        self.step_wrappers.append(wrapper)
+        self.install_step()
+
+    def unwrap_step(self, wrapper):
+        self.step_wrappers.remove(wrapper)
+        self.install_step()
+
+    def install_step(self):
+        """ Rebuild this instance's step from Chip8.step and the wrappers, or drop it if there are none. """
+        self.__dict__.pop("step", None)
+        for wrapper in self.step_wrappers:
+            self.step = wrapper(self.step)
+
+    def set_trace_level(self, level):
+        """
+        Turn tracing on or off. Tracing wraps step for this instance only (see wrap_step),
+        so step() and run() pay nothing for it while it's off.
+        """
+        self.tracer.level = level
+        tracing = self.trace_step in self.step_wrappers
+        if level == TRACE_OFF and tracing:
+            self.unwrap_step(self.trace_step)
+        elif level != TRACE_OFF and not tracing:
+            self.wrap_step(self.trace_step)
+
+    def trace_step(self, inner_step):
+        """ Step wrapper that records every instruction inner_step executes with the tracer. """
+        self.untraced_step = inner_step
+        return self.traced_step
+
+    def traced_step(self):
+        if self.key_wait is not None:
+            # Nothing is executed while waiting for a key, so there's nothing to record.
+            self.untraced_step()
+            return
+        pc = self.pc
+        opcode = self.memory[pc] << 8 | self.memory[pc + 1]
+        if self.tracer.level >= TRACE_REGISTERS:
+            registers = bytes(self.registers)
+            index = self.index
+        try:
+            self.untraced_step()
+        except Exception:
+            self.tracer.record(pc, opcode)
+            self.tracer.dump(header=f"Crashed executing {opcode:04X} at {pc:#05x}. Most recent instructions:")
+            raise
+
+        deltas = ()
+        if self.tracer.level >= TRACE_REGISTERS:
+            deltas = tuple((reg, value) for reg, value in enumerate(self.registers) if value != registers[reg])
+            if self.index != index:
+                deltas += ((INDEX_REGISTER, self.index),)
+        self.tracer.record(pc, opcode, deltas)
 
     def step(self):
-        print(f"PC: {self.pc}", end=" ")
+        if self.key_wait is not None:
+            # FX0A is waiting for a key. Time passes, but nothing is executed.
+            self.cycles += 1
+            if self.cycles >= self.next_event_cycle:
+                self.process_events()
+            return
 
         self.opcode = self.memory[self.pc] << 8 | self.memory[self.pc + 1]
-        instr = self.decode(self.opcode)
         self.should_draw = False # default to false, specific opcodes can override this
-        instr(self.opcode)
-
-        if self.delay_timer > 0:
-            self.delay_timer -= 1
-
+        if self.decoder == "table":
+            self.dispatch_table[self.opcode](self, self.opcode)
+        else:
+            instr = self.decode(self.opcode)
+            instr(self.opcode)
+
+        self.cycles += 1
+        if self.cycles >= self.next_event_cycle:
+            self.process_events()
+
+    def tick_cycle(self, tick):
+        """ The cycle on which the given timer tick happens. """
+        return -(-tick * self.cpu_hz // TIMER_HZ)
+
+    def tick(self, count=1):
+        """ Count both timers down by count 60Hz ticks. """
+        self.ticks += count
+        if self.delay_timer:
+            self.delay_timer = max(self.delay_timer - count, 0)
+        if self.sound_timer:
+            if self.sound_timer <= count and self.buzzer_listener:
+                # With several ticks at once (skipped idle loops) the buzzer stopped on an earlier tick than this one.
+                stop = self.cycles if self.wall_clock else self.tick_cycle(self.ticks - count + self.sound_timer)
+                self.buzzer_listener(stop, False)
+            self.sound_timer = max(self.sound_timer - count, 0)
+        if not self.wall_clock:
+            self.next_tick_cycle = self.tick_cycle(self.ticks + 1)
+        self.schedule_events()
+
+    def sync_wall_clock(self):
+        """ In wall clock mode, run every timer tick that is due according to real time. """
+        due = int((time.perf_counter() - self.wall_clock_start) * TIMER_HZ)
+        if due > self.ticks:
+            self.tick(due - self.ticks)
+        self.next_tick_cycle = self.cycles + WALL_CLOCK_POLL
+        self.schedule_events()
+
+    def run(self, cycles=None, until_pc=None, until_draw=False, until_tick=False):
+        """
+        Execute instructions until a stop condition is met and return a RunResult.
+        cycles: maximum number of instructions to execute (None for no limit).
+        until_pc: an address or collection of addresses. Stops before executing an instruction at one of them.
+        until_draw: stop after the first instruction that changes the display.
+        until_tick: stop after the instruction that completes the next 60Hz timer tick.
+        Loops that are idling until the next tick (e.g. jump to self, or polling the delay timer or a key)
+        are fast forwarded by skip_idle_loop, with the same end state as executing them.
+        """
+        if cycles is None:
+            cycles = float("inf")
+        if until_pc is None:
+            breakpoints = ()
+        elif isinstance(until_pc, int):
+            breakpoints = (until_pc,)
+        else:
+            breakpoints = frozenset(until_pc)
+
+        if "step" in self.__dict__:
+            # step is wrapped on this instance (tracing or profiling), so every instruction must go through it.
+            return self.stepped_run(cycles, breakpoints, until_draw, until_tick)
+
+        # Keep everything the loop touches in locals. The cycle count is only written back to self.cycles
+        # when an event is due, before an idle loop is checked, and when the loop exits (also on an exception).
+        memory = self.memory
+        dispatch = self.dispatch_table
+        decode = self.decode
+        busy_loops = self.busy_loops
+        # Idle loops can't be skipped if run() stops on every tick and ticks are closer together than IDLE_MIN_SKIP.
+        skip_idle = not until_tick or self.cpu_hz >= IDLE_MIN_SKIP * TIMER_HZ
+        # Only the stop conditions that were asked for are checked after each instruction.
+        check_stops = bool(until_draw or breakpoints)
+        start = self.cycles
+        stop = start + cycles
+        while self.cycles < stop:
+            if self.key_wait is not None:
+                # FX0A is waiting for a key. Sleep until the next event instead of executing anything.
+                ticks = self.ticks
+                if not self.wait(stop - self.cycles, until_tick):
+                    return RunResult(STOP_KEY, self.cycles - start)
+                if until_tick and self.ticks != ticks:
+                    return RunResult(STOP_TICK, self.cycles - start)
+                if self.pc in breakpoints:
+                    return RunResult(STOP_PC, self.cycles - start)
+                continue
+
+            # The address of a backward jump whose loop might be idle, once the inner loop finds one.
+            idle_end = None
+            cycle = self.cycles
+            try:
+                # The same loop twice, so the decoder isn't chosen on every instruction.
+                if self.decoder == "table":
+                    while cycle < stop:
+                        pc = self.pc
+                        opcode = memory[pc] << 8 | memory[pc + 1]
+                        if until_draw:
+                            self.should_draw = False
+                        dispatch[opcode](self, opcode)
+                        cycle += 1
+                        if cycle >= self.next_event_cycle:
+                            self.cycles = cycle
+                            ticks = self.ticks
+                            self.process_events()
+                            if until_tick and self.ticks != ticks:
+                                return RunResult(STOP_TICK, cycle - start)
+                            # FX0A makes an event due straight away, so the wait is only checked for here.
+                            if self.key_wait is not None and self.pc not in breakpoints:
+                                break
+                        new_pc = self.pc
+                        if check_stops:
+                            if until_draw and self.should_draw:
+                                return RunResult(STOP_DRAW, cycle - start)
+                            if new_pc in breakpoints:
+                                return RunResult(STOP_PC, cycle - start)
+                        if new_pc <= pc and opcode & 0xF000 == 0x1000 and skip_idle and pc not in busy_loops:
+                            idle_end = pc
+                            break
+                else:
+                    while cycle < stop:
+                        pc = self.pc
+                        opcode = memory[pc] << 8 | memory[pc + 1]
+                        if until_draw:
+                            self.should_draw = False
+                        decode(opcode)(opcode)
+                        cycle += 1
+                        if cycle >= self.next_event_cycle:
+                            self.cycles = cycle
+                            ticks = self.ticks
+                            self.process_events()
+                            if until_tick and self.ticks != ticks:
+                                return RunResult(STOP_TICK, cycle - start)
+                            if self.key_wait is not None and self.pc not in breakpoints:
+                                break
+                        new_pc = self.pc
+                        if check_stops:
+                            if until_draw and self.should_draw:
+                                return RunResult(STOP_DRAW, cycle - start)
+                            if new_pc in breakpoints:
+                                return RunResult(STOP_PC, cycle - start)
+                        if new_pc <= pc and opcode & 0xF000 == 0x1000 and skip_idle and pc not in busy_loops:
+                            idle_end = pc
+                            break
+            finally:
+                self.cycles = cycle
+            if idle_end is not None:
+                self.skip_idle_loop(self.pc, idle_end, stop - cycle, breakpoints, until_tick)
+        return RunResult(STOP_CYCLES, self.cycles - start)
+
+    def skip_idle_loop(self, start, end, budget, breakpoints, until_tick):
+        """
+        Called by run() after the jump at end went back to start. Executes one more pass of the loop, and if it
+        only used IDLE_HANDLERS and left registers, I and keys as they were, every following pass would be
+        identical. Those passes are skipped by moving the clock forward instead of executing them: up to the
+        next tick if the loop reads the delay timer or run() stops at ticks, otherwise up to the whole budget.
+        The instruction that completes a tick run() has to stop at is always left for run() to execute.
+        Returns the number of instructions executed or skipped, at most budget.
+        """
+        first_cycle = self.cycles
+        ticks = self.ticks
+        if until_tick or end in self.timer_loops:
+            budget = min(budget, self.next_tick_cycle - 1 - first_cycle)
+        # A key event changes what the loop sees, so it's never skipped past.
+        if self.key_events:
+            budget = min(budget, self.key_events[0][0] - 1 - self.cycles)
+        if budget < IDLE_MIN_SKIP or breakpoints and any(start <= address <= end for address in breakpoints):
+            return 0
+
+        memory = self.memory
+        table = self.build_dispatch_table(self.vip_hires)
+        state = (bytes(self.registers), self.index, tuple(self.keys))
+        reads_timer = False
+        executed = 0
+        while executed < budget:
+            pc = self.pc
+            opcode = memory[pc] << 8 | memory[pc + 1]
+            name = table[opcode].__name__
+            if not start <= pc <= end or name not in IDLE_HANDLERS:
+                self.busy_loops.add(end)
+                return executed
+            reads_timer = reads_timer or name == "set_register_timer"
+            self.should_draw = False
+            table[opcode](self, opcode)
+            self.cycles += 1
+            executed += 1
+            if self.cycles >= self.next_event_cycle:
+                # The budget stops short of the next key event, so these are timer ticks.
+                self.process_events()
+            if pc == end and self.pc == start:
+                break
+        else:
+            return executed
+
+        if (bytes(self.registers), self.index, tuple(self.keys)) != state:
+            return executed
+        # Below TIMER_HZ, or in wall clock mode, ticks can happen during the pass.
+        to_tick = self.next_tick_cycle - 1 - first_cycle
+        if reads_timer:
+            # The loop is waiting for the delay timer, so it can only be skipped up to the next tick.
+            # At low clock speeds a tick is too few instructions away for that to be worth checking.
+            if self.cpu_hz < IDLE_MIN_SKIP * TIMER_HZ:
+                self.busy_loops.add(end)
+            self.timer_loops.add(end)
+            if self.ticks != ticks:
+                # The pass read the timer from before a tick, so the next one might not match it.
+                return executed
+            budget = min(budget, to_tick)
+        if budget == float("inf"):
+            budget = to_tick
+            if budget == float("inf"):
+                return executed
+        skipped = (budget - executed) // executed * executed
+        self.advance(skipped)
+        return executed + skipped
+
+    def stepped_run(self, cycles, breakpoints, until_draw, until_tick):
+        start = self.cycles
+        stop = start + cycles
+        while self.cycles < stop:
+            ticks = self.ticks
+            if self.key_wait is not None:
+                # Nothing is executed while FX0A waits, so there's nothing to step through. Wait as run() does.
+                if not self.wait(stop - self.cycles, until_tick):
+                    return RunResult(STOP_KEY, self.cycles - start)
+            else:
+                self.step()
+            if until_tick and self.ticks != ticks:
+                return RunResult(STOP_TICK, self.cycles - start)
+            if until_draw and self.should_draw:
+                return RunResult(STOP_DRAW, self.cycles - start)
+            if self.pc in breakpoints:
+                return RunResult(STOP_PC, self.cycles - start)
+        return RunResult(STOP_CYCLES, self.cycles - start)
+
+    def advance(self, cycles):
+        """ Account for instructions that were executed without going through step(). """
+        self.cycles += cycles
+        if self.cycles >= self.next_event_cycle:
+            self.process_events()
 
     def decode(self, opcode):
         if opcode == 0x00E0:
             return self.disp_clear
         elif opcode == 0x00EE:
             return self.return_from_subroutine
+        elif (opcode & 0xFFF0) == 0x00C0:
+            return self.scroll_down
+        elif opcode == 0x00FB:
+            return self.scroll_right
+        elif opcode == 0x00FC:
+            return self.scroll_left
+        elif opcode == 0x00FE:
+            return self.set_lores
+        elif opcode == 0x00FF:
+            return self.set_hires
+        elif opcode == VIP_HIRES_CLEAR and self.vip_hires:
+            return self.disp_clear
         elif (opcode & 0xF000) == 0x1000:
             return self.jump_to_constant
         elif (opcode & 0xF000) == 0x2000:
@@ -131,6 +721,8 @@ class Chip8:
             return self.set_index
         elif (opcode & 0xF000) == 0xC000:
             return self.set_register_random
+        elif (opcode & 0xF00F) == 0xD000:
+            return self.draw_large_sprite
         elif (opcode & 0xF000) == 0xD000:
             return self.draw_sprite
         elif (opcode & 0xF0FF) == 0xE09E:
@@ -139,8 +731,12 @@ class Chip8:
             return self.skip_if_not_pressed
         elif (opcode & 0xF0FF) == 0xF007:
             return self.set_register_timer
+        elif (opcode & 0xF0FF) == 0xF00A:
+            return self.wait_for_key
         elif (opcode & 0xF0FF) == 0xF015:
             return self.set_delay_timer
+        elif (opcode & 0xF0FF) == 0xF018:
+            return self.set_sound_timer
         elif (opcode & 0xF0FF) == 0xF01E:
             return self.add_index
         elif (opcode & 0xF0FF) == 0xF029:
@@ -154,68 +750,85 @@ class Chip8:
         else:
             return self.not_implemented_instr
 
+    @property
+    def video_memory(self):
+        """ The display as display_height lists of display_width pixels. Built on every access, so read it sparingly. """
+        width = self.display_width
+        return [
+            [(row >> (width - 1 - col)) & 1 for col in range(width)]
+            for row in self.display
+        ]
+
+    def take_dirty_rows(self):
+        """ Return the bit mask of rows changed since the last call and start tracking again. """
+        dirty = self.dirty_rows
+        self.dirty_rows = 0
+        return dirty
+
     def disp_clear(self, _):
-        print("Clear Display")
-        self.video_memory = self.gen_blank_video_memory()
+        self.display[:] = [0] * self.display_height
+        self.dirty_rows = self.all_rows
+        self.should_draw = True
+        self.pc += 2
+
+    def scroll_down(self, opcode):
+        # Rows move down by N, and blank rows come in at the top.
+        rows = min(opcode & 0x000F, self.display_height)
+        if rows:
+            self.display[:] = [0] * rows + self.display[:-rows]
+            self.dirty_rows = self.all_rows
+            self.should_draw = True
+        self.pc += 2
+
+    def scroll_right(self, _):
+        # Every row is shifted 4 pixels as a single integer. Pixels that go past the edge are lost.
+        self.display[:] = [row >> 4 for row in self.display]
+        self.dirty_rows = self.all_rows
+        self.should_draw = True
+        self.pc += 2
+
+    def scroll_left(self, _):
+        mask = (1 << self.display_width) - 1
+        self.display[:] = [(row << 4) & mask for row in self.display]
+        self.dirty_rows = self.all_rows
+        self.should_draw = True
+        self.pc += 2
+
+    def set_lores(self, _):
+        self.set_display_size(DISPLAY_WIDTH, DISPLAY_HEIGHT)
+        self.should_draw = True
+        self.pc += 2
+
+    def set_hires(self, _):
+        self.set_display_size(HIRES_WIDTH, HIRES_HEIGHT)
         self.should_draw = True
         self.pc += 2
 
     def set_register_const(self, opcode):
-        print("Set Register to Constant")
         reg_index = (opcode & 0x0F00) >> 8
         const = opcode & 0x00FF
         self.registers[reg_index] = const
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {reg_index}")
-            print(f"Constant Value: {const}")
-            print()
-
     def set_register_register(self, opcode):
-        print("Set Register to Register")
         x_index = (opcode & 0x0F00) >> 8
         y_index = (opcode & 0x00F0) >> 4
         self.registers[x_index] = self.registers[y_index]
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {x_index}")
-            print(f"Register Index: {y_index}")
-            print()
-
-
     def set_register_timer(self, opcode):
-        print("Set Register to Timer")
         reg_index = (opcode & 0x0F00) >> 8
         self.registers[reg_index] = self.delay_timer
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {reg_index}")
-            print(f"Timer Value: {self.delay_timer}")
-            print()
-
     def set_register_random(self, opcode):
-        print("Set register to random")
         reg_index = (opcode & 0x0F00) >> 8
         const = opcode & 0x00FF
-        rand = random.randint(0, ((2**8) - 1))
+        rand = self.rng.randint(0, ((2**8) - 1))
         self.registers[reg_index] = rand & const
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {reg_index}")
-            print(f"Constant Value: {const}")
-            print(f"Randomly Generated Value: {rand}")
-            print()
-
     def add_register_const(self, opcode):
-        print("Add Constant to Register")
         reg_index = (opcode & 0x0F00) >> 8
         const = opcode & 0x00FF
         result = self.registers[reg_index] + const
@@ -223,14 +836,7 @@ class Chip8:
         self.registers[reg_index] = result % (2**8)
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {reg_index}")
-            print(f"Constant Value: {const}")
-            print()
-
     def add_registers(self, opcode):
-        print("Add register to register")
         x_index = (opcode & 0x0F00) >> 8
         y_index = (opcode & 0x00F0) >> 4
         result = self.registers[x_index] + self.registers[y_index]
@@ -243,14 +849,7 @@ class Chip8:
 
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {x_index}")
-            print(f"Register Index: {y_index}")
-            print()
-
     def sub_registers(self, opcode):
-        print("Subtract register to register")
         x_index = (opcode & 0x0F00) >> 8
         y_index = (opcode & 0x00F0) >> 4
         result = self.registers[x_index] - self.registers[y_index]
@@ -265,14 +864,7 @@ class Chip8:
 
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {x_index}")
-            print(f"Register Index: {y_index}")
-            print()
-
     def shift_right(self, opcode):
-        print("Shift register right")
         reg_index = (opcode & 0x0F00) >> 8
         value = self.registers[reg_index]
 
@@ -282,14 +874,7 @@ class Chip8:
 
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {reg_index}")
-            self.dump_registers()
-            print()
-
     def shift_left(self, opcode):
-        print("Shift register left")
         reg_index = (opcode & 0x0F00) >> 8
         value = self.registers[reg_index]
 
@@ -299,73 +884,33 @@ class Chip8:
 
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {reg_index}")
-            self.dump_registers()
-            print()
-
     def or_registers(self, opcode):
-        print("Set register to logical or of self and register")
         x_index = (opcode & 0x0F00) >> 8
         y_index = (opcode & 0x00F0) >> 4
         result = self.registers[x_index] | self.registers[y_index]
         self.registers[x_index] = result
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            self.dump_registers()
-            print(f"Register Index: {x_index}")
-            print(f"Register Index: {y_index}")
-            self.dump_registers()
-            print()
-
     def and_registers(self, opcode):
-        print("Set register to logical and of self and register")
         x_index = (opcode & 0x0F00) >> 8
         y_index = (opcode & 0x00F0) >> 4
         result = self.registers[x_index] & self.registers[y_index]
         self.registers[x_index] = result
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            self.dump_registers()
-            print(f"Register Index: {x_index}")
-            print(f"Register Index: {y_index}")
-            self.dump_registers()
-            print()
-
     def xor_registers(self, opcode):
-        print("Set register to logical xor of self and register")
         x_index = (opcode & 0x0F00) >> 8
         y_index = (opcode & 0x00F0) >> 4
         result = self.registers[x_index] ^ self.registers[y_index]
         self.registers[x_index] = result
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            self.dump_registers()
-            print(f"Register Index: {x_index}")
-            print(f"Register Index: {y_index}")
-            self.dump_registers()
-            print()
-
     def set_index(self, opcode):
-        print("Set Index")
         const = opcode & 0x0FFF
         self.index = const
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Constant Value: {const}")
-            print()
-
     def set_index_to_sprite(self, opcode):
-        print("Set Index to Sprite")
         # https://github.com/mattmikolay/chip-8/wiki/CHIP‐8-Technical-Reference#fonts
         # Sprites start at 0x00 and each takes up 5 bytes
         reg_index = (opcode & 0x0F00) >> 8
@@ -375,15 +920,7 @@ class Chip8:
         self.index = sprite_location
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {reg_index}")
-            print(f"Register Value: {value}")
-            print(f"Sprite Location: {sprite_location}")
-            print()
-
     def add_index(self, opcode):
-        print("Add to Index")
         reg_index = (opcode & 0x0F00) >> 8
         value = self.registers[reg_index]
         result = self.index + value
@@ -397,63 +934,47 @@ class Chip8:
 
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {reg_index}")
-            print()
-
     def call_subroutine(self, opcode):
-        print("Call Subroutine")
+        if self.stack_pointer == len(self.stack):
+            raise IndexError("Stack overflow")
         addr = opcode & 0x0FFF
         self.stack[self.stack_pointer] = self.pc
         self.stack_pointer += 1
         self.pc = addr
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Address: {addr}")
-            print()
-
     def jump_to_constant(self, opcode):
-        print("Jump To Constant")
         const = opcode & 0x0FFF
         self.pc = const
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Address: {const}")
-            print()
-
     def return_from_subroutine(self, opcode):
-        print("Return From Subroutine")
-
         # value stored on stack is the calling address, we want the instruction after that so we add 2. 
         # stack pointer points to next open spot, so we subtract 1 to get last item on stack.
+        if not self.stack_pointer:
+            raise IndexError("Stack underflow")
         addr = self.stack[self.stack_pointer - 1] + 2
         self.stack_pointer -= 1
         self.pc = addr
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Address: {addr}")
-            print()
-
     def set_delay_timer(self, opcode):
-        print("Set Delay Timer")
         reg_index = (opcode & 0x0F00) >> 8
         value = self.registers[reg_index]
 
         self.delay_timer = value
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register: {reg_index}")
-            print(f"Value: {value}")
-            print()
+    def set_sound_timer(self, opcode):
+        reg_index = (opcode & 0x0F00) >> 8
+        value = self.registers[reg_index]
+
+        if self.buzzer_listener and bool(value) != bool(self.sound_timer):
+            # run() only keeps self.cycles up to date on events, so the change is reported by the next one,
+            # which is made due straight after this instruction.
+            self.buzzer_change = bool(value)
+            self.next_event_cycle = 0
+        self.sound_timer = value
+        self.pc += 2
 
     def skip_if_equal(self, opcode):
-        print("Skip If Equal")
         reg_index = (opcode & 0x0F00) >> 8
         value = self.registers[reg_index]
         const = opcode & 0x00FF
@@ -463,15 +984,7 @@ class Chip8:
         else:
             self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register: {reg_index}")
-            print(f"Value: {value}")
-            print(f"Const: {const}")
-            print()
-
     def skip_if_reg_equal(self, opcode):
-        print("Skip If Registers Equal")
         x_index = (opcode & 0x0F00) >> 8
         y_index = (opcode & 0x00F0) >> 4
 
@@ -480,15 +993,7 @@ class Chip8:
         else:
             self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {x_index}")
-            print(f"Register Index: {y_index}")
-            self.dump_registers()
-
-
     def skip_if_not_equal(self, opcode):
-        print("Skip If Not Equal")
         reg_index = (opcode & 0x0F00) >> 8
         value = self.registers[reg_index]
         const = opcode & 0x00FF
@@ -498,15 +1003,7 @@ class Chip8:
         else:
             self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register: {reg_index}")
-            print(f"Value: {value}")
-            print(f"Const: {const}")
-            print()
-
     def skip_if_not_equal_registers(self, opcode):
-        print("Skip If Not Equal Registers")
         x_index = (opcode & 0x0F00) >> 8
         y_index = (opcode & 0x00F0) >> 4
 
@@ -515,15 +1012,7 @@ class Chip8:
         else:
             self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register Index: {x_index}")
-            print(f"Register Index: {y_index}")
-            self.dump_registers()
-            print()
-
     def skip_if_pressed(self, opcode):
-        print("Skip If Key Pressed")
         reg_index = (opcode & 0x0F00) >> 8
         value = self.registers[reg_index]
         pressed = self.keys[value]
@@ -533,17 +1022,7 @@ class Chip8:
         else:
             self.pc += 2
 
-        # Reset key value after it's processed
-        self.keys[value] = False
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register: {reg_index}")
-            print(f"Value: {value}")
-            print(f"Pressed: {pressed}")
-            print()
-
     def skip_if_not_pressed(self, opcode):
-        print("Skip If Key Not Pressed")
         reg_index = (opcode & 0x0F00) >> 8
         value = self.registers[reg_index]
         pressed = self.keys[value]
@@ -553,17 +1032,13 @@ class Chip8:
         else:
             self.pc += 2
 
-        # Reset key value after it's processed
-        self.keys[value] = False
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register: {reg_index}")
-            print(f"Value: {value}")
-            print(f"Pressed: {pressed}")
-            print()
+    def wait_for_key(self, opcode):
+        # Execution is suspended until the next key press, which stores the key in VX and moves on (see apply_key_event).
+        self.key_wait = (opcode & 0x0F00) >> 8
+        # Make the run loop look at the wait straight after this instruction.
+        self.next_event_cycle = 0
 
     def store_bcd(self, opcode):
-        print("Store BCD to Memory")
         reg_index = (opcode & 0x0F00) >> 8
         value = self.registers[reg_index]
 
@@ -577,16 +1052,7 @@ class Chip8:
 
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register: {reg_index}")
-            print(f"I: {self.index}")
-            self.dump_registers()
-            self.dump_memory()
-            print()
-
     def mem_dump(self, opcode):
-        print("Dump to Memory")
         reg_index = (opcode & 0x0F00) >> 8
         index = self.index
         for val in self.registers[:reg_index + 1]:
@@ -594,64 +1060,66 @@ class Chip8:
             index += 1
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register: {reg_index}")
-            print(f"I: {self.index}")
-            print()
-
     def mem_read(self, opcode):
-        print("Read from Memory")
         reg_x = (opcode & 0x0F00) >> 8
         index = self.index
         for index in range(0, reg_x + 1):
             self.registers[index] = self.memory[self.index + index]
         self.pc += 2
 
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"Register: {reg_x}")
-            print(f"I: {self.index}")
-            self.dump_registers()
-            print()
-
-
     def draw_sprite(self, opcode):
-        print("Draw Sprite")
-        x = self.registers[(opcode & 0x0F00) >> 8]
-        y = self.registers[(opcode & 0x00F0) >> 4]
-        height = opcode & 0x000F
-        if DEBUG:
-            print(format(opcode, '02x'))
-            print(f"X: {x}")
-            print(f"Y: {y}")
-            print(f"Height: {height}")
-            print()
-
-        self.registers[0xF] = 0
+        # Sprites start at (VX, VY), wrapping around the screen, and are clipped at the right and bottom edges.
+        width = self.display_width
+        x = self.registers[(opcode & 0x0F00) >> 8] % width
+        y = self.registers[(opcode & 0x00F0) >> 4] % self.display_height
+        height = min(opcode & 0x000F, self.display_height - y)
+
+        # Each sprite line is shifted into position and XORed onto its display row in one go.
+        # Any pixel that was on in both is a collision.
+        display = self.display
+        shift = width - 8
+        collision = 0
         for sprite_row in range(height):
-            sprite_line = self.memory[self.index + sprite_row]
-            bits = byte_to_bits(sprite_line)
-            for ind, bit in enumerate(bits):
-                row = y + sprite_row
-                col = x + ind
-                if bit:
-                    if self.video_memory[row][col]:
-                        self.video_memory[row][col] = 0
-                        self.registers[0xF] = 1
-                    else:
-                        self.video_memory[row][col] = 1
+            line = (self.memory[self.index + sprite_row] << shift) >> x
+            row = display[y + sprite_row]
+            collision |= row & line
+            display[y + sprite_row] = row ^ line
 
+        self.dirty_rows |= ((1 << height) - 1) << y
+        self.registers[0xF] = 1 if collision else 0
         self.should_draw = True
         self.pc += 2
 
-    def not_implemented_instr(self, opcode):
-        print(f"Not implemented opcode: {format(opcode, '02x')}")
-        self.dump_registers()
+    def draw_large_sprite(self, opcode):
+        # In SUPER-CHIP hires mode DXY0 draws a 16x16 sprite of two bytes per line. Otherwise it's a DXYN
+        # with N = 0, which draws nothing.
+        if self.display_width != HIRES_WIDTH:
+            self.draw_sprite(opcode)
+            return
+        x = self.registers[(opcode & 0x0F00) >> 8] % HIRES_WIDTH
+        y = self.registers[(opcode & 0x00F0) >> 4] % HIRES_HEIGHT
+        height = min(16, HIRES_HEIGHT - y)
+
+        display = self.display
+        memory = self.memory
+        shift = HIRES_WIDTH - 16
+        collision = 0
+        for sprite_row in range(height):
+            address = self.index + 2 * sprite_row
+            line = ((memory[address] << 8 | memory[address + 1]) << shift) >> x
+            row = display[y + sprite_row]
+            collision |= row & line
+            display[y + sprite_row] = row ^ line
+
+        self.dirty_rows |= ((1 << height) - 1) << y
+        self.registers[0xF] = 1 if collision else 0
+        self.should_draw = True
         self.pc += 2
 
-    def gen_blank_video_memory(self):
-        video_memory = []
-        for row in range(DISPLAY_HEIGHT):
-            video_memory.append([0] * DISPLAY_WIDTH)
-        return video_memory
+    def not_implemented_instr(self, opcode):
+        # Only the first hit of each opcode is reported, a rom looping over one would drown everything else.
+        if opcode not in self.unimplemented:
+            self.unimplemented[opcode] = self.pc
+            self.tracer.write(f"Not implemented opcode: {format(opcode, '02x')}")
+            self.dump_registers()
+        self.pc += 2
@@ -0,0 +1,373 @@
+import argparse
+import copy
+import hashlib
+import importlib.util
+import inspect
+import io
+import os
+import sys
+import time
+from bench import scripted_key_events
+from chip8 import Chip8, DEFAULT_CPU_HZ, DISPLAY_WIDTH, disassemble, is_vip_hires
+from savestate import load_state, save_state
+
+# Engines that can be checked against the reference, which is a Chip8 executed one step() at a time.
+#   step   - the same, for checking a reference loaded from another chip8.py
+#   chain  - step() with the if/elif decoder
+#   run    - Chip8.run, with its fast paths (idle loop skipping, batched event checks)
+#   block  - translator.BlockEngine
+#   vector - a one machine vector.VectorChip8 (needs numpy, and is much slower than the others)
+ENGINES = ("step", "chain", "run", "block", "vector")
+
+DEFAULT_CYCLES = 1000000
+# Clock speeds every rom is checked at. Below TIMER_HZ several timer ticks fall on the same cycle.
+CPU_HZ = (DEFAULT_CPU_HZ, 30)
+DEFAULT_INTERVAL = 10000
+SEED = 0
+# Differing memory bytes and display rows listed in a divergence report.
+MAX_LISTED = 16
+# What a reference core needs beyond step(): Chip8(rom_file, decoder=..., seed=...) and these methods, for
+# queued key events, save states and the state comparison. chip8.py has all of them since SUPER-CHIP support.
+REFERENCE_ARGUMENTS = ("decoder", "seed")
+REFERENCE_METHODS = ("queue_key_event", "schedule_events", "set_display_size")
+
+
+def chip_state(chip):
+    """ Everything an engine could get wrong, in a form that compares equal across engines. """
+    return {
+        "pc": chip.pc,
+        "index": chip.index,
+        "registers": bytes(chip.registers),
+        "stack": tuple(chip.stack[:chip.stack_pointer]),
+        "delay_timer": chip.delay_timer,
+        "sound_timer": chip.sound_timer,
+        "key_wait": chip.key_wait,
+        "keys": tuple(chip.keys),
+        "cycles": chip.cycles,
+        "ticks": chip.ticks,
+        "memory": bytes(chip.memory),
+        "display_width": chip.display_width,
+        "display": tuple(chip.display),
+    }
+
+
+def same_state(first, second):
+    """ States match when they're equal, or when both engines have stopped with an error. """
+    if "error" in first or "error" in second:
+        return "error" in first and "error" in second
+    return first == second
+
+
+def state_hash(state):
+    return hashlib.sha256(repr(sorted(state.items())).encode()).hexdigest()
+
+
+class ChipRunner:
+    """
+    Runs a Chip8 with one of the scalar engines. Snapshots are save states, and key events are
+    queued again after a restore, since the ones already applied have left the chip's queue.
+    An exception stops the machine, and its state becomes just the error.
+    """
+    def __init__(self, chip, engine, events):
+        self.chip = chip
+        self.engine = engine
+        self.events = events
+        self.error = None
+        # Unimplemented opcodes are reported through the tracer, which would print on every run of a bisection.
+        chip.tracer.stream = io.StringIO()
+        self.block_engine = None
+        if engine == "block":
+            from translator import BlockEngine
+
+            self.block_engine = BlockEngine(chip)
+        for cycle, key, pressed in events:
+            chip.queue_key_event(key, pressed, cycle)
+
+    def run(self, cycles):
+        if self.error:
+            return
+        chip = self.chip
+        try:
+            if self.engine == "run":
+                chip.run(cycles=cycles)
+            elif self.engine == "block":
+                self.block_engine.run(cycles)
+            else:
+                step = chip.step
+                for _ in range(cycles):
+                    step()
+        except Exception as error:
+            self.error = repr(error)
+
+    def state(self):
+        return {"error": self.error} if self.error else chip_state(self.chip)
+
+    def save(self):
+        return self.error, save_state(self.chip)
+
+    def load(self, snapshot):
+        chip = self.chip
+        self.error, data = snapshot
+        load_state(chip, data)
+        if self.block_engine:
+            self.block_engine.flush()
+        chip.key_events.clear()
+        for cycle, key, pressed in self.events:
+            if cycle > chip.cycles:
+                chip.queue_key_event(key, pressed, cycle)
+        chip.schedule_events()
+
+
+class VectorRunner:
+    """ Runs a copy of a chip as the only machine of a VectorChip8. Key events are applied between runs. """
+    def __init__(self, chip, events):
+        from vector import VectorChip8
+
+        self.engine = VectorChip8.from_chips([chip])
+        self.events = events
+        # Index of the first event that hasn't been applied yet.
+        self.next_event = 0
+        self.apply_due_events()
+
+    def apply_due_events(self):
+        engine = self.engine
+        events = self.events
+        while self.next_event < len(events) and events[self.next_event][0] <= engine.cycles:
+            _, key, pressed = events[self.next_event]
+            if pressed:
+                engine.press_key(0, key)
+            else:
+                engine.release_key(0, key)
+            self.next_event += 1
+
+    def run(self, cycles):
+        # Like Chip8, events due on a cycle are applied after the instruction that reaches it.
+        engine = self.engine
+        end = engine.cycles + cycles
+        while True:
+            self.apply_due_events()
+            if engine.cycles >= end:
+                break
+            target = end
+            if self.next_event < len(self.events):
+                target = min(end, self.events[self.next_event][0])
+            engine.run(target - engine.cycles)
+
+    def state(self):
+        engine = self.engine
+        if engine.faulted[0]:
+            return {"error": "faulted"}
+        key_wait = int(engine.key_wait[0])
+        return {
+            "pc": int(engine.pc[0]),
+            "index": int(engine.index[0]),
+            "registers": bytes(engine.registers[0]),
+            "stack": tuple(int(value) for value in engine.stack[0, :engine.stack_pointer[0]]),
+            "delay_timer": int(engine.delay_timer[0]),
+            "sound_timer": int(engine.sound_timer[0]),
+            "key_wait": None if key_wait < 0 else key_wait,
+            "keys": tuple(bool(key) for key in engine.keys[0]),
+            "cycles": engine.cycles,
+            "ticks": engine.ticks,
+            "memory": bytes(engine.memory[0]),
+            "display_width": DISPLAY_WIDTH,
+            "display": tuple(int(row) for row in engine.display[0]),
+        }
+
+    def save(self):
+        return copy.deepcopy(self.engine), self.next_event
+
+    def load(self, snapshot):
+        engine, self.next_event = snapshot
+        self.engine = copy.deepcopy(engine)
+
+
+def load_chip_class(path):
+    """
+    The Chip8 class of another copy of chip8.py, e.g. one checked out from before a change.
+    Raises ValueError if that core is too old to be checked against (see REFERENCE_METHODS).
+    """
+    spec = importlib.util.spec_from_file_location("reference_chip8", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    chip_class = module.Chip8
+    parameters = inspect.signature(chip_class).parameters
+    missing = [f"{name}=" for name in REFERENCE_ARGUMENTS if name not in parameters]
+    missing += [f"{name}()" for name in REFERENCE_METHODS if not hasattr(chip_class, name)]
+    if missing:
+        raise ValueError(f"{path} is too old to use as a reference, its Chip8 has no {', '.join(missing)}. "
+                         "Cores from SUPER-CHIP support on are supported.")
+    return chip_class
+
+
+def make_runner(engine, rom_file, events, seed=SEED, chip_class=Chip8, **chip_args):
+    if engine == "vector":
+        return VectorRunner(Chip8(rom_file, seed=seed, **chip_args), events)
+    decoder = "chain" if engine == "chain" else "table"
+    return ChipRunner(chip_class(rom_file, decoder=decoder, seed=seed, **chip_args), engine, events)
+
+
+def bisect(reference, alternate, snapshots, count):
+    """
+    The engines match at the snapshots and differ count cycles later. Narrow that down to the first
+    differing instruction, and leave both engines in the last matching state. Returns the number of
+    cycles from the snapshots to that state.
+    """
+    low, high = 0, count
+    while high - low > 1:
+        middle = (low + high) // 2
+        reference.load(snapshots[0])
+        alternate.load(snapshots[1])
+        reference.run(middle - low)
+        alternate.run(middle - low)
+        if same_state(reference.state(), alternate.state()):
+            low = middle
+            snapshots = (reference.save(), alternate.save())
+        else:
+            high = middle
+    reference.load(snapshots[0])
+    alternate.load(snapshots[1])
+    return low
+
+
+def describe_state(state):
+    if "error" in state:
+        return [f"  stopped: {state['error']}"]
+    registers = " ".join(f"V{n:X}={value:02x}" for n, value in enumerate(state["registers"]))
+    return [
+        f"  pc={state['pc']:#05x} I={state['index']:#05x} DT={state['delay_timer']} ST={state['sound_timer']}"
+        f" stack=[{' '.join(f'{address:#05x}' for address in state['stack'])}] key_wait={state['key_wait']}"
+        f" cycles={state['cycles']} ticks={state['ticks']} hash={state_hash(state)[:12]}",
+        f"  {registers}",
+    ]
+
+
+def describe_divergence(before, reference, alternate, engine):
+    """ A report of the instruction that made the engines differ and both states after it. """
+    lines = []
+    if "error" in before:
+        lines.append("Both engines had already stopped.")
+    else:
+        pc = before["pc"]
+        opcode = before["memory"][pc] << 8 | before["memory"][pc + 1] if pc + 1 < len(before["memory"]) else None
+        # The jump at the start of a VIP hires rom is never executed, so it's still there to tell which table applies.
+        vip_hires = is_vip_hires(bytes(before["memory"][0x200:0x202]))
+        instruction = f"{opcode:04X}  {disassemble(opcode, vip_hires)}" if opcode is not None else "(past the end of memory)"
+        lines.append(f"First differing instruction at cycle {before['cycles']}: {pc:#05x}  {instruction}")
+        lines.append("Before it:")
+        lines += describe_state(before)
+    lines.append("reference after it:")
+    lines += describe_state(reference)
+    lines.append(f"{engine} after it:")
+    lines += describe_state(alternate)
+    if "error" in reference or "error" in alternate:
+        return "\n".join(lines)
+
+    for name in ("pc", "index", "delay_timer", "sound_timer", "key_wait", "keys", "cycles", "ticks", "stack", "display_width"):
+        if reference[name] != alternate[name]:
+            lines.append(f"  {name}: {reference[name]} != {alternate[name]}")
+    for n, (expected, actual) in enumerate(zip(reference["registers"], alternate["registers"])):
+        if expected != actual:
+            lines.append(f"  V{n:X}: {expected:#04x} != {actual:#04x}")
+    addresses = [address for address, (expected, actual) in enumerate(zip(reference["memory"], alternate["memory"]))
+                 if expected != actual]
+    for address in addresses[:MAX_LISTED]:
+        lines.append(f"  memory[{address:#05x}]: {reference['memory'][address]:#04x} != {alternate['memory'][address]:#04x}")
+    rows = [y for y, (expected, actual) in enumerate(zip(reference["display"], alternate["display"])) if expected != actual]
+    width = reference["display_width"]
+    for y in rows[:MAX_LISTED]:
+        lines.append(f"  display row {y}: {reference['display'][y]:0{width}b} != {alternate['display'][y]:0{width}b}")
+    if len(addresses) > MAX_LISTED or len(rows) > MAX_LISTED:
+        lines.append(f"  ({len(addresses)} memory bytes and {len(rows)} display rows differ in total)")
+    return "\n".join(lines)
+
+
+def check(rom_file, engine, cycles=DEFAULT_CYCLES, interval=DEFAULT_INTERVAL, events=None, seed=SEED,
+          chip_class=Chip8, **chip_args):
+    """
+    Run the reference (chip_class, one step() per instruction) and engine in lockstep on the same rom and input,
+    comparing their states every interval cycles. events are (cycle, key, pressed), scripted input if None.
+    Returns None if they agree for the whole run, otherwise a report of the first differing instruction.
+    """
+    chip = chip_class(rom_file, seed=seed, **chip_args)
+    if events is None:
+        events = scripted_key_events(chip, cycles)
+    reference = ChipRunner(chip, "step", events)
+    alternate = make_runner(engine, rom_file, events, seed=seed, **chip_args)
+
+    done = 0
+    snapshots = (reference.save(), alternate.save())
+    if not same_state(reference.state(), alternate.state()):
+        return describe_divergence(reference.state(), reference.state(), alternate.state(), engine)
+    while done < cycles:
+        count = min(interval, cycles - done)
+        reference.run(count)
+        alternate.run(count)
+        if not same_state(reference.state(), alternate.state()):
+            done += bisect(reference, alternate, snapshots, count)
+            before = reference.state()
+            reference.run(1)
+            alternate.run(1)
+            return describe_divergence(before, reference.state(), alternate.state(), engine)
+        done += count
+        if "error" in reference.state():
+            # Both stopped with an error, so there's nothing left to compare.
+            break
+        snapshots = (reference.save(), alternate.save())
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check an engine against the reference interpreter, instruction for instruction.")
+    parser.add_argument("roms", nargs="*", help="Roms to check. Defaults to the whole rom library.")
+    parser.add_argument("--engine", choices=ENGINES, default="block")
+    parser.add_argument("--cycles", type=int, default=DEFAULT_CYCLES)
+    parser.add_argument("--interval", type=int, default=DEFAULT_INTERVAL, help="Cycles between state comparisons.")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--cpu-hz", type=int, action="append",
+                        help=f"Clock speed to check at. Can be repeated. Defaults to {', '.join(map(str, CPU_HZ))}.")
+    parser.add_argument("--log", help="Use the rom, seed and key events of an input log instead.")
+    parser.add_argument("--reference", help="A chip8.py to use as the reference instead of this one, "
+                                            "e.g. `git show HEAD~1:chip8.py > /tmp/chip8_old.py`. "
+                                            "It has to be from SUPER-CHIP support on.")
+    args = parser.parse_args()
+
+    chip_class = Chip8
+    if args.reference:
+        try:
+            chip_class = load_chip_class(args.reference)
+        except ValueError as error:
+            parser.error(str(error))
+    runs = []
+    if args.log:
+        from inputlog import find_rom, read_log
+
+        log = read_log(args.log)
+        cycles = log["cycles"] or args.cycles
+        runs.append((find_rom(log, args.log), cycles, log["events"], log["seed"], {"cpu_hz": log["cpu_hz"]}))
+    else:
+        from batch import find_roms
+
+        roms = args.roms or find_roms()
+        runs = [
+            (rom_file, args.cycles, None, args.seed, {"cpu_hz": cpu_hz})
+            for cpu_hz in args.cpu_hz or CPU_HZ
+            for rom_file in roms
+        ]
+
+    diverged = 0
+    start = time.perf_counter()
+    for rom_file, cycles, events, seed, chip_args in runs:
+        rom_start = time.perf_counter()
+        report = check(rom_file, args.engine, cycles, args.interval, events, seed, chip_class, **chip_args)
+        status = "ok" if report is None else "DIVERGED"
+        print(f"{status:<9} {os.path.basename(rom_file)} at {chip_args['cpu_hz']}Hz ({time.perf_counter() - rom_start:.2f}s)")
+        if report:
+            diverged += 1
+            print(report)
+    print(f"{len(runs)} runs, {diverged} diverged, in {time.perf_counter() - start:.2f}s")
+    return 1 if diverged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
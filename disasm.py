@@ -0,0 +1,306 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from chip8 import Chip8, VIP_HIRES_START, disassemble, is_vip_hires
+
+DEFAULT_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".disasm-cache.json")
+# Bump when the analysis changes, so old cache entries are rebuilt.
+CACHE_VERSION = 2
+PROGRAM_START = 0x200
+
+# Handlers that end a basic block. Unimplemented opcodes (including BNNN and 00FD) are executed
+# as no-ops by the interpreter, so they fall through like any other instruction.
+SKIP_HANDLERS = {
+    "skip_if_equal",
+    "skip_if_not_equal",
+    "skip_if_reg_equal",
+    "skip_if_not_equal_registers",
+    "skip_if_pressed",
+    "skip_if_not_pressed",
+}
+BLOCK_END_HANDLERS = SKIP_HANDLERS | {"jump_to_constant", "call_subroutine", "return_from_subroutine"}
+
+# Kinds of data region, by how the code uses it.
+SPRITE = "sprite" # drawn with DXYN
+DATA = "data" # read or written with FX33, FX55 or FX65
+UNKNOWN = "unknown" # not reached as code and not referenced through a known I
+
+
+def successors(pc, opcode, name):
+    """ The addresses execution can continue at after the instruction at pc, not counting call targets. """
+    if name == "jump_to_constant":
+        return [opcode & 0x0FFF]
+    if name == "return_from_subroutine":
+        return []
+    if name in SKIP_HANDLERS:
+        return [pc + 2, pc + 4]
+    return [pc + 2]
+
+
+def analyze(data):
+    """
+    Static analysis of a rom, as a JSON friendly dict:
+      entry, end             - first instruction and the address after the last rom byte
+      code                   - addresses of every instruction reachable from entry
+      blocks                 - basic blocks: start, end (after the last instruction), successors and call target
+      functions              - entry, blocks and callees of the main program and every subroutine
+      loops                  - (block, target) for every backward edge, i.e. the loops worth optimizing
+      data                   - start, end and kind of every range of rom bytes that isn't code
+      self_modifying         - FX33/FX55 writes with a known I that land on code: pc, start, end
+      unresolved_writes      - addresses of FX33/FX55 writes whose I isn't known statically
+      outside                - jump and call targets outside the rom
+    Code is found by following jumps, calls and skips from the entry point. I is only tracked within
+    a basic block, from ANNN to the next instruction that changes it.
+    """
+    vip_hires = is_vip_hires(data)
+    table = Chip8.build_dispatch_table(vip_hires)
+    entry = VIP_HIRES_START if vip_hires else PROGRAM_START
+    end = PROGRAM_START + len(data)
+
+    # Find every reachable instruction and the leaders that start basic blocks.
+    code = {}
+    leaders = {entry}
+    call_targets = set()
+    outside = set()
+    pending = [entry]
+    while pending:
+        pc = pending.pop()
+        while pc not in code:
+            if not PROGRAM_START <= pc < end - 1:
+                outside.add(pc)
+                break
+            opcode = data[pc - PROGRAM_START] << 8 | data[pc - PROGRAM_START + 1]
+            name = table[opcode].__name__
+            code[pc] = (opcode, name)
+            if name in BLOCK_END_HANDLERS:
+                targets = successors(pc, opcode, name)
+                if name == "call_subroutine":
+                    call_targets.add(opcode & 0x0FFF)
+                    targets.append(opcode & 0x0FFF)
+                leaders.update(targets)
+                pending.extend(targets)
+                break
+            pc += 2
+
+    # Every instruction is reached by falling through from a leader, so walking from each leader finds all blocks.
+    blocks = {}
+    for start in sorted(leaders):
+        if start not in code:
+            continue
+        pc = start
+        while code[pc][1] not in BLOCK_END_HANDLERS and pc + 2 not in leaders and pc + 2 in code:
+            pc += 2
+        opcode, name = code[pc]
+        blocks[start] = {
+            "start": start,
+            "end": pc + 2,
+            "successors": successors(pc, opcode, name),
+            "call": opcode & 0x0FFF if name == "call_subroutine" else None,
+        }
+
+    functions = []
+    for function_entry in [entry] + sorted(call_targets - {entry}):
+        if function_entry not in blocks:
+            continue
+        seen = set()
+        callees = set()
+        pending = [function_entry]
+        while pending:
+            start = pending.pop()
+            if start in seen or start not in blocks:
+                continue
+            seen.add(start)
+            block = blocks[start]
+            if block["call"] is not None:
+                callees.add(block["call"])
+            pending.extend(block["successors"])
+        functions.append({"entry": function_entry, "blocks": sorted(seen), "calls": sorted(callees)})
+
+    loops = [
+        [start, target] for start, block in sorted(blocks.items())
+        for target in block["successors"] if target <= start and target in blocks
+    ]
+
+    # Memory accesses through I, for the instructions where I is known.
+    code_bytes = set()
+    for pc in code:
+        code_bytes.update((pc, pc + 1))
+    reads = {}
+    self_modifying = []
+    unresolved_writes = []
+    for start, block in sorted(blocks.items()):
+        index = None
+        for pc in range(start, block["end"], 2):
+            opcode, name = code[pc]
+            x = (opcode & 0x0F00) >> 8
+            if name == "set_index":
+                index = opcode & 0x0FFF
+            elif name in ("add_index", "set_index_to_sprite"):
+                index = None
+            elif name in ("draw_sprite", "draw_large_sprite", "mem_read") and index is not None:
+                length = {"draw_sprite": opcode & 0xF, "draw_large_sprite": 32, "mem_read": x + 1}[name]
+                for address in range(index, index + length):
+                    # A byte that's both drawn and read as data counts as a sprite.
+                    if reads.get(address) != SPRITE:
+                        reads[address] = SPRITE if name != "mem_read" else DATA
+            elif name in ("store_bcd", "mem_dump"):
+                if index is None:
+                    unresolved_writes.append(pc)
+                    continue
+                length = 3 if name == "store_bcd" else x + 1
+                for address in range(index, index + length):
+                    reads.setdefault(address, DATA)
+                if any(address in code_bytes for address in range(index, index + length)):
+                    self_modifying.append({"pc": pc, "start": index, "end": index + length})
+
+    data_regions = []
+    for address in range(PROGRAM_START, end):
+        if address in code_bytes:
+            continue
+        kind = reads.get(address, UNKNOWN)
+        region = data_regions[-1] if data_regions else None
+        if region and region["end"] == address and region["kind"] == kind:
+            region["end"] += 1
+        else:
+            data_regions.append({"start": address, "end": address + 1, "kind": kind})
+
+    return {
+        "entry": entry,
+        "end": end,
+        "code": sorted(code),
+        "blocks": [blocks[start] for start in sorted(blocks)],
+        "functions": functions,
+        "loops": loops,
+        "data": data_regions,
+        "self_modifying": self_modifying,
+        "unresolved_writes": unresolved_writes,
+        "outside": sorted(outside),
+    }
+
+
+class Disassembler:
+    """
+    Analyses roms and keeps the results in a JSON cache keyed by the rom's sha1, so a rom is
+    only analysed again when its contents change. Call save() to write new results out.
+    """
+    def __init__(self, cache_file=DEFAULT_CACHE):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file) as cache:
+                data = json.load(cache)
+            if data.get("version") == CACHE_VERSION:
+                self.entries = data["entries"]
+
+    def save(self):
+        if self.changed:
+            with open(self.cache_file, "w") as cache:
+                json.dump({"version": CACHE_VERSION, "entries": self.entries}, cache, separators=(",", ":"))
+            self.changed = False
+
+    def analyze(self, data):
+        sha1 = hashlib.sha1(data).hexdigest()
+        analysis = self.entries.get(sha1)
+        if analysis is None:
+            analysis = analyze(data)
+            self.entries[sha1] = analysis
+            self.changed = True
+        return analysis
+
+    def analyze_file(self, rom_file):
+        with open(rom_file, "rb") as rom:
+            return self.analyze(rom.read())
+
+
+def listing(data, analysis):
+    """ The rom as assembly, one instruction or run of data bytes per line, with labels and notes. """
+    vip_hires = is_vip_hires(data)
+    labels = {block["start"]: f"loc_{block['start']:03x}" for block in analysis["blocks"]}
+    labels.update({function["entry"]: f"sub_{function['entry']:03x}" for function in analysis["functions"]})
+    labels[analysis["entry"]] = "start"
+    loop_targets = {target for _, target in analysis["loops"]}
+    notes = {write["pc"]: f"writes code at {write['start']:#05x}-{write['end'] - 1:#05x}"
+             for write in analysis["self_modifying"]}
+    notes.update({pc: "writes through an unknown I" for pc in analysis["unresolved_writes"]})
+
+    items = [(pc, None) for pc in analysis["code"]] + [(region["start"], region) for region in analysis["data"]]
+    lines = []
+    for address, region in sorted(items, key=lambda item: item[0]):
+        if region is None:
+            if address in labels:
+                lines.append(f"{labels[address]}:" + ("  ; loop" if address in loop_targets else ""))
+            opcode = data[address - PROGRAM_START] << 8 | data[address - PROGRAM_START + 1]
+            line = f"  {address:#05x}  {opcode:04X}  {disassemble(opcode, vip_hires)}"
+            lines.append(line + (f"  ; {notes[address]}" if address in notes else ""))
+        elif region["kind"] == SPRITE:
+            for offset in range(region["start"], region["end"]):
+                value = data[offset - PROGRAM_START]
+                pixels = format(value, "08b").replace("0", ".").replace("1", "#")
+                lines.append(f"  {offset:#05x}  {value:02X}    DB {value:#04x}  ; {pixels}")
+        else:
+            for offset in range(region["start"], region["end"], 8):
+                values = data[offset - PROGRAM_START:min(offset + 8, region["end"]) - PROGRAM_START]
+                lines.append(f"  {offset:#05x}  {values.hex().upper():<16}  DB {', '.join(f'{v:#04x}' for v in values)}"
+                             + f"  ; {region['kind']}")
+    return "\n".join(lines)
+
+
+def call_graph(analysis):
+    """ The call graph and loops as text. """
+    lines = []
+    for function in analysis["functions"]:
+        blocks = set(function["blocks"])
+        loops = [f"{start:#05x}->{target:#05x}" for start, target in analysis["loops"] if start in blocks]
+        calls = ", ".join(f"sub_{callee:03x}" for callee in function["calls"]) or "-"
+        lines.append(f"sub_{function['entry']:03x}: {len(blocks)} blocks, calls {calls}"
+                     + (f", loops {' '.join(loops)}" if loops else ""))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Disassemble a rom and build its control flow graph.")
+    parser.add_argument("rom", nargs="?", help="Rom path, part of a rom name or a sha1 prefix.")
+    parser.add_argument("--graph", action="store_true", help="Print the call graph and loops instead of the listing.")
+    parser.add_argument("--all", action="store_true", help="Analyse every rom in the catalog and report the time taken.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    disassembler = Disassembler()
+    if args.all:
+        from catalog import Catalog
+
+        catalog = Catalog()
+        if not catalog.entries:
+            catalog.scan()
+        for entry in sorted(catalog.entries.values(), key=lambda entry: entry["path"]):
+            analysis = disassembler.analyze_file(os.path.join(catalog.root, entry["path"]))
+            if analysis["self_modifying"]:
+                print(f"self modifying: {entry['path']}")
+        disassembler.save()
+        print(f"{len(catalog.entries)} roms in {time.perf_counter() - start:.3f}s")
+        return 0
+    if not args.rom:
+        parser.error("a rom is required unless --all is given")
+
+    rom_file = args.rom
+    if not os.path.exists(rom_file):
+        from catalog import Catalog
+
+        rom_file = Catalog().resolve(rom_file)
+    with open(rom_file, "rb") as rom:
+        data = rom.read()
+    analysis = disassembler.analyze(data)
+    disassembler.save()
+    print(call_graph(analysis) if args.graph else listing(data, analysis))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from chip8 import Chip8, DISPLAY_WIDTH, DISPLAY_HEIGHT
+
+# Actions are a key to hold down (0x0-0xF), or NO_KEY to press nothing.
+NUM_KEYS = 16
+NO_KEY = NUM_KEYS
+NUM_ACTIONS = NUM_KEYS + 1
+
+# An observation is the display as one byte per pixel (0 or 1), row by row.
+OBSERVATION_SIZE = DISPLAY_WIDTH * DISPLAY_HEIGHT
+
+# Pixels for every possible byte of a display row, e.g. 0b10100000 -> b"\x01\x00\x01\x00\x00\x00\x00\x00".
+BYTE_PIXELS = [bytes((byte >> (7 - bit)) & 1 for bit in range(8)) for byte in range(256)]
+
+
+def display_error(chip):
+    """ Why the chip's display can't be observed, or None when it's 64x32. """
+    width, height = chip.display_width, chip.display_height
+    if (width, height) != (DISPLAY_WIDTH, DISPLAY_HEIGHT):
+        return f"Display is {width}x{height}, observations only cover {DISPLAY_WIDTH}x{DISPLAY_HEIGHT}."
+    return None
+
+
+def write_observation(chip, buffer):
+    """ Write the chip's display into buffer (anything supporting slice assignment of OBSERVATION_SIZE bytes). """
+    shifts = range(DISPLAY_WIDTH - 8, -1, -8)
+    buffer[:OBSERVATION_SIZE] = b"".join(BYTE_PIXELS[(row >> shift) & 0xFF] for row in chip.display for shift in shifts)
+
+
+class Chip8Env:
+    """
+    Headless environment for training agents on a rom.
+    Each step holds the action's key for frame_skip frames (60Hz timer ticks) and returns
+    (observation, reward, done, info). Repeating an action keeps its key down rather than pressing it again.
+    reward_fn(chip) and done_fn(chip) are called after every step. max_frames ends an episode regardless.
+    Observations only cover the 64x32 display, so a rom that switches to a hires mode ends its episode,
+    with the reason in info["error"] and the last 64x32 observation. So does an exception raised by the core.
+    A rom that starts on another display size raises ValueError when the env is created.
+    """
+    def __init__(self, rom_file, frame_skip=4, reward_fn=None, done_fn=None, max_frames=None, seed=None, **chip_args):
+        self.rom_file = rom_file
+        self.frame_skip = frame_skip
+        self.reward_fn = reward_fn
+        self.done_fn = done_fn
+        self.max_frames = max_frames
+        self.seed = seed
+        self.chip_args = chip_args
+        self.observation = bytearray(OBSERVATION_SIZE)
+        self.chip = None
+        self.frames = 0
+        self.action = NO_KEY
+        # A rom that doesn't start on the 64x32 display (VIP hires) can't be observed at all.
+        error = display_error(Chip8(rom_file, **chip_args))
+        if error:
+            raise ValueError(f"{rom_file}: {error}")
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.seed = seed
+        self.chip = Chip8(self.rom_file, seed=self.seed, **self.chip_args)
+        self.frames = 0
+        self.action = NO_KEY
+        write_observation(self.chip, self.observation)
+        return self.observation
+
+    def step(self, action):
+        assert 0 <= action < NUM_ACTIONS, f"Action must be between 0 and {NUM_ACTIONS - 1}."
+        chip = self.chip
+        if action != self.action:
+            if self.action != NO_KEY:
+                chip.release_key(self.action)
+            if action != NO_KEY:
+                chip.press_key(action)
+            self.action = action
+        try:
+            for _ in range(self.frame_skip):
+                chip.run(until_tick=True)
+                self.frames += 1
+        except Exception as exception:
+            # A fault in the rom (e.g. returning with an empty stack) ends the episode, not the caller.
+            error = f"Crashed at {chip.pc:#05x}: {exception!r}"
+        else:
+            error = display_error(chip)
+
+        info = {"frames": self.frames, "cycles": chip.cycles}
+        if error:
+            info["error"] = error
+            return self.observation, 0.0, True, info
+        write_observation(chip, self.observation)
+        reward = self.reward_fn(chip) if self.reward_fn else 0.0
+        done = bool(self.done_fn and self.done_fn(chip))
+        if self.max_frames is not None and self.frames >= self.max_frames:
+            done = True
+        return self.observation, reward, done, info
+
+
+def worker_loop(connection, start, stop, observations, rewards, dones, actions, env_args):
+    """
+    Runs environments start..stop in a worker process. Observations, rewards and done flags are written straight
+    into the shared arrays, so only tiny command messages go through the pipe.
+    """
+    env_args = dict(env_args)
+    seed = env_args.pop("seed", None)
+    envs = [Chip8Env(seed=None if seed is None else seed + n, **env_args) for n in range(start, stop)]
+    view = memoryview(observations).cast("B")
+    while True:
+        command = connection.recv()
+        if command == "reset":
+            for offset, env in enumerate(envs, start):
+                view[offset * OBSERVATION_SIZE:(offset + 1) * OBSERVATION_SIZE] = env.reset()
+                rewards[offset] = 0.0
+                dones[offset] = False
+        elif command == "step":
+            for offset, env in enumerate(envs, start):
+                observation, reward, done, _ = env.step(actions[offset])
+                # Finished environments start over straight away. Their done flag tells the caller it happened.
+                if done:
+                    observation = env.reset()
+                view[offset * OBSERVATION_SIZE:(offset + 1) * OBSERVATION_SIZE] = observation
+                rewards[offset] = reward
+                dones[offset] = done
+        elif command == "close":
+            connection.close()
+            return
+        connection.send(True)
+
+
+class VectorEnv:
+    """
+    count copies of Chip8Env spread over a pool of worker processes.
+    observations is a shared buffer of count * OBSERVATION_SIZE bytes (e.g. numpy.frombuffer(env.observations,
+    dtype=numpy.uint8).reshape(count, DISPLAY_HEIGHT, DISPLAY_WIDTH)); rewards and dones are shared arrays.
+    Environment n is seeded with seed + n when a seed is given.
+    """
+    def __init__(self, rom_file, count, workers=None, **env_args):
+        workers = min(workers or multiprocessing.cpu_count(), count)
+        env_args["rom_file"] = rom_file
+        # Raises ValueError for a rom that can't be observed here, before a worker could fail on it.
+        Chip8Env(**env_args)
+        self.count = count
+        self.observations = RawArray("B", count * OBSERVATION_SIZE)
+        self.rewards = RawArray("d", count)
+        self.dones = RawArray("b", count)
+        self.actions = RawArray("b", count)
+
+        self.connections = []
+        self.processes = []
+        for worker in range(workers):
+            start = worker * count // workers
+            stop = (worker + 1) * count // workers
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=worker_loop,
+                args=(child, start, stop, self.observations, self.rewards, self.dones, self.actions, env_args),
+                daemon=True,
+            )
+            process.start()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def command(self, command):
+        for connection in self.connections:
+            connection.send(command)
+        for connection in self.connections:
+            connection.recv()
+
+    def reset(self):
+        self.command("reset")
+        return self.observations
+
+    def step(self, actions):
+        """ Step every environment with its action. Returns the shared (observations, rewards, dones) arrays. """
+        self.actions[:] = list(actions)
+        self.command("step")
+        return self.observations, self.rewards, self.dones
+
+    def observation(self, n):
+        return bytes(self.observations[n * OBSERVATION_SIZE:(n + 1) * OBSERVATION_SIZE])
+
+    def close(self):
+        for connection in self.connections:
+            connection.send("close")
+        for process in self.processes:
+            process.join()
@@ -0,0 +1,354 @@
+import argparse
+import glob
+import hashlib
+import io
+import multiprocessing
+import os
+import random
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from batch import classify
+from chip8 import Chip8, DEFAULT_CPU_HZ
+from inputlog import read_log, write_log
+
+# Coverage is one bit per (pc, opcode class) pair: pc << KIND_BITS | handler kind.
+KIND_BITS = 6
+MAP_BYTES = (4096 << KIND_BITS) // 8
+
+DEFAULT_CYCLES = 20000
+DEFAULT_OUTPUT = "fuzz-out"
+# Mutations of one corpus entry run per task sent to a worker.
+TASK_ITERATIONS = 50
+# Key events kept per input.
+MAX_EVENTS = 64
+SEED = 0
+# Seconds between progress lines.
+STATUS_SECONDS = 5
+
+# Values that tend to hit edge cases: zero, sign and nibble boundaries, and the 00E0/00EE opcode bytes.
+INTERESTING_BYTES = (0x00, 0x01, 0x0F, 0x10, 0x7F, 0x80, 0xE0, 0xEE, 0xFE, 0xFF)
+
+# Set in every worker process by init_worker.
+coverage_map = None
+
+
+def build_kinds():
+    """ The handler kind of every opcode, and the opcodes of every kind, from Chip8's dispatch table. """
+    table = Chip8.build_dispatch_table()
+    names = sorted({handler.__name__ for handler in table})
+    assert len(names) <= 1 << KIND_BITS, "Too many handlers for the coverage map."
+    kind_of = {name: kind for kind, name in enumerate(names)}
+    kinds = bytes(kind_of[handler.__name__] for handler in table)
+    opcodes = [[] for _ in names]
+    for opcode, kind in enumerate(kinds):
+        opcodes[kind].append(opcode)
+    return names, kinds, opcodes
+
+
+KIND_NAMES, KINDS, OPCODES_BY_KIND = build_kinds()
+
+
+class Case:
+    """ One fuzzer input: a rom, key events as (cycle, key, pressed), and the seed rom it was mutated from. """
+    __slots__ = ("rom", "events", "base", "rounds")
+
+    def __init__(self, rom, events=(), base=None):
+        self.rom = bytes(rom)
+        self.events = tuple(sorted(events))
+        self.base = self.rom if base is None else base
+        # Times this case was picked for mutation.
+        self.rounds = 0
+
+    def name(self):
+        data = self.rom + repr(self.events).encode()
+        return hashlib.sha1(data).hexdigest()[:16]
+
+
+def execute(case, cycles):
+    """
+    Run a case for up to cycles instructions. Returns the coverage indexes it reached, and None or
+    (status, handler name, error, cycle) if it crashed.
+    """
+    chip = Chip8(case.rom, seed=SEED)
+    chip.tracer.stream = io.StringIO()
+    for cycle, key, pressed in case.events:
+        chip.queue_key_event(key, pressed, cycle)
+    covered = set()
+    memory = chip.memory
+    step = chip.step
+    try:
+        for _ in range(cycles):
+            pc = chip.pc
+            covered.add(pc << KIND_BITS | KINDS[memory[pc] << 8 | memory[pc + 1]])
+            step()
+    except Exception as error:
+        pc = chip.pc
+        name = KIND_NAMES[KINDS[memory[pc] << 8 | memory[pc + 1]]] if pc + 1 < len(memory) else "fetch"
+        return covered, (classify(chip, error), name, repr(error), chip.cycles)
+    return covered, None
+
+
+def mutate_rom(rom, rng):
+    rom = bytearray(rom)
+    for _ in range(rng.choice((1, 1, 2, 4))):
+        position = rng.randrange(len(rom))
+        mutation = rng.randrange(5)
+        if mutation == 0:
+            rom[position] ^= 1 << rng.randrange(8)
+        elif mutation == 1:
+            rom[position] = rng.randrange(256)
+        elif mutation == 2:
+            rom[position] = rng.choice(INTERESTING_BYTES)
+        elif mutation == 3 and len(rom) > 1:
+            # An instruction of a random kind, so rare handlers come up as often as common ones.
+            position &= ~1
+            opcode = rng.choice(rng.choice(OPCODES_BY_KIND))
+            rom[position:position + 2] = opcode.to_bytes(2, "big")[:len(rom) - position]
+        else:
+            # Copy a few bytes from elsewhere in the rom, keeping its length.
+            source = rng.randrange(len(rom))
+            chunk = rom[source:source + rng.randint(2, 8)][:len(rom) - position]
+            rom[position:position + len(chunk)] = chunk
+    return bytes(rom)
+
+
+def mutate_events(events, rng, cycles):
+    events = list(events)
+    mutation = rng.randrange(4)
+    if mutation == 0 or not events:
+        if len(events) < MAX_EVENTS:
+            events.append((rng.randrange(cycles), rng.randrange(16), rng.random() < 0.5))
+    elif mutation == 1:
+        events.pop(rng.randrange(len(events)))
+    elif mutation == 2:
+        n = rng.randrange(len(events))
+        cycle, _, pressed = events[n]
+        events[n] = (cycle, rng.randrange(16), pressed)
+    else:
+        n = rng.randrange(len(events))
+        _, key, pressed = events[n]
+        events[n] = (rng.randrange(cycles), key, pressed)
+    return events
+
+
+def mutate(case, rng, cycles):
+    rom, events = case.rom, case.events
+    mutation = rng.randrange(3)
+    if mutation != 1:
+        rom = mutate_rom(rom, rng)
+    if mutation != 0:
+        events = mutate_events(events, rng, cycles)
+    return Case(rom, events, case.base)
+
+
+def init_worker(shared_map):
+    global coverage_map
+    coverage_map = shared_map
+
+
+def add_coverage(covered):
+    """ Set the bits for covered in the shared map and return how many were new. Racy, but at worst a case is kept twice. """
+    new = 0
+    for index in covered:
+        byte, bit = index >> 3, 1 << (index & 7)
+        if not coverage_map[byte] & bit:
+            coverage_map[byte] |= bit
+            new += 1
+    return new
+
+
+def fuzz_task(case, cycles, iterations, rng_seed):
+    """ Mutate case iterations times. Returns the mutants that found new coverage, the crashes, and executions run. """
+    rng = random.Random(rng_seed)
+    found = []
+    crashes = []
+    for _ in range(iterations):
+        mutant = mutate(case, rng, cycles)
+        covered, crash = execute(mutant, cycles)
+        new = add_coverage(covered)
+        if crash:
+            crashes.append((mutant, crash))
+        elif new:
+            found.append(mutant)
+    return found, crashes, iterations
+
+
+def seed_task(case, cycles):
+    covered, crash = execute(case, cycles)
+    add_coverage(covered)
+    return crash
+
+
+def signature(crash):
+    status, name, _, _ = crash
+    return status, name
+
+
+def minimize(case, crash):
+    """
+    Shrink a crashing case while it still crashes the same way: drop the events that don't matter,
+    and put back every mutated rom byte that isn't needed. Returns the smaller case and its crash.
+    """
+    wanted = signature(crash)
+    cycles = crash[3] + 1
+
+    def crashes(candidate):
+        _, result = execute(candidate, cycles)
+        return result is not None and signature(result) == wanted
+
+    events = [event for event in case.events if event[0] <= crash[3]]
+    for n in reversed(range(len(events))):
+        candidate = events[:n] + events[n + 1:]
+        if crashes(Case(case.rom, candidate, case.base)):
+            events = candidate
+
+    # Revert mutated bytes in shrinking chunks, then one at a time.
+    rom = bytearray(case.rom)
+    base = case.base
+    changed = [n for n in range(len(rom)) if n >= len(base) or rom[n] != base[n]]
+    size = max(len(changed) // 2, 1)
+    while changed:
+        kept = []
+        for start in range(0, len(changed), size):
+            chunk = changed[start:start + size]
+            candidate = bytearray(rom)
+            for n in chunk:
+                if n < len(base):
+                    candidate[n] = base[n]
+            if crashes(Case(candidate, events, base)):
+                rom = candidate
+            else:
+                kept += chunk
+        changed = kept
+        if size == 1:
+            break
+        size //= 2
+
+    smaller = Case(rom, events, base)
+    _, result = execute(smaller, cycles)
+    return smaller, result
+
+
+def save_case(case, directory, name, cycles=None):
+    """ Save a case as name.ch8 and an input log, name.log, that inputlog.py can replay. """
+    os.makedirs(directory, exist_ok=True)
+    rom_file = os.path.join(directory, name + ".ch8")
+    with open(rom_file, "wb") as rom:
+        rom.write(case.rom)
+    write_log(os.path.join(directory, name + ".log"), rom_file, SEED, DEFAULT_CPU_HZ, case.events, cycles)
+
+
+def load_corpus(directory):
+    cases = []
+    for rom_file in sorted(glob.glob(os.path.join(directory, "*.ch8"))):
+        with open(rom_file, "rb") as rom:
+            data = rom.read()
+        log_file = rom_file[:-len(".ch8")] + ".log"
+        events = read_log(log_file)["events"] if os.path.exists(log_file) else ()
+        cases.append(Case(data, events))
+    return cases
+
+
+def count_bits(shared_map):
+    return bin(int.from_bytes(bytes(shared_map), "little")).count("1")
+
+
+class Fuzzer:
+    """
+    Runs fuzz_task over a process pool. The coverage map lives in shared memory, so every worker sees
+    the bits the others found. The corpus and the crashes are kept by this process, which picks the
+    next entry to mutate, saves new corpus entries and sends new kinds of crash off to be minimized.
+    """
+    def __init__(self, seeds, output=DEFAULT_OUTPUT, cycles=DEFAULT_CYCLES, jobs=None, seed=SEED):
+        self.output = output
+        self.cycles = cycles
+        self.jobs = jobs or os.cpu_count()
+        self.rng = random.Random(seed)
+        self.coverage_map = multiprocessing.Array("B", MAP_BYTES, lock=False)
+        self.corpus = list(seeds) + load_corpus(os.path.join(output, "corpus"))
+        self.signatures = {}
+        self.executions = 0
+
+    def pick(self):
+        """ The least fuzzed of a few random corpus entries. """
+        candidates = [self.rng.choice(self.corpus) for _ in range(4)]
+        case = min(candidates, key=lambda candidate: candidate.rounds)
+        case.rounds += 1
+        return case
+
+    def add_crash(self, pool, pending, case, crash):
+        key = signature(crash)
+        if key in self.signatures:
+            self.signatures[key] += 1
+            return
+        self.signatures[key] = 1
+        print(f"crash: {key[0]} in {key[1]}: {crash[2]} at cycle {crash[3]}")
+        pending[pool.submit(minimize, case, crash)] = ("minimize", case)
+
+    def save_crash(self, case, crash):
+        status, name, error, cycle = crash
+        # The end line runs the crashing instruction, so replaying the log raises the same error.
+        save_case(case, os.path.join(self.output, "crashes"), f"{status}-{name}-{case.name()[:8]}", cycle + 1)
+        print(f"saved minimized crash: {status} in {name}, {len(case.events)} key events, {error}")
+
+    def run(self, seconds):
+        start = time.perf_counter()
+        last_status = start
+        with ProcessPoolExecutor(self.jobs, initializer=init_worker, initargs=(self.coverage_map,)) as pool:
+            # Tasks in flight, mapped to their kind and the case they were given.
+            pending = {pool.submit(seed_task, case, self.cycles): ("seed", case) for case in self.corpus}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, case = pending.pop(future)
+                    if kind == "minimize":
+                        self.save_crash(*future.result())
+                    elif kind == "seed":
+                        crash = future.result()
+                        if crash:
+                            self.add_crash(pool, pending, case, crash)
+                    else:
+                        found, crashes, executions = future.result()
+                        self.executions += executions
+                        for case in found:
+                            self.corpus.append(case)
+                            save_case(case, os.path.join(self.output, "corpus"), case.name())
+                        for case, crash in crashes:
+                            self.add_crash(pool, pending, case, crash)
+
+                now = time.perf_counter()
+                running = now - start < seconds
+                # Keep two tasks per worker queued so none sits idle while results are handled.
+                while running and sum(1 for kind, _ in pending.values() if kind == "fuzz") < self.jobs * 2:
+                    case = self.pick()
+                    task = pool.submit(fuzz_task, case, self.cycles, TASK_ITERATIONS, self.rng.randrange(1 << 32))
+                    pending[task] = ("fuzz", case)
+                if now - last_status >= STATUS_SECONDS or not pending:
+                    last_status = now
+                    print(f"{now - start:6.1f}s  {self.executions:,} execs ({self.executions / (now - start):,.0f}/s)"
+                          f"  corpus {len(self.corpus)}  coverage {count_bits(self.coverage_map)}"
+                          f"  crashes {sum(self.signatures.values())} ({len(self.signatures)} unique)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Coverage guided fuzzing of the Chip8 core with mutated roms and key input.")
+    parser.add_argument("roms", nargs="*", help="Seed roms. Defaults to roms/*.ch8.")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--cycles", type=int, default=DEFAULT_CYCLES, help="Instructions each input runs for.")
+    parser.add_argument("--jobs", type=int, help="Worker processes. Defaults to one per core.")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="Directory for the corpus and the crashes.")
+    parser.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args()
+
+    seeds = []
+    for rom_file in args.roms or sorted(glob.glob("roms/*.ch8")):
+        with open(rom_file, "rb") as rom:
+            seeds.append(Case(rom.read()))
+    fuzzer = Fuzzer(seeds, output=args.output, cycles=args.cycles, jobs=args.jobs, seed=args.seed)
+    fuzzer.run(args.seconds)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+import time
+
+# Taken before anything else is imported so startup_time includes importing the core.
+IMPORT_START = time.perf_counter()
+
+import sys
+from chip8 import Chip8, TIMER_HZ
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_START
+
+# Characters used by render for pixels that are on and off.
+ON_CHAR = "#"
+OFF_CHAR = "."
+
+
+def run_rom(rom_file, cycles=None, frames=None, seed=None, keys=(), input_log=None, wav=None, **chip_args):
+    """
+    Run a rom with no frontend and return the Chip8.
+    Stops after cycles instructions or frames 60Hz frames, whichever comes first. keys are held down throughout.
+    input_log is an optional path to write an input log of the run to, see inputlog.py.
+    wav is an optional path to write the buzzer audio to.
+    """
+    chip = Chip8(rom_file, seed=seed, **chip_args)
+    writer = None
+    if input_log:
+        from inputlog import InputLogWriter
+
+        writer = InputLogWriter(input_log, chip, rom_file)
+    buzzer = None
+    if wav:
+        from audio import record_wav
+
+        buzzer = record_wav(chip, wav)
+    for key in keys:
+        chip.press_key(key)
+    if frames is None:
+        chip.run(cycles=cycles)
+    else:
+        for _ in range(frames):
+            budget = None if cycles is None else cycles - chip.cycles
+            if budget is not None and budget <= 0:
+                break
+            chip.run(cycles=budget, until_tick=True)
+    if writer:
+        writer.close()
+    if buzzer:
+        buzzer.close()
+    return chip
+
+
+def render(chip):
+    """ The display as text, one line per row. """
+    width = chip.display_width
+    return "\n".join(
+        "".join(ON_CHAR if row >> (width - 1 - col) & 1 else OFF_CHAR for col in range(width))
+        for row in chip.display
+    )
+
+
+def startup_time(rom_file):
+    """ Seconds it takes to import the core, create a Chip8 for the rom and execute its first instruction. """
+    start = time.perf_counter()
+    chip = Chip8(rom_file)
+    chip.step()
+    return IMPORT_SECONDS + time.perf_counter() - start
+
+
+def main():
+    # argparse pulls in re and enum, which would double the import time of this module for library users.
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a rom without a window.")
+    parser.add_argument("rom")
+    parser.add_argument("--cycles", type=int, help="Stop after this many instructions.")
+    parser.add_argument("--frames", type=int, help=f"Stop after this many {TIMER_HZ}Hz frames.")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--key", type=lambda key: int(key, 16), action="append", default=[],
+                        help="Hex key to hold down. Can be repeated.")
+    parser.add_argument("--show", action="store_true", help="Print the display when done.")
+    parser.add_argument("--startup", action="store_true",
+                        help="Print the time from import to the first executed instruction and exit.")
+    parser.add_argument("--window", action="store_true", help="Open the rom in the pyxel frontend instead.")
+    parser.add_argument("--log", help="Write an input log of the run to this file. Replay it with inputlog.py.")
+    parser.add_argument("--wav", help="Write the buzzer audio to this WAV file.")
+    args = parser.parse_args()
+
+    if args.startup:
+        print(f"{startup_time(args.rom) * 1000:.2f} ms")
+        return 0
+    if args.window:
+        from main import App
+
+        App(args.rom, seed=args.seed, input_log=args.log)
+        return 0
+    if args.cycles is None and args.frames is None:
+        parser.error("one of --cycles or --frames is required")
+
+    chip = run_rom(args.rom, cycles=args.cycles, frames=args.frames, seed=args.seed, keys=args.key, input_log=args.log,
+                   wav=args.wav)
+    print(f"cycles={chip.cycles} ticks={chip.ticks} pc={chip.pc:#05x}")
+    if args.show:
+        print(render(chip))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
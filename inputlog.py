@@ -0,0 +1,173 @@
+import argparse
+import hashlib
+import os
+import sys
+import time
+from chip8 import Chip8
+from savestate import state_hash
+
+# Input log layout (text, one item per line):
+#   chip8-input-log <version>
+#   rom <sha1> <path>                                   (a relative path is from the current directory, or from
+#                                                        the log's directory, which is how write_log stores it)
+#   seed <seed>
+#   cpu_hz <cpu_hz>
+#   <cycle> <key in hex> <1 for press, 0 for release>   (one line per key event, in cycle order)
+#   end <cycles> <state hash>                           (missing if the run didn't finish cleanly, - for the hash
+#                                                        when it isn't known, e.g. for a run that crashes)
+# A key event applies on the cycle it's logged with, after any timer tick due on that cycle.
+MAGIC = "chip8-input-log"
+VERSION = 1
+ENGINES = ("step", "run", "block")
+
+
+def rom_sha1(rom_file):
+    with open(rom_file, "rb") as rom:
+        return hashlib.sha1(rom.read()).hexdigest()
+
+
+def header(rom_file, seed, cpu_hz, rom_path=None):
+    """ rom_path is the rom's path as written to the log, rom_file by default. """
+    rom_path = rom_path or rom_file
+    return f"{MAGIC} {VERSION}\nrom {rom_sha1(rom_file)} {rom_path}\nseed {seed}\ncpu_hz {cpu_hz}\n"
+
+
+def write_log(path, rom_file, seed, cpu_hz, events, cycles=None, state=None):
+    """
+    Write a whole log for a run that wasn't recorded live, e.g. one made up by the fuzzer.
+    events are (cycle, key, pressed). cycles adds an end line, with state as its hash if given.
+    The rom is stored relative to the log, so the two can be replayed from anywhere as long as they stay together.
+    """
+    rom_path = os.path.relpath(rom_file, os.path.dirname(os.path.abspath(path)))
+    with open(path, "w") as log_file:
+        log_file.write(header(rom_file, seed, cpu_hz, rom_path))
+        for cycle, key, pressed in sorted(events):
+            log_file.write(f"{cycle} {key:X} {int(pressed)}\n")
+        if cycles is not None:
+            log_file.write(f"end {cycles} {state or '-'}\n")
+
+
+class InputLogWriter:
+    """
+    Logs a chip's key events from its first cycle on, keyed by the cycle they apply on.
+    Like Profiler, it swaps a wrapper in for that chip's apply_key_event only, so events queued for a later
+    cycle are logged when they happen, in cycle order. Lines are flushed as they're written, so the log
+    survives the emulator being killed. close() adds the end line with the final cycle count and state hash
+    that replay checks against.
+    """
+    def __init__(self, path, chip, rom_file):
+        assert chip.cycles == 0, "Logging has to start before the first instruction."
+        assert not chip.wall_clock, "Runs timed by the wall clock can't be replayed."
+        self.chip = chip
+        self.file = open(path, "w")
+        self.file.write(header(rom_file, chip.seed, chip.cpu_hz))
+        self.file.flush()
+        self.inner_apply_key_event = chip.apply_key_event
+        chip.apply_key_event = self.logged_apply_key_event
+
+    def logged_apply_key_event(self, key, pressed):
+        self.inner_apply_key_event(key, pressed)
+        self.file.write(f"{self.chip.cycles} {key:X} {int(pressed)}\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.write(f"end {self.chip.cycles} {state_hash(self.chip)}\n")
+        self.file.close()
+        self.chip.__dict__.pop("apply_key_event", None)
+
+
+def read_log(path):
+    """ A log as a dict of rom, sha1, seed, cpu_hz, events [(cycle, key, pressed)], cycles and hash. """
+    log = {"events": [], "cycles": None, "hash": None}
+    with open(path) as log_file:
+        header = log_file.readline().split()
+        if header != [MAGIC, str(VERSION)]:
+            raise ValueError(f"{path} is not an input log, or one from a different version.")
+        for line in log_file:
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0] == "rom":
+                # Rom paths can contain spaces.
+                log["sha1"], log["rom"] = line.split(None, 2)[1:]
+                log["rom"] = log["rom"].rstrip("\n")
+            elif fields[0] in ("seed", "cpu_hz"):
+                log[fields[0]] = int(fields[1])
+            elif fields[0] == "end":
+                log["cycles"] = int(fields[1])
+                log["hash"] = None if fields[2] == "-" else fields[2]
+            else:
+                log["events"].append((int(fields[0]), int(fields[1], 16), fields[2] == "1"))
+    return log
+
+
+def find_rom(log, log_path=None):
+    """
+    The logged rom's path if it's still there and unchanged, otherwise the catalog rom with the same sha1.
+    A relative path is looked for from the current directory, then from the directory of the log at log_path.
+    """
+    candidates = [log["rom"]]
+    if log_path and not os.path.isabs(log["rom"]):
+        candidates.append(os.path.join(os.path.dirname(log_path), log["rom"]))
+    for rom_file in candidates:
+        if os.path.exists(rom_file) and rom_sha1(rom_file) == log["sha1"]:
+            return rom_file
+    from catalog import Catalog
+
+    return Catalog().resolve(log["sha1"])
+
+
+def replay(path, rom_file=None, engine="run"):
+    """
+    Run a logged session again as fast as possible.
+    engine is "step" (one Chip8.step per instruction), "run" (Chip8.run) or "block" (translator.BlockEngine),
+    so optimized engines can be checked against the reference. A log without an end line runs to its last event.
+    Returns the chip and whether its final state matches the log's hash (None when the log has no hash).
+    """
+    assert engine in ENGINES, f"Engine must be one of {ENGINES}."
+    log = read_log(path)
+    rom_file = rom_file or find_rom(log, path)
+    if rom_sha1(rom_file) != log["sha1"]:
+        raise ValueError(f"{rom_file} is not the rom this log was made with.")
+    chip = Chip8(rom_file, seed=log["seed"], cpu_hz=log["cpu_hz"])
+    for cycle, key, pressed in log["events"]:
+        chip.queue_key_event(key, pressed, cycle)
+
+    cycles = log["cycles"]
+    if cycles is None:
+        cycles = log["events"][-1][0] if log["events"] else 0
+    if engine == "step":
+        for _ in range(cycles):
+            chip.step()
+    elif engine == "block":
+        from translator import BlockEngine
+
+        BlockEngine(chip).run(cycles)
+    else:
+        chip.run(cycles=cycles)
+    return chip, None if log["hash"] is None else state_hash(chip) == log["hash"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an input log and check the final state.")
+    parser.add_argument("log")
+    parser.add_argument("--rom", help="Rom to use instead of the one named in the log.")
+    parser.add_argument("--engine", choices=ENGINES, default="run")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    chip, matches = replay(args.log, rom_file=args.rom, engine=args.engine)
+    elapsed = time.perf_counter() - start
+    print(f"cycles={chip.cycles} ticks={chip.ticks} in {elapsed:.3f}s")
+    print(f"state {state_hash(chip)}")
+    if matches is None:
+        print("The log has no state hash to check against.")
+        return 0
+    print("Matches the log." if matches else "DOES NOT match the log.")
+    return 0 if matches else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,29 @@
-import pyxel
-from chip8 import Chip8
-
-# Pyxel has minimum screen height of 64. Chip-8 display is 32, so draw it in the middle.
-Y_OFFSET = 16
+from chip8 import Chip8, DISPLAY_WIDTH, HIRES_WIDTH, HIRES_HEIGHT, TIMER_HZ
+
+# Pyxel has minimum screen height of 64. Lower displays (the normal 64x32 one) are drawn in the middle.
+MIN_SCREEN_HEIGHT = 64
+# Width of the window in real pixels, whatever the screen size in Chip 8 pixels.
+WINDOW_WIDTH = 640
+
+# Pyxel colors used for pixels that are on and off, and for the border around the display.
+ON_COLOR = 7
+OFF_COLOR = 0
+BORDER_COLOR = 6
+
+# The buzzer is a looped square wave in pyxel sound 0, played on channel 0 while the sound timer is non-zero.
+BUZZER_SOUND = 0
+BUZZER_CHANNEL = 0
+BUZZER_NOTE = "a2"
+
+# Pyxel image data for every possible byte of a display row, by scale, e.g. at scale 1 0b10100000 -> "70700000".
+# SUPER-CHIP roms get a 128x64 screen, where their 64x32 mode is drawn at scale 2.
+BYTE_COLORS = {
+    scale: [
+        "".join((str(ON_COLOR) if byte & (0x80 >> bit) else str(OFF_COLOR)) * scale for bit in range(8))
+        for byte in range(256)
+    ]
+    for scale in (1, 2)
+}
 
 # The Chip 8 has a hex keyboard, so we need to translate the left hand side of a modern keyboard to the right keys.
 # ╔═══╦═══╦═══╦═══╗
@@ -14,21 +35,47 @@ Y_OFFSET = 16
 # ╠═══╬═══╬═══╬═══╣
 # ║ A ║ 0 ║ B ║ F ║
 # ╚═══╩═══╩═══╩═══╝
-KEY_MAP = {
-    pyxel.KEY_1: 1, pyxel.KEY_2: 2, pyxel.KEY_3: 3, pyxel.KEY_4: 0xC,
-    pyxel.KEY_Q: 4, pyxel.KEY_W: 5, pyxel.KEY_E: 6, pyxel.KEY_R: 0xD,
-    pyxel.KEY_A: 7, pyxel.KEY_S: 8, pyxel.KEY_D: 9, pyxel.KEY_F: 0xE,
-    pyxel.KEY_Z: 0xA, pyxel.KEY_X: 0, pyxel.KEY_C: 0xB, pyxel.KEY_V: 0xF,
+KEY_LAYOUT = {
+    "KEY_1": 1, "KEY_2": 2, "KEY_3": 3, "KEY_4": 0xC,
+    "KEY_Q": 4, "KEY_W": 5, "KEY_E": 6, "KEY_R": 0xD,
+    "KEY_A": 7, "KEY_S": 8, "KEY_D": 9, "KEY_F": 0xE,
+    "KEY_Z": 0xA, "KEY_X": 0, "KEY_C": 0xB, "KEY_V": 0xF,
 }
 
+# pyxel is only imported once a window is opened, so tools can import this module without a GUI stack.
+pyxel = None
+
+
+def load_pyxel():
+    """ Import pyxel and return the map of pyxel key -> Chip 8 key. """
+    global pyxel
+    import pyxel
+
+    return {getattr(pyxel, name): chip8_key for name, chip8_key in KEY_LAYOUT.items()}
+
+
 class App:
-    def __init__(self, rom_file):
-        self.chip = Chip8(rom_file)
+    def __init__(self, rom_file, seed=None, input_log=None):
+        self.chip = Chip8(rom_file, seed=seed)
+        if input_log:
+            import atexit
+            from inputlog import InputLogWriter
+
+            # pyxel exits the process when the window is closed, so the log is finished from an exit handler.
+            atexit.register(InputLogWriter(input_log, self.chip, rom_file).close)
         self.paused = False
         self.manual_step_mode = False
         self.should_step = False
-
-        pyxel.init(64, 64, fps=100, scale=10)
+        self.key_map = load_pyxel()
+        self.width, self.height = screen_size(rom_file, self.chip)
+
+        # One frame per 60Hz timer tick. Each frame runs the instructions that fit in one tick.
+        pyxel.init(self.width, self.height, fps=TIMER_HZ, scale=WINDOW_WIDTH // self.width)
+        # The display is kept in image bank 0. Only changed rows are rewritten, then it's blitted once per frame.
+        self.screen = pyxel.image(0)
+        # The tone is set up once and only started or stopped when the buzzer changes, never every frame.
+        pyxel.sound(BUZZER_SOUND).set(BUZZER_NOTE, "s", "5", "n", 30)
+        self.buzzing = False
         pyxel.run(self.update, self.draw)
 
     def update(self):
@@ -49,36 +96,80 @@ class App:
         else:
             self.should_step = False
 
+        # Only key state changes are passed on. They're applied even while paused so no key gets stuck down.
+        for key_in, chip8_key in self.key_map.items():
+            if pyxel.btnp(key_in):
+                self.chip.press_key(chip8_key)
+            elif pyxel.btnr(key_in):
+                self.chip.release_key(chip8_key)
+
         if not self.paused and (self.should_step or not self.manual_step_mode):
-            for key_in, chip8_key in KEY_MAP.items():
-                if pyxel.btnr(key_in):
-                    self.chip.set_key(chip8_key)
-            self.chip.step()
+            if self.manual_step_mode:
+                self.chip.step()
+            else:
+                self.chip.run(until_tick=True)
+        self.update_buzzer()
+
+    def update_buzzer(self):
+        buzzing = self.chip.sound_timer > 0 and not self.paused
+        if buzzing != self.buzzing:
+            if buzzing:
+                pyxel.play(BUZZER_CHANNEL, BUZZER_SOUND, loop=True)
+            else:
+                pyxel.stop(BUZZER_CHANNEL)
+            self.buzzing = buzzing
 
     def draw(self):
-        if self.chip.should_draw:
-            pyxel.cls(6)
-            for y, row in enumerate(self.chip.video_memory):
-                for x, col in enumerate(row):
-                    if col:
-                        pyxel.pix(x, y+Y_OFFSET, 7)
-                    else:
-                        pyxel.pix(x, y+Y_OFFSET, 0)
+        chip = self.chip
+        # The display fills the width of the screen, and is centered vertically.
+        scale = self.width // chip.display_width
+        width = chip.display_width * scale
+        height = chip.display_height * scale
+        dirty = chip.take_dirty_rows()
+        if dirty:
+            display = chip.display
+            for y in range(chip.display_height):
+                if dirty >> y & 1:
+                    self.screen.set(0, y * scale, [row_to_colors(display[y], chip.display_width, scale)] * scale)
+
+        pyxel.cls(BORDER_COLOR)
+        pyxel.blt(0, (self.height - height) // 2, 0, 0, 0, width, height)
+
+
+def screen_size(rom_file, chip):
+    """ The pyxel screen size for a rom, big enough for every display size the rom can switch to. """
+    from catalog import SUPERCHIP, detect_variant
+
+    with open(rom_file, "rb") as rom:
+        if detect_variant(rom.read()) == SUPERCHIP:
+            return HIRES_WIDTH, HIRES_HEIGHT
+    return chip.display_width, max(chip.display_height, MIN_SCREEN_HEIGHT)
+
+
+def row_to_colors(row, width=DISPLAY_WIDTH, scale=1):
+    """ Convert a display row into a line of pyxel image data. """
+    byte_colors = BYTE_COLORS[scale]
+    return "".join(byte_colors[(row >> shift) & 0xFF] for shift in range(width - 8, -1, -8))
 
 
 def get_rom_filename(default=None):
     """
     Get a rom filename using the following priority:
-    1. Default passed to this function.
-    2. Filename passed as command line arg
+    1. Rom passed as command line arg. Either a path, or a name or sha1 prefix looked up in the rom catalog.
+    2. Default passed to this function.
     3. Display a file picker window for user input
     """
+    import os
     import sys
 
-    if default:
+    if len(sys.argv) > 1:
+        if os.path.exists(sys.argv[1]):
+            return sys.argv[1]
+        from catalog import Catalog
+
+        return Catalog().resolve(sys.argv[1])
+    elif default:
         return default
-    elif len(sys.argv) > 1:
-        return sys.argv[1]
     else:
         from tkinter import Tk
         from tkinter.filedialog import askopenfilename
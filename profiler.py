@@ -0,0 +1,128 @@
+import argparse
+import json
+import time
+from collections import Counter, defaultdict
+from chip8 import Chip8
+
+# Name of the bottom stack frame, for code that isn't inside any subroutine.
+ROOT_FRAME = "main"
+
+
+class Profiler:
+    """
+    Counts executions and time per handler, per rom address and per call stack.
+    start() wraps profiled_step around the chip's step for that instance only, so a chip that isn't
+    being profiled pays nothing. Subroutines are tracked through 2NNN/00EE, so time spent in a
+    subroutine is attributed to it and every subroutine that called it.
+    """
+    def __init__(self, chip):
+        self.chip = chip
+        self.table = Chip8.build_dispatch_table(chip.vip_hires)
+        self.handler_counts = Counter()
+        self.handler_time = defaultdict(float)
+        self.pc_counts = Counter()
+        self.pc_time = defaultdict(float)
+        # (frame, frame, ..., handler) -> seconds
+        self.stack_time = defaultdict(float)
+        self.stack = (ROOT_FRAME,)
+        self.inner_step = None
+
+    def start(self):
+        # A step wrapper, so profiling works together with tracing turned on or off at any point.
+        self.chip.wrap_step(self.wrap)
+
+    def stop(self):
+        self.chip.unwrap_step(self.wrap)
+
+    def wrap(self, inner_step):
+        self.inner_step = inner_step
+        return self.profiled_step
+
+    def profiled_step(self):
+        chip = self.chip
+        pc = chip.pc
+        opcode = chip.memory[pc] << 8 | chip.memory[pc + 1]
+        name = self.table[opcode].__name__
+
+        start = time.perf_counter()
+        self.inner_step()
+        elapsed = time.perf_counter() - start
+
+        self.handler_counts[name] += 1
+        self.handler_time[name] += elapsed
+        self.pc_counts[pc] += 1
+        self.pc_time[pc] += elapsed
+        self.stack_time[self.stack + (name,)] += elapsed
+
+        if name == "call_subroutine":
+            self.stack += (f"sub_{opcode & 0x0FFF:#05x}",)
+        elif name == "return_from_subroutine" and len(self.stack) > 1:
+            self.stack = self.stack[:-1]
+
+    def report(self, limit=15):
+        """ Text summary of the hottest handlers and addresses. """
+        total = sum(self.handler_time.values()) or 1
+        lines = [f"{'handler':<32}{'count':>12}{'seconds':>12}{'%':>8}"]
+        for name, seconds in sorted(self.handler_time.items(), key=lambda item: -item[1])[:limit]:
+            lines.append(f"{name:<32}{self.handler_counts[name]:>12,}{seconds:>12.4f}{100 * seconds / total:>8.1f}")
+        lines.append("")
+        lines.append(f"{'address':<32}{'count':>12}{'seconds':>12}{'%':>8}")
+        for pc, seconds in sorted(self.pc_time.items(), key=lambda item: -item[1])[:limit]:
+            lines.append(f"{pc:<#32x}{self.pc_counts[pc]:>12,}{seconds:>12.4f}{100 * seconds / total:>8.1f}")
+        return "\n".join(lines)
+
+    def collapsed_stacks(self):
+        """ Brendan Gregg's collapsed stack format (for flamegraph.pl and friends), weighted in microseconds. """
+        return "\n".join(
+            f"{';'.join(frames)} {round(seconds * 1e6)}"
+            for frames, seconds in sorted(self.stack_time.items())
+        ) + "\n"
+
+    def speedscope(self, name="chip8"):
+        """ The profile as a speedscope (https://www.speedscope.app) sampled profile. """
+        frame_index = {}
+        samples = []
+        weights = []
+        for frames, seconds in self.stack_time.items():
+            samples.append([frame_index.setdefault(frame, len(frame_index)) for frame in frames])
+            weights.append(round(seconds * 1e9))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": [{"name": frame} for frame in frame_index]},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "nanoseconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile a rom headlessly.")
+    parser.add_argument("rom")
+    parser.add_argument("--cycles", type=int, default=100000)
+    parser.add_argument("--collapsed", help="Write collapsed stacks to this file.")
+    parser.add_argument("--speedscope", help="Write a speedscope profile to this file.")
+    args = parser.parse_args()
+
+    chip = Chip8(args.rom)
+    profiler = Profiler(chip)
+    profiler.start()
+    chip.run(cycles=args.cycles)
+    profiler.stop()
+
+    print(profiler.report())
+    if args.collapsed:
+        with open(args.collapsed, "w") as collapsed_file:
+            collapsed_file.write(profiler.collapsed_stacks())
+    if args.speedscope:
+        with open(args.speedscope, "w") as speedscope_file:
+            json.dump(profiler.speedscope(args.rom), speedscope_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+import argparse
+import os
+import struct
+import zlib
+from catalog import SUPERCHIP, detect_variant
+from chip8 import Chip8, DISPLAY_WIDTH, DISPLAY_HEIGHT, HIRES_WIDTH, HIRES_HEIGHT, TIMER_HZ
+
+# Recording layout (little endian):
+#   header: magic, version, width, height, frames per second
+#   records until the end of the file, each one image of the display:
+#     number of frames the image is shown for, bit mask of the rows that differ from the previous image,
+#     then for every bit set in the mask, top row first, the row XOR the previous row as width / 8 bytes
+#     (most significant byte first)
+# A display that doesn't change only adds to the frame count of the current record, and a change
+# only stores the rows it touched, so long runs take a few bytes per changed frame.
+MAGIC = b"C8RC"
+VERSION = 1
+HEADER = struct.Struct("<4sHHHH")
+RECORD = struct.Struct("<HQ")
+MAX_REPEAT = 0xFFFF
+
+# GIF frame delays are in hundredths of a second, and most viewers slow down any delay under 2, so
+# recordings are resampled to 50 frames per second when exported as a GIF.
+GIF_FPS = 50
+GIF_PALETTE = b"\x00\x00\x00\xff\xff\xff" # off, on
+# Smallest code size GIF allows, enough for the 2 color palette.
+LZW_MIN_CODE_SIZE = 2
+LZW_MAX_CODES = 4096
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Every byte with each bit doubled, e.g. 0b10100000 -> 0b1100110000000000.
+DOUBLED_BYTES = [sum(3 << 2 * bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+def set_bits(mask):
+    """ Indexes of the bits set in mask, lowest first. """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class Recorder:
+    """ Writes displays to a recording, one call to add_frame per 60Hz frame. """
+    def __init__(self, path, width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, fps=TIMER_HZ):
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, width, height, fps))
+        self.row_bytes = width // 8
+        self.all_rows = (1 << height) - 1
+        self.previous = [0] * height
+        # The latest image isn't written until it changes, since its frame count isn't known before then.
+        self.pending = None
+        self.repeat = 0
+        self.frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def add_frame(self, display, dirty_rows=None):
+        """
+        Add the current display as the next frame.
+        dirty_rows is an optional mask of the rows that may have changed (e.g. from take_dirty_rows), so
+        rows that can't have changed aren't compared.
+        """
+        self.frames += 1
+        mask = 0
+        rows = []
+        previous = self.previous
+        for y in set_bits(self.all_rows if dirty_rows is None else dirty_rows):
+            changed = display[y] ^ previous[y]
+            if changed:
+                mask |= 1 << y
+                rows.append(changed.to_bytes(self.row_bytes, "big"))
+                previous[y] = display[y]
+        if not mask and self.pending is not None and self.repeat < MAX_REPEAT:
+            self.repeat += 1
+            return
+        self.flush()
+        self.pending = (mask, b"".join(rows))
+        self.repeat = 1
+
+    def flush(self):
+        if self.pending is not None:
+            mask, rows = self.pending
+            self.file.write(RECORD.pack(self.repeat, mask) + rows)
+            self.pending = None
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class Recording:
+    """ Reads a recording back one image at a time. """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as recording_file:
+            magic, version, self.width, self.height, self.fps = HEADER.unpack(recording_file.read(HEADER.size))
+        assert magic == MAGIC, f"{path} is not a recording."
+        assert version == VERSION, f"Unsupported recording version {version}."
+        self.row_bytes = self.width // 8
+
+    def images(self):
+        """ Yield (display, frames) for every record: the display as a tuple of rows and how many frames it's shown. """
+        display = [0] * self.height
+        with open(self.path, "rb") as recording_file:
+            recording_file.seek(HEADER.size)
+            while True:
+                record = recording_file.read(RECORD.size)
+                if not record:
+                    return
+                frames, mask = RECORD.unpack(record)
+                for y in set_bits(mask):
+                    display[y] ^= int.from_bytes(recording_file.read(self.row_bytes), "big")
+                yield tuple(display), frames
+
+    def resampled(self, fps):
+        """ Same as images, but with frame counts at a different frame rate. Images shown for less than a frame are dropped. """
+        start = 0
+        last = None
+        last_count = 0
+        for display, frames in self.images():
+            end = start + frames
+            # Output frame k shows the image that is up at recording frame k * self.fps / fps.
+            count = -(-end * fps // self.fps) - -(-start * fps // self.fps)
+            start = end
+            if not count:
+                continue
+            if display == last:
+                last_count += count
+                continue
+            if last is not None:
+                yield last, last_count
+            last = display
+            last_count = count
+        if last is not None:
+            yield last, last_count
+
+
+def scaled_lines(width, scale, pixel_values):
+    """ Function turning a row into its bytes scaled up by scale, with one byte per pixel in pixel_values. """
+    byte_pixels = [
+        b"".join(pixel_values[byte >> (7 - bit) & 1] * scale for bit in range(8))
+        for byte in range(256)
+    ]
+    row_bytes = width // 8
+    cache = {}
+
+    def scaled_line(row):
+        line = cache.get(row)
+        if line is None:
+            line = cache[row] = b"".join(byte_pixels[byte] for byte in row.to_bytes(row_bytes, "big"))
+        return line
+    return scaled_line
+
+
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def png_encoder(width, height, scale):
+    """ Function turning a display into the bytes of a black and white PNG, scale pixels per Chip 8 pixel. """
+    header = png_chunk(b"IHDR", struct.pack(">IIBBBBB", width * scale, height * scale, 1, 0, 0, 0, 0))
+    end = png_chunk(b"IEND", b"")
+    # A 1 bit PNG row is the row's own bits, so scaling up builds bytes of 0/1 bits and packs them again.
+    bits = scaled_lines(width, scale, (b"0", b"1"))
+
+    def encode(display):
+        lines = []
+        for row in display:
+            scaled = bits(row)
+            line = b"\x00" + int(scaled, 2).to_bytes(len(scaled) // 8, "big")
+            lines.append(line * scale)
+        return PNG_SIGNATURE + header + png_chunk(b"IDAT", zlib.compress(b"".join(lines))) + end
+    return encode
+
+
+def export_png(recording, directory, scale=4, fps=None):
+    """ Write every frame as directory/frame_NNNNNN.png. Returns the number of files written. """
+    os.makedirs(directory, exist_ok=True)
+    encode = png_encoder(recording.width, recording.height, scale)
+    images = recording.images() if fps is None else recording.resampled(fps)
+    count = 0
+    for display, frames in images:
+        png = encode(display)
+        for _ in range(frames):
+            with open(os.path.join(directory, f"frame_{count:06d}.png"), "wb") as png_file:
+                png_file.write(png)
+            count += 1
+    return count
+
+
+def lzw_encode(pixels):
+    """ GIF flavoured LZW of a bytes of palette indexes, split into data sub-blocks. """
+    clear_code = 1 << LZW_MIN_CODE_SIZE
+    end_code = clear_code + 1
+    next_code = end_code + 1
+    code_size = LZW_MIN_CODE_SIZE + 1
+    # Strings are keyed by (code of the string without its last pixel) << 8 | last pixel.
+    table = {}
+    out = bytearray()
+    bits = clear_code
+    bit_count = code_size
+
+    prefix = pixels[0]
+    for pixel in pixels[1:]:
+        key = prefix << 8 | pixel
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        bits |= prefix << bit_count
+        bit_count += code_size
+        if next_code < LZW_MAX_CODES:
+            table[key] = next_code
+            if next_code == 1 << code_size:
+                code_size += 1
+            next_code += 1
+        else:
+            bits |= clear_code << bit_count
+            bit_count += code_size
+            table.clear()
+            next_code = end_code + 1
+            code_size = LZW_MIN_CODE_SIZE + 1
+        while bit_count >= 8:
+            out.append(bits & 0xFF)
+            bits >>= 8
+            bit_count -= 8
+        prefix = pixel
+    for code in (prefix, end_code):
+        bits |= code << bit_count
+        bit_count += code_size
+    while bit_count > 0:
+        out.append(bits & 0xFF)
+        bits >>= 8
+        bit_count -= 8
+
+    blocks = [bytes((LZW_MIN_CODE_SIZE,))]
+    for offset in range(0, len(out), 255):
+        block = out[offset:offset + 255]
+        blocks.append(bytes((len(block),)) + block)
+    blocks.append(b"\x00")
+    return b"".join(blocks)
+
+
+def export_gif(recording, path, scale=4, fps=GIF_FPS):
+    """
+    Write the recording as a looping animated GIF. Each GIF frame only covers the rows that changed
+    since the one before, drawn over it. Returns the number of GIF frames written.
+    """
+    width = recording.width * scale
+    line = scaled_lines(recording.width, scale, (b"\x00", b"\x01"))
+    previous = None
+    count = 0
+    time = 0
+    with open(path, "wb") as gif:
+        gif.write(b"GIF89a" + struct.pack("<HHBBB", width, recording.height * scale, 0x80, 0, 0) + GIF_PALETTE)
+        gif.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+        for display, frames in recording.resampled(fps):
+            changed = [y for y in range(recording.height) if previous is None or display[y] != previous[y]] or [0]
+            top, bottom = changed[0], changed[-1] + 1
+            # Delays are rounded on the running total so they don't drift.
+            delay = round((time + frames) * 100 / fps) - round(time * 100 / fps)
+            time += frames
+            pixels = b"".join(line(row) * scale for row in display[top:bottom])
+            gif.write(b"\x21\xf9\x04\x04" + struct.pack("<H", min(delay, 0xFFFF)) + b"\x00\x00")
+            gif.write(b"\x2c" + struct.pack("<HHHHB", 0, top * scale, width, (bottom - top) * scale, 0))
+            gif.write(lzw_encode(pixels))
+            previous = display
+            count += 1
+        gif.write(b"\x3b")
+    return count
+
+
+def double_display(display, width):
+    """ A display at twice the size, each pixel becoming 2x2. """
+    rows = []
+    for row in display:
+        doubled = 0
+        for shift in range(width - 8, -1, -8):
+            doubled = doubled << 16 | DOUBLED_BYTES[row >> shift & 0xFF]
+        rows += (doubled, doubled)
+    return rows
+
+
+def record(rom_file, path, frames, seed=None, keys=(), wav=None, **chip_args):
+    """
+    Run a rom headlessly for a number of 60Hz frames, recording the display after each one. Returns the Chip8.
+    SUPER-CHIP roms are recorded at 128x64, with their 64x32 mode at double size. Raises ValueError if the display
+    switches to a size the recording can't hold, after writing out the frames before the switch.
+    wav is an optional path for the buzzer audio, which covers the same frames.
+    """
+    chip = Chip8(rom_file, seed=seed, **chip_args)
+    for key in keys:
+        chip.press_key(key)
+    buzzer = None
+    if wav:
+        from audio import record_wav
+
+        buzzer = record_wav(chip, wav)
+    with open(rom_file, "rb") as rom:
+        if detect_variant(rom.read()) == SUPERCHIP:
+            width, height = HIRES_WIDTH, HIRES_HEIGHT
+        else:
+            width, height = chip.display_width, chip.display_height
+    try:
+        with Recorder(path, width, height) as recorder:
+            for frame in range(frames):
+                chip.run(until_tick=True)
+                dirty_rows = chip.take_dirty_rows()
+                if (chip.display_width, chip.display_height) == (width, height):
+                    recorder.add_frame(chip.display, dirty_rows)
+                elif (chip.display_width * 2, chip.display_height * 2) == (width, height):
+                    recorder.add_frame(double_display(chip.display, chip.display_width))
+                else:
+                    # A switch the variant detection missed, e.g. 00FF reached through BNNN. The recording's size
+                    # is fixed by its header, so it ends here and keeps the frames before the switch.
+                    raise ValueError(
+                        f"Display switched to {chip.display_width}x{chip.display_height} after {frame} frames,"
+                        f" the recording is {width}x{height}."
+                    )
+    finally:
+        if buzzer:
+            buzzer.close()
+    return chip
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record roms headlessly and export recordings.")
+    commands = parser.add_subparsers(dest="command")
+    record_parser = commands.add_parser("record", help="Record a rom.")
+    record_parser.add_argument("rom")
+    record_parser.add_argument("output", help="Recording file to write.")
+    record_parser.add_argument("--frames", type=int, default=600, help=f"Number of {TIMER_HZ}Hz frames to record.")
+    record_parser.add_argument("--seed", type=int)
+    record_parser.add_argument("--key", type=lambda key: int(key, 16), action="append", default=[],
+                               help="Hex key to hold down. Can be repeated.")
+    record_parser.add_argument("--wav", nargs="?", const=True,
+                               help="Also write the buzzer audio, to this file or next to the recording as .wav.")
+    export_parser = commands.add_parser("export", help="Export a recording as an animated GIF or PNG frames.")
+    export_parser.add_argument("recording")
+    export_parser.add_argument("output", help="A .gif file, or a directory for PNG frames.")
+    export_parser.add_argument("--scale", type=int, default=4)
+    export_parser.add_argument("--fps", type=int, help="Resample PNG frames to this frame rate.")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        wav = os.path.splitext(args.output)[0] + ".wav" if args.wav is True else args.wav
+        try:
+            record(args.rom, args.output, args.frames, seed=args.seed, keys=args.key, wav=wav)
+        except ValueError as error:
+            parser.error(str(error))
+        print(f"Wrote {os.path.getsize(args.output)} bytes to {args.output}")
+        if wav:
+            print(f"Wrote {os.path.getsize(wav)} bytes to {wav}")
+    elif args.command == "export":
+        recording = Recording(args.recording)
+        if args.output.endswith(".gif"):
+            count = export_gif(recording, args.output, scale=args.scale)
+            print(f"Wrote {count} GIF frames to {args.output}")
+        else:
+            count = export_png(recording, args.output, scale=args.scale, fps=args.fps)
+            print(f"Wrote {count} PNG files to {args.output}")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
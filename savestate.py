@@ -0,0 +1,243 @@
+import hashlib
+import struct
+import time
+from collections import deque
+from chip8 import DISPLAY_WIDTH, TIMER_HZ, WALL_CLOCK_POLL
+
+# Save state layout (little endian):
+#   magic, version
+#   core: pc, I, stack pointer, delay timer, sound timer, key bit mask, FX0A register (0xFF when not waiting),
+#         cpu_hz, cycles, ticks, V0-VF, stack, display width, display height
+#   memory: 4096 bytes
+#   display: display height rows of display width / 8 bytes, most significant byte first
+#   rng: the 625 words of the Mersenne Twister state, then a flag and value for the cached gauss value
+MAGIC = b"C8ST"
+VERSION = 3
+HEADER = struct.Struct("<4sH")
+CORE = struct.Struct("<HHBBBHBIQQ16s32sBB")
+RNG = struct.Struct("<625IBd")
+
+# Memory is compared and stored in pages of this many bytes when building rewind snapshots.
+PAGE_SIZE = 256
+# Rewind sizes are estimated with this many bytes per display row.
+ROW_BYTES = DISPLAY_WIDTH // 8
+
+
+def pack_core(chip):
+    keys = 0
+    for key, pressed in enumerate(chip.keys):
+        if pressed:
+            keys |= 1 << key
+    return CORE.pack(
+        chip.pc, chip.index, chip.stack_pointer, chip.delay_timer, chip.sound_timer, keys,
+        0xFF if chip.key_wait is None else chip.key_wait, chip.cpu_hz, chip.cycles, chip.ticks, bytes(chip.registers), chip.stack.tobytes(),
+        chip.display_width, chip.display_height,
+    )
+
+
+def pack_display(chip):
+    row_bytes = chip.display_width // 8
+    return b"".join(row.to_bytes(row_bytes, "big") for row in chip.display)
+
+
+def pack_rng(chip):
+    version, words, gauss = chip.rng.getstate()
+    return RNG.pack(*words, gauss is not None, gauss or 0.0)
+
+
+def save_state(chip):
+    """ Serialize the full machine state into bytes. """
+    return b"".join((
+        HEADER.pack(MAGIC, VERSION),
+        pack_core(chip),
+        bytes(chip.memory),
+        pack_display(chip),
+        pack_rng(chip),
+    ))
+
+
+def unpack_core(chip, data):
+    (chip.pc, chip.index, chip.stack_pointer, chip.delay_timer, chip.sound_timer, keys,
+     key_wait, chip.cpu_hz, chip.cycles, chip.ticks, registers, stack, width, height) = CORE.unpack(data)
+    chip.registers[:] = registers
+    chip.stack[:] = type(chip.stack)(chip.stack.typecode, stack)
+    chip.keys[:] = [bool(keys >> key & 1) for key in range(16)]
+    chip.key_wait = None if key_wait == 0xFF else key_wait
+    # The display contents are restored separately.
+    chip.display_width = width
+    chip.display_height = height
+    chip.all_rows = (1 << height) - 1
+    if chip.wall_clock:
+        chip.next_tick_cycle = chip.cycles + WALL_CLOCK_POLL
+    else:
+        chip.next_tick_cycle = chip.tick_cycle(chip.ticks + 1)
+    # Queued key events are input rather than machine state, so they're kept.
+    chip.schedule_events()
+
+
+def unpack_display(chip, data):
+    row_bytes = chip.display_width // 8
+    chip.display[:] = [
+        int.from_bytes(data[offset:offset + row_bytes], "big")
+        for offset in range(0, len(data), row_bytes)
+    ]
+    chip.dirty_rows = chip.all_rows
+
+
+def unpack_rng(chip, data):
+    values = RNG.unpack(data)
+    gauss = values[626] if values[625] else None
+    chip.rng.setstate((3, tuple(values[:625]), gauss))
+
+
+def load_state(chip, data):
+    """
+    Restore a state produced by save_state. Memory, registers, stack and display are updated in place.
+    Any code cache built from the old memory (e.g. translator.BlockEngine) must be flushed by the caller.
+    """
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a Chip8 save state, or one from a different version.")
+
+    offset = HEADER.size
+    core = data[offset:offset + CORE.size]
+    unpack_core(chip, core)
+    offset += CORE.size
+    sections = []
+    for size in (len(chip.memory), chip.display_height * chip.display_width // 8, RNG.size):
+        sections.append(data[offset:offset + size])
+        offset += size
+    memory, display, rng = sections
+
+    chip.memory[:] = memory
+    unpack_display(chip, display)
+    unpack_rng(chip, rng)
+
+
+def state_hash(chip):
+    """ SHA-256 of the chip's save state. Two machines with the same hash are in exactly the same state. """
+    return hashlib.sha256(save_state(chip)).hexdigest()
+
+
+def changed_pages(data, base):
+    """ The (offset, bytes) pages of data that differ from base. """
+    return [
+        (start, bytes(data[start:start + PAGE_SIZE]))
+        for start in range(0, len(data), PAGE_SIZE)
+        if data[start:start + PAGE_SIZE] != base[start:start + PAGE_SIZE]
+    ]
+
+
+def apply_pages(target, base, pages):
+    target[:] = base
+    for start, page in pages:
+        target[start:start + len(page)] = page
+
+
+class Snapshot:
+    """
+    One entry in the rewind buffer.
+    A keyframe holds complete copies of memory, display and rng state. Other snapshots keep only the memory
+    and rng pages and the display rows that differ from their keyframe.
+    The small core section (registers, pc, timers...) is always stored in full.
+    """
+    __slots__ = ("keyframe", "core", "memory", "rows", "rng")
+
+    def __init__(self, keyframe, core, memory, rows, rng):
+        self.keyframe = keyframe
+        self.core = core
+        self.memory = memory
+        self.rows = rows
+        self.rng = rng
+
+    def size(self):
+        """ Approximate number of bytes of state held by this snapshot. """
+        if self.keyframe is None:
+            return len(self.core) + len(self.memory) + len(self.rows) * ROW_BYTES + len(self.rng)
+        pages = sum(len(page) for _, page in self.memory) + sum(len(page) for _, page in self.rng)
+        return len(self.core) + pages + len(self.rows) * ROW_BYTES
+
+
+class Rewind:
+    """
+    A bounded history of machine states for rewinding.
+    Call capture() once per frame. Every keyframe_interval captures a keyframe is stored, in between
+    only the differences against the last keyframe, so a few seconds of history stay small.
+    """
+    def __init__(self, chip, seconds=5, captures_per_second=TIMER_HZ, keyframe_interval=60):
+        self.chip = chip
+        self.keyframe_interval = keyframe_interval
+        self.snapshots = deque(maxlen=seconds * captures_per_second)
+        self.keyframe = None
+        self.since_keyframe = 0
+        self.restore_times = deque(maxlen=100)
+
+    def capture(self):
+        chip = self.chip
+        core = pack_core(chip)
+        rng = pack_rng(chip)
+        keyframe = self.keyframe
+        # Switching display size starts a new keyframe, since rows can only be compared at the same size.
+        if (keyframe is None or self.since_keyframe >= self.keyframe_interval
+                or len(chip.display) != len(keyframe.rows)):
+            snapshot = Snapshot(None, core, bytes(chip.memory), tuple(chip.display), rng)
+            self.keyframe = snapshot
+            self.since_keyframe = 0
+        else:
+            rows = tuple((y, row) for y, row in enumerate(chip.display) if row != keyframe.rows[y])
+            memory = changed_pages(chip.memory, keyframe.memory)
+            snapshot = Snapshot(keyframe, core, memory, rows, changed_pages(rng, keyframe.rng))
+        self.snapshots.append(snapshot)
+        self.since_keyframe += 1
+        return snapshot
+
+    def rewind(self, captures=1):
+        """
+        Go back the given number of captures (1 restores the most recent one) and drop the newer history.
+        Returns the seconds spent restoring, which is also kept in restore_times.
+        """
+        if not self.snapshots:
+            raise IndexError("Nothing to rewind to.")
+        captures = min(captures, len(self.snapshots))
+        for _ in range(captures - 1):
+            self.snapshots.pop()
+        snapshot = self.snapshots[-1]
+
+        start = time.perf_counter()
+        self.restore(snapshot)
+        elapsed = time.perf_counter() - start
+        self.restore_times.append(elapsed)
+
+        # The current keyframe may be newer than this point in history, so start a new one on the next capture.
+        self.keyframe = None
+        return elapsed
+
+    def restore(self, snapshot):
+        chip = self.chip
+        unpack_core(chip, snapshot.core)
+        if snapshot.keyframe is None:
+            chip.memory[:] = snapshot.memory
+            chip.display[:] = snapshot.rows
+            unpack_rng(chip, snapshot.rng)
+        else:
+            keyframe = snapshot.keyframe
+            apply_pages(chip.memory, keyframe.memory, snapshot.memory)
+            chip.display[:] = keyframe.rows
+            for y, row in snapshot.rows:
+                chip.display[y] = row
+            rng = bytearray(len(keyframe.rng))
+            apply_pages(rng, keyframe.rng, snapshot.rng)
+            unpack_rng(chip, bytes(rng))
+        chip.dirty_rows = chip.all_rows
+
+    def stats(self):
+        """ Summary of the buffer's size and restore cost. """
+        keyframes = sum(1 for snapshot in self.snapshots if snapshot.keyframe is None)
+        restores = len(self.restore_times)
+        return {
+            "snapshots": len(self.snapshots),
+            "keyframes": keyframes,
+            "bytes": sum(snapshot.size() for snapshot in self.snapshots),
+            "average_restore_seconds": sum(self.restore_times) / restores if restores else None,
+            "max_restore_seconds": max(self.restore_times) if restores else None,
+        }
@@ -0,0 +1,353 @@
+import asyncio
+import json
+import struct
+import time
+from collections import deque
+from catalog import Catalog
+from chip8 import Chip8, DISPLAY_WIDTH, DISPLAY_HEIGHT, TIMER_HZ
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Every message is a type byte and a payload length, followed by the payload.
+HEADER = struct.Struct("<BI")
+MAX_PAYLOAD = 4096
+
+# Message types.
+OPEN = 1 # client: rom name, path or sha1 prefix (utf-8). Starts this connection's session.
+KEY = 2 # client: KEY_EVENT
+STATS = 3 # client: empty payload. server: JSON with the aggregate stats and the client's own session
+FRAME = 4 # server: FRAME_HEADER, then width / 8 bytes for every row set in the mask, top row first
+ERROR = 5 # server: utf-8 message. The connection is closed after it.
+
+KEY_EVENT = struct.Struct("<BB") # key, 1 for press or 0 for release
+# Frame number, bit mask of the rows included, display width and height. The size changes when a
+# SUPER-CHIP rom switches modes, and every row is sent then.
+FRAME_HEADER = struct.Struct("<IQBB")
+
+# The scheduler goes back to the event loop to handle network I/O at least this often while running sessions.
+SLICE_SECONDS = 0.002
+# Frames aren't written to a client with more than this many bytes still unsent. Its changed rows are
+# remembered and sent together once it catches up, so a slow client never builds up a backlog.
+MAX_WRITE_BUFFER = 64 * 1024
+# Instructions per second are measured over windows of this many seconds.
+STATS_SECONDS = 1.0
+# Number of scheduler rounds kept for the round time statistics.
+ROUND_HISTORY = 600
+
+
+def encode(kind, payload=b""):
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+async def read_message(reader, max_payload=MAX_PAYLOAD):
+    kind, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if max_payload is not None and length > max_payload:
+        raise ValueError(f"Message of {length} bytes is too large.")
+    return kind, await reader.readexactly(length)
+
+
+def frame_payload(frame, rows, chip):
+    row_bytes = chip.display_width // 8
+    parts = [FRAME_HEADER.pack(frame, rows, chip.display_width, chip.display_height)]
+    display = chip.display
+    for y in range(chip.display_height):
+        if rows >> y & 1:
+            parts.append(display[y].to_bytes(row_bytes, "big"))
+    return b"".join(parts)
+
+
+def apply_frame(display, payload):
+    """
+    Update a list of display rows from a FRAME payload and return (frame number, width).
+    The list is resized when the display size changed.
+    """
+    frame, rows, width, height = FRAME_HEADER.unpack_from(payload)
+    if len(display) != height:
+        display[:] = [0] * height
+    row_bytes = width // 8
+    offset = FRAME_HEADER.size
+    for y in range(height):
+        if rows >> y & 1:
+            display[y] = int.from_bytes(payload[offset:offset + row_bytes], "big")
+            offset += row_bytes
+    return frame, width
+
+
+class Session:
+    """ One client's Chip8. Runs a frame at a time and streams the rows that changed. """
+    def __init__(self, session_id, chip, writer):
+        self.id = session_id
+        self.chip = chip
+        self.writer = writer
+        self.frames = 0
+        self.frames_sent = 0
+        # Rows changed since the last frame that was sent.
+        self.pending_rows = 0
+        self.window_start = time.perf_counter()
+        self.window_cycles = 0
+        self.instructions_per_second = 0.0
+        self.closed = False
+
+    def run_frame(self):
+        self.chip.run(until_tick=True)
+        self.frames += 1
+        self.pending_rows |= self.chip.take_dirty_rows()
+        if self.pending_rows and self.writer.transport.get_write_buffer_size() <= MAX_WRITE_BUFFER:
+            self.writer.write(encode(FRAME, frame_payload(self.frames, self.pending_rows, self.chip)))
+            self.pending_rows = 0
+            self.frames_sent += 1
+
+    def update_rate(self, now):
+        self.instructions_per_second = (self.chip.cycles - self.window_cycles) / (now - self.window_start)
+        self.window_start = now
+        self.window_cycles = self.chip.cycles
+
+    def stats(self):
+        return {
+            "id": self.id,
+            "frames": self.frames,
+            "frames_sent": self.frames_sent,
+            "cycles": self.chip.cycles,
+            "instructions_per_second": self.instructions_per_second,
+        }
+
+
+class Server:
+    """
+    Hosts one Chip8 session per TCP connection.
+    A single scheduler task gives every session one frame (one 60Hz tick of instructions) per round, starting
+    each round at a different session so none is always served last. Rounds are paced at TIMER_HZ. When there
+    are more sessions than fit in a frame's time, every session slows down by the same amount instead of
+    rounds piling up, and the scheduler still yields every SLICE_SECONDS so key events are handled promptly.
+    The rom catalog is brought up to date once at startup. Clients can only look roms up in it, never rescan it.
+    """
+    def __init__(self, catalog=None, **chip_args):
+        self.catalog = catalog or Catalog()
+        self.catalog.scan()
+        self.chip_args = chip_args
+        self.sessions = {}
+        self.next_id = 1
+        self.rounds = 0
+        self.round_times = deque(maxlen=ROUND_HISTORY)
+        self.server = None
+        self.scheduler = None
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        self.scheduler = asyncio.ensure_future(self.schedule())
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.scheduler.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        for session in list(self.sessions.values()):
+            session.writer.close()
+
+    async def handle_connection(self, reader, writer):
+        session = None
+        try:
+            while True:
+                kind, payload = await read_message(reader)
+                if kind == OPEN and session is None:
+                    session = self.open_session(payload.decode(), writer)
+                elif kind == KEY and session is not None:
+                    key, pressed = KEY_EVENT.unpack(payload)
+                    if pressed:
+                        session.chip.press_key(key)
+                    else:
+                        session.chip.release_key(key)
+                elif kind == STATS:
+                    writer.write(encode(STATS, json.dumps(self.stats(session)).encode()))
+                else:
+                    raise ValueError(f"Unexpected message type {kind}.")
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, LookupError, AssertionError, struct.error) as error:
+            writer.write(encode(ERROR, str(error).encode()))
+        finally:
+            if session is not None:
+                session.closed = True
+                self.sessions.pop(session.id, None)
+            writer.close()
+
+    def open_session(self, rom, writer):
+        rom_file = self.catalog.resolve(rom, rescan=False)
+        session = Session(self.next_id, Chip8(rom_file, **self.chip_args), writer)
+        self.next_id += 1
+        self.sessions[session.id] = session
+        return session
+
+    async def schedule(self):
+        loop = asyncio.get_running_loop()
+        next_round = loop.time()
+        window_start = time.perf_counter()
+        while True:
+            start = time.perf_counter()
+            sessions = list(self.sessions.values())
+            if sessions:
+                first = self.rounds % len(sessions)
+                sessions = sessions[first:] + sessions[:first]
+            slice_start = start
+            for session in sessions:
+                if session.closed:
+                    continue
+                try:
+                    session.run_frame()
+                except Exception as error:
+                    session.writer.write(encode(ERROR, f"Emulation stopped: {error!r}".encode()))
+                    session.writer.close()
+                    session.closed = True
+                    self.sessions.pop(session.id, None)
+                if time.perf_counter() - slice_start > SLICE_SECONDS:
+                    await asyncio.sleep(0)
+                    slice_start = time.perf_counter()
+            now = time.perf_counter()
+            self.round_times.append(now - start)
+            self.rounds += 1
+
+            if now - window_start >= STATS_SECONDS:
+                for session in self.sessions.values():
+                    session.update_rate(now)
+                window_start = now
+
+            # A round that ran late starts the next one straight away, without trying to catch up.
+            next_round = max(next_round + 1 / TIMER_HZ, loop.time())
+            await asyncio.sleep(next_round - loop.time())
+
+    def stats(self, session=None):
+        """ Aggregate stats, plus those of one session if given or of every session otherwise. """
+        times = sorted(self.round_times)
+        stats = {
+            "sessions": len(self.sessions),
+            "rounds": self.rounds,
+            "instructions_per_second": sum(session.instructions_per_second for session in self.sessions.values()),
+            "round_seconds_median": times[len(times) // 2] if times else None,
+            "round_seconds_max": times[-1] if times else None,
+        }
+        if session is None:
+            stats["per_session"] = [session.stats() for session in self.sessions.values()]
+        else:
+            stats["session"] = session.stats()
+        return stats
+
+
+class Client:
+    """ Minimal client. Keeps a copy of the remote display up to date from FRAME messages. """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.display = [0] * DISPLAY_HEIGHT
+        self.display_width = DISPLAY_WIDTH
+        self.frame = 0
+
+    @classmethod
+    async def connect(cls, rom, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        reader, writer = await asyncio.open_connection(host, port)
+        client = cls(reader, writer)
+        writer.write(encode(OPEN, rom.encode()))
+        return client
+
+    def press_key(self, key):
+        self.writer.write(encode(KEY, KEY_EVENT.pack(key, 1)))
+
+    def release_key(self, key):
+        self.writer.write(encode(KEY, KEY_EVENT.pack(key, 0)))
+
+    async def receive(self):
+        """ Wait for the next message and return (type, payload). Frames are applied to display first. """
+        kind, payload = await read_message(self.reader, max_payload=None)
+        if kind == FRAME:
+            self.frame, self.display_width = apply_frame(self.display, payload)
+        elif kind == ERROR:
+            raise RuntimeError(payload.decode())
+        return kind, payload
+
+    async def stats(self):
+        self.writer.write(encode(STATS))
+        while True:
+            kind, payload = await self.receive()
+            if kind == STATS:
+                return json.loads(payload)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def load_test(rom, sessions, seconds, **chip_args):
+    """
+    Run a server and the given number of local clients for a while. Every second each client presses a
+    different key and asks for stats, and the time to the reply is taken as the server's input latency.
+    Returns the server's stats and the longest latency any client saw.
+    """
+    server = Server(**chip_args)
+    port = await server.start(port=0)
+    clients = [await Client.connect(rom, port=port) for _ in range(sessions)]
+    latencies = [0.0] * sessions
+
+    async def drive(n, client):
+        key = n % 16
+        # Spread the clients over the second rather than having them all send at once.
+        await asyncio.sleep(n / sessions)
+        while True:
+            await asyncio.sleep(1)
+            client.release_key(key)
+            key = (key + 1) % 16
+            client.press_key(key)
+            sent = time.perf_counter()
+            await client.stats()
+            latencies[n] = max(latencies[n], time.perf_counter() - sent)
+
+    tasks = [asyncio.ensure_future(drive(n, client)) for n, client in enumerate(clients)]
+    await asyncio.sleep(seconds)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    stats = server.stats()
+    for client in clients:
+        await client.close()
+    await server.stop()
+    return stats, max(latencies)
+
+
+async def run_server(host, port):
+    """ Run a server until the process is stopped. """
+    server = Server()
+    await server.start(host, port)
+    print(f"Listening on {host}:{port}")
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.stop()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve Chip8 sessions over TCP.")
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="Run the server.")
+    serve.add_argument("--host", default=DEFAULT_HOST)
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    load = commands.add_parser("load", help="Run a server with many local clients and report its throughput.")
+    load.add_argument("rom")
+    load.add_argument("--sessions", type=int, default=100)
+    load.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        asyncio.run(run_server(args.host, args.port))
+    elif args.command == "load":
+        stats, latency = asyncio.run(load_test(args.rom, args.sessions, args.seconds))
+        print(f"{stats['sessions']} sessions, {stats['rounds']} rounds in {args.seconds}s")
+        print(f"{stats['instructions_per_second']:,.0f} instructions/s in total")
+        print(f"round time: median {stats['round_seconds_median'] * 1000:.2f} ms, max {stats['round_seconds_max'] * 1000:.2f} ms")
+        print(f"slowest reply to a client: {latency * 1000:.1f} ms")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import sys
+from collections import deque
+
+# Trace levels. Each level records everything the previous one does.
+TRACE_OFF = 0
+TRACE_INSTRUCTIONS = 1 # pc and opcode of every executed instruction
+TRACE_REGISTERS = 2 # plus the registers (and I) each instruction changed
+
+# Number of records kept before the oldest ones are dropped.
+DEFAULT_BUFFER_SIZE = 4096
+
+# Register index used for I in register deltas.
+INDEX_REGISTER = 16
+
+
+class Tracer:
+    """
+    Keeps the most recent trace records in a bounded ring buffer.
+    Records are small tuples: (pc, opcode, deltas) for instructions and (None, None, text) for messages.
+    Formatting (including mnemonics) only happens when the buffer is dumped.
+    """
+    def __init__(self, level=TRACE_OFF, size=DEFAULT_BUFFER_SIZE, stream=None):
+        self.level = level
+        self.records = deque(maxlen=size)
+        self.stream = stream
+        # Set by Chip8.load_rom, so VIP hires roms get their own mnemonics.
+        self.vip_hires = False
+
+    def record(self, pc, opcode, deltas=()):
+        self.records.append((pc, opcode, deltas))
+
+    def write(self, text):
+        """ Output a message immediately, and keep it in the buffer when tracing is on. """
+        if self.level:
+            self.records.append((None, None, text))
+        stream = self.stream or sys.stdout
+        stream.write(text + "\n")
+
+    def format_record(self, record):
+        from chip8 import disassemble
+
+        pc, opcode, deltas = record
+        if pc is None:
+            return deltas
+        line = f"{pc:#05x}  {opcode:04X}  {disassemble(opcode, self.vip_hires):<20}"
+        for reg, value in deltas:
+            name = "I" if reg == INDEX_REGISTER else f"V{reg:X}"
+            line += f" {name}={value:#x}"
+        return line.rstrip()
+
+    def dump(self, stream=None, header=None):
+        """ Write out every record in the buffer, oldest first. """
+        stream = stream or self.stream or sys.stdout
+        if header:
+            stream.write(header + "\n")
+        for record in self.records:
+            stream.write(self.format_record(record) + "\n")
+        stream.flush()
+
+    def clear(self):
+        self.records.clear()
@@ -0,0 +1,235 @@
+from chip8 import Chip8
+
+# Longest run of instructions compiled into a single block.
+MAX_BLOCK_LENGTH = 64
+
+# Handlers that change control flow, draw, write memory, wait or start the buzzer. A block always ends after one of these.
+# FX18 reports a buzzer change on the event it makes due, so the clock has to be brought up to date straight after it.
+BLOCK_END_HANDLERS = {
+    "jump_to_constant",
+    "call_subroutine",
+    "return_from_subroutine",
+    "skip_if_equal",
+    "skip_if_not_equal",
+    "skip_if_reg_equal",
+    "skip_if_not_equal_registers",
+    "skip_if_pressed",
+    "skip_if_not_pressed",
+    "draw_sprite",
+    "draw_large_sprite",
+    "disp_clear",
+    "scroll_down",
+    "scroll_right",
+    "scroll_left",
+    "set_lores",
+    "set_hires",
+    "store_bcd",
+    "mem_dump",
+    "wait_for_key",
+    "set_sound_timer",
+}
+
+# Handlers that use the timers or the keys, which change on ticks and key events.
+# The clock is brought up to date before these run, so every due tick and key event has been applied.
+CLOCK_HANDLERS = {
+    "set_register_timer",
+    "set_delay_timer",
+    "set_sound_timer",
+    "skip_if_pressed",
+    "skip_if_not_pressed",
+    "wait_for_key",
+}
+
+# Handlers that write to memory at I, as (handler, number of bytes written) so the cache can be invalidated.
+MEMORY_WRITE_HANDLERS = {
+    "store_bcd": lambda x: 3,
+    "mem_dump": lambda x: x + 1,
+}
+
+# Python source for handlers simple enough to be inlined into a block.
+# V is the register list, c is the Chip8. Templates are formatted with the opcode operands.
+INLINE_TEMPLATES = {
+    "set_register_const": ["V[{x}] = {nn}"],
+    "add_register_const": ["V[{x}] = (V[{x}] + {nn}) & 0xFF"],
+    "set_register_register": ["V[{x}] = V[{y}]"],
+    "or_registers": ["V[{x}] = V[{x}] | V[{y}]"],
+    "and_registers": ["V[{x}] = V[{x}] & V[{y}]"],
+    "xor_registers": ["V[{x}] = V[{x}] ^ V[{y}]"],
+    "add_registers": [
+        "r = V[{x}] + V[{y}]",
+        "V[{x}] = r & 0xFF",
+        "V[15] = 1 if r >= 0x100 else 0",
+    ],
+    "sub_registers": [
+        "r = V[{x}] - V[{y}]",
+        "V[{x}] = r & 0xFF",
+        "V[15] = 0 if r < 0 else 1",
+    ],
+    "shift_right": [
+        "r = V[{x}]",
+        "V[15] = r & 1",
+        "V[{x}] = r >> 1",
+    ],
+    "shift_left": [
+        "r = V[{x}]",
+        "V[15] = r >> 7",
+        "V[{x}] = (r << 1) & 0xFF",
+    ],
+    "set_index": ["c.index = {nnn}"],
+    # Control flow. These always end a block, so they set the pc themselves.
+    "jump_to_constant": ["c.pc = {nnn}"],
+    "skip_if_equal": ["c.pc = {skip} if V[{x}] == {nn} else {next}"],
+    "skip_if_not_equal": ["c.pc = {skip} if V[{x}] != {nn} else {next}"],
+    "skip_if_reg_equal": ["c.pc = {skip} if V[{x}] == V[{y}] else {next}"],
+    "skip_if_not_equal_registers": ["c.pc = {skip} if V[{x}] != V[{y}] else {next}"],
+}
+
+
+class BlockEngine:
+    """
+    Executes a Chip8 by translating straight-line runs of instructions into Python functions.
+    Each block is compiled once, cached by its start address, and invalidated when FX33/FX55 write over it.
+    The resulting state is identical to calling Chip8.step() once per instruction.
+    """
+    def __init__(self, chip):
+        self.chip = chip
+        self.table = Chip8.build_dispatch_table(chip.vip_hires)
+        # start address -> (compiled block, end address)
+        self.blocks = {}
+        # Non-zero for every byte of memory that is part of a cached block.
+        self.code = bytearray(len(chip.memory))
+
+    def step(self):
+        """ Execute one block and return the number of instructions it contained. """
+        if self.chip.key_wait is not None:
+            self.chip.step()
+            return 1
+        pc = self.chip.pc
+        block = self.blocks.get(pc)
+        if block is None:
+            block = self.translate(pc)
+        return block[0](self.chip)
+
+    def run(self, cycles):
+        """ Execute exactly `cycles` instructions, finishing with single steps if a block would overshoot. """
+        chip = self.chip
+        blocks = self.blocks
+        executed = 0
+        while executed < cycles:
+            if chip.key_wait is not None:
+                # FX0A is waiting for a key, so let time pass up to the next event instead.
+                passed = chip.wait(cycles - executed)
+                executed += passed
+                continue
+            block = blocks.get(chip.pc)
+            if block is None:
+                block = self.translate(chip.pc)
+            if block[2] > cycles - executed:
+                chip.step()
+                executed += 1
+            else:
+                executed += block[0](chip)
+        return executed
+
+    def translate(self, start):
+        memory = self.chip.memory
+        table = self.table
+        ops = []
+        addr = start
+        while addr + 1 < len(memory) and len(ops) < MAX_BLOCK_LENGTH:
+            opcode = memory[addr] << 8 | memory[addr + 1]
+            handler = table[opcode]
+            ops.append((addr, opcode, handler))
+            addr += 2
+            if handler.__name__ in BLOCK_END_HANDLERS:
+                break
+
+        if not ops:
+            # Let the interpreter fail the same way it would when fetching past the end of memory.
+            def step_block(chip):
+                chip.step()
+                return 1
+            return (step_block, start, 1)
+
+        block = (self.compile(start, ops), addr, len(ops))
+        self.blocks[start] = block
+        for index in range(start, addr):
+            self.code[index] = 1
+        return block
+
+    def compile(self, start, ops):
+        namespace = {"invalidate": self.invalidate}
+        lines = [
+            "def block(c):",
+            "    V = c.registers",
+            "    c.should_draw = False",
+        ]
+        pending_ticks = 0
+        # Whether c.pc still needs to be set after the last instruction.
+        pc_pending = True
+        for addr, opcode, handler in ops:
+            name = handler.__name__
+            operands = {
+                "x": (opcode & 0x0F00) >> 8,
+                "y": (opcode & 0x00F0) >> 4,
+                "nn": opcode & 0x00FF,
+                "nnn": opcode & 0x0FFF,
+                "next": addr + 2,
+                "skip": addr + 4,
+            }
+            if name in CLOCK_HANDLERS and pending_ticks:
+                lines.append(f"    c.advance({pending_ticks})")
+                pending_ticks = 0
+
+            if name in INLINE_TEMPLATES:
+                for template in INLINE_TEMPLATES[name]:
+                    lines.append("    " + template.format(**operands))
+                pc_pending = name not in BLOCK_END_HANDLERS
+            else:
+                handler_name = f"h_{addr:03x}"
+                namespace[handler_name] = handler
+                lines.append(f"    c.pc = {addr}")
+                if pending_ticks:
+                    # If the handler raises, the instructions before it still count, as they do with step().
+                    lines.append("    try:")
+                    lines.append(f"        {handler_name}(c, {opcode})")
+                    lines.append("    except BaseException:")
+                    lines.append(f"        c.advance({pending_ticks})")
+                    lines.append("        raise")
+                else:
+                    lines.append(f"    {handler_name}(c, {opcode})")
+                if name in MEMORY_WRITE_HANDLERS:
+                    length = MEMORY_WRITE_HANDLERS[name](operands["x"])
+                    lines.append(f"    invalidate(c.index, {length})")
+                pc_pending = False
+            pending_ticks += 1
+
+        last_addr, last_opcode, _ = ops[-1]
+        if pc_pending:
+            lines.append(f"    c.pc = {last_addr + 2}")
+        lines.append(f"    c.opcode = {last_opcode}")
+        lines.append(f"    c.advance({pending_ticks})")
+        lines.append(f"    return {len(ops)}")
+
+        code = compile("\n".join(lines), f"<block {start:#05x}>", "exec")
+        exec(code, namespace)
+        return namespace["block"]
+
+    def invalidate(self, start, length):
+        """ Drop every cached block that overlaps memory[start:start + length]. """
+        if not any(self.code[start:start + length]):
+            return
+        end = start + length
+        for block_start, block in list(self.blocks.items()):
+            if block_start < end and start < block[1]:
+                del self.blocks[block_start]
+
+        self.code = bytearray(len(self.chip.memory))
+        for block_start, block in self.blocks.items():
+            for index in range(block_start, block[1]):
+                self.code[index] = 1
+
+    def flush(self):
+        """ Drop all cached blocks, e.g. after the chip's memory was replaced wholesale. """
+        self.blocks = {}
+        self.code = bytearray(len(self.chip.memory))
@@ -0,0 +1,449 @@
+# Runs many Chip8 machines in lockstep using NumPy.
+#
+# All machines' state lives in arrays with one row per machine. Every step fetches all opcodes at once,
+# groups the machines by which Chip8 handler their opcode decodes to, and runs each group as one vectorized
+# operation. Handler selection comes straight from Chip8's dispatch table, so the opcode set is shared.
+#
+# Machines that would raise in the scalar interpreter (bad pc, stack overflow/underflow, memory access
+# past the end, key index out of range) are marked as faulted and stop executing instead.
+# Only the 64x32 display is supported. VIP hires roms and machines switching to SUPER-CHIP hires mode
+# are faulted as well.
+import random
+import numpy as np
+from chip8 import Chip8, DISPLAY_WIDTH, DISPLAY_HEIGHT, TIMER_HZ
+
+MEMORY_SIZE = 4096
+STACK_SIZE = 16
+
+
+class VectorChip8:
+    # Handler names in kind order, and a table mapping every opcode to its kind. Built on first use.
+    kinds = None
+    kind_table = None
+
+    def __init__(self, count, cpu_hz, rngs=None, seed=None):
+        """
+        count: number of machines.
+        rngs: optional list of random.Random, one per machine, used for CXNN so results match the scalar
+            interpreter exactly. Without it a single NumPy generator (seeded with seed) is used.
+        """
+        self.build_kind_table()
+        self.count = count
+        self.memory = np.zeros((count, MEMORY_SIZE), dtype=np.uint8)
+        self.registers = np.zeros((count, 16), dtype=np.uint8)
+        self.index = np.zeros(count, dtype=np.int64)
+        self.pc = np.full(count, 0x200, dtype=np.int64)
+        self.stack = np.zeros((count, STACK_SIZE), dtype=np.int64)
+        self.stack_pointer = np.zeros(count, dtype=np.int64)
+        self.delay_timer = np.zeros(count, dtype=np.int64)
+        self.sound_timer = np.zeros(count, dtype=np.int64)
+        self.keys = np.zeros((count, 16), dtype=bool)
+        # Register FX0A is waiting to store a key in, or -1 when not waiting.
+        self.key_wait = np.full(count, -1, dtype=np.int64)
+        # One unsigned 64 bit integer per display row, like Chip8.display.
+        self.display = np.zeros((count, DISPLAY_HEIGHT), dtype=np.uint64)
+        self.faulted = np.zeros(count, dtype=bool)
+
+        # All machines share one clock since they run in lockstep.
+        self.cpu_hz = cpu_hz
+        self.cycles = 0
+        self.ticks = 0
+        self.next_tick_cycle = self.tick_cycle(1)
+
+        self.rngs = rngs
+        self.np_rng = np.random.default_rng(seed)
+
+    @classmethod
+    def build_kind_table(cls):
+        if cls.kind_table is None:
+            table = Chip8.build_dispatch_table()
+            names = sorted({handler.__name__ for handler in table})
+            kind_of = {name: kind for kind, name in enumerate(names)}
+            cls.kinds = names
+            cls.kind_table = np.array([kind_of[handler.__name__] for handler in table], dtype=np.int64)
+        return cls.kind_table
+
+    @classmethod
+    def from_chips(cls, chips, exact_random=True):
+        """
+        Build a lockstep engine holding a copy of each chip's state. All chips must share cpu_hz and cycle count.
+        With exact_random, each machine draws random numbers from a copy of its chip's rng.
+        """
+        rngs = None
+        if exact_random:
+            rngs = []
+            for chip in chips:
+                rng = random.Random()
+                rng.setstate(chip.rng.getstate())
+                rngs.append(rng)
+
+        engine = cls(len(chips), chips[0].cpu_hz, rngs=rngs)
+        engine.cycles = chips[0].cycles
+        engine.ticks = chips[0].ticks
+        engine.next_tick_cycle = engine.tick_cycle(engine.ticks + 1)
+        for n, chip in enumerate(chips):
+            engine.memory[n] = np.frombuffer(bytes(chip.memory), dtype=np.uint8)
+            engine.registers[n] = np.frombuffer(bytes(chip.registers), dtype=np.uint8)
+            engine.index[n] = chip.index
+            engine.pc[n] = chip.pc
+            engine.stack[n] = list(chip.stack)
+            engine.stack_pointer[n] = chip.stack_pointer
+            engine.delay_timer[n] = chip.delay_timer
+            engine.sound_timer[n] = chip.sound_timer
+            engine.keys[n] = chip.keys
+            engine.key_wait[n] = -1 if chip.key_wait is None else chip.key_wait
+            if chip.display_width == DISPLAY_WIDTH and chip.display_height == DISPLAY_HEIGHT:
+                engine.display[n] = chip.display
+            else:
+                engine.faulted[n] = True
+        return engine
+
+    @classmethod
+    def from_rom(cls, rom_file, count, cpu_hz=None, seed=None):
+        """ count identical machines running the same rom. """
+        chip = Chip8(rom_file) if cpu_hz is None else Chip8(rom_file, cpu_hz=cpu_hz)
+        engine = cls.from_chips([chip], exact_random=False)
+        for name in ("memory", "registers", "index", "pc", "stack", "stack_pointer",
+                     "delay_timer", "sound_timer", "keys", "key_wait", "display", "faulted"):
+            setattr(engine, name, np.repeat(getattr(engine, name), count, axis=0))
+        engine.count = count
+        engine.np_rng = np.random.default_rng(seed)
+        return engine
+
+    def machine_state(self, n):
+        """ State of machine n in the same shape as state_of(chip), for comparisons. """
+        return (
+            bytes(self.registers[n]), int(self.index[n]), int(self.pc[n]),
+            [int(value) for value in self.stack[n]], int(self.stack_pointer[n]),
+            int(self.delay_timer[n]), int(self.sound_timer[n]),
+            bytes(self.memory[n]), [int(row) for row in self.display[n]],
+        )
+
+    def press_key(self, machines, key):
+        """ Press key on the given machines (an index, list or mask). Machines waiting in FX0A take the key. """
+        machines = np.atleast_1d(np.arange(self.count)[machines])
+        self.keys[machines, key] = True
+        waiting = machines[self.key_wait[machines] >= 0]
+        self.registers[waiting, self.key_wait[waiting]] = key
+        self.key_wait[waiting] = -1
+        self.pc[waiting] += 2
+
+    def release_key(self, machines, key):
+        self.keys[machines, key] = False
+
+    def tick_cycle(self, tick):
+        return -(-tick * self.cpu_hz // TIMER_HZ)
+
+    def run(self, cycles):
+        for _ in range(cycles):
+            self.step()
+
+    def step(self):
+        # Machines waiting for a key only let time pass.
+        active = np.flatnonzero(~self.faulted & (self.key_wait < 0))
+        pc = self.pc[active]
+        bad = pc > MEMORY_SIZE - 2
+        if bad.any():
+            self.faulted[active[bad]] = True
+            active = active[~bad]
+            pc = pc[~bad]
+
+        memory = self.memory
+        opcodes = memory[active, pc].astype(np.int64) << 8 | memory[active, pc + 1]
+        kinds = self.kind_table[opcodes]
+
+        # Group machines by handler and run each group once.
+        order = np.argsort(kinds, kind="stable")
+        counts = np.bincount(kinds, minlength=len(self.kinds))
+        start = 0
+        for kind in np.flatnonzero(counts):
+            group = order[start:start + counts[kind]]
+            start += counts[kind]
+            getattr(self, self.kinds[kind])(active[group], opcodes[group])
+
+        self.cycles += 1
+        if self.cycles >= self.next_tick_cycle:
+            # Below TIMER_HZ more than one tick can be due on a cycle.
+            count = self.cycles * TIMER_HZ // self.cpu_hz - self.ticks
+            self.ticks += count
+            np.maximum(self.delay_timer - count, 0, out=self.delay_timer)
+            np.maximum(self.sound_timer - count, 0, out=self.sound_timer)
+            self.next_tick_cycle = self.tick_cycle(self.ticks + 1)
+
+    def fault(self, machines, bad):
+        """ Mark the machines where bad is set as faulted and return the rest (and the mask of those kept). """
+        if bad.any():
+            self.faulted[machines[bad]] = True
+        return machines[~bad], ~bad
+
+    # Handlers. Each receives the machines in its group and their opcodes.
+
+    def disp_clear(self, m, op):
+        self.display[m] = 0
+        self.pc[m] += 2
+
+    def scroll_down(self, m, op):
+        rows = op & 0xF
+        for count in np.unique(rows[rows > 0]):
+            machines = m[rows == count]
+            self.display[machines, count:] = self.display[machines, :-count].copy()
+            self.display[machines, :count] = 0
+        self.pc[m] += 2
+
+    def scroll_right(self, m, op):
+        self.display[m] >>= np.uint64(4)
+        self.pc[m] += 2
+
+    def scroll_left(self, m, op):
+        # Bits shifted past the top of the 64 bit row are dropped, just like pixels past the left edge.
+        self.display[m] <<= np.uint64(4)
+        self.pc[m] += 2
+
+    def set_lores(self, m, op):
+        self.display[m] = 0
+        self.pc[m] += 2
+
+    def set_hires(self, m, op):
+        self.fault(m, np.ones(len(m), dtype=bool))
+
+    def return_from_subroutine(self, m, op):
+        m, _ = self.fault(m, self.stack_pointer[m] == 0)
+        self.stack_pointer[m] -= 1
+        self.pc[m] = self.stack[m, self.stack_pointer[m]] + 2
+
+    def jump_to_constant(self, m, op):
+        self.pc[m] = op & 0x0FFF
+
+    def call_subroutine(self, m, op):
+        m, keep = self.fault(m, self.stack_pointer[m] >= STACK_SIZE)
+        self.stack[m, self.stack_pointer[m]] = self.pc[m]
+        self.stack_pointer[m] += 1
+        self.pc[m] = op[keep] & 0x0FFF
+
+    def skip(self, m, condition):
+        self.pc[m] += np.where(condition, 4, 2)
+
+    def skip_if_equal(self, m, op):
+        self.skip(m, self.registers[m, op >> 8 & 0xF] == (op & 0xFF))
+
+    def skip_if_not_equal(self, m, op):
+        self.skip(m, self.registers[m, op >> 8 & 0xF] != (op & 0xFF))
+
+    def skip_if_reg_equal(self, m, op):
+        self.skip(m, self.registers[m, op >> 8 & 0xF] == self.registers[m, op >> 4 & 0xF])
+
+    def skip_if_not_equal_registers(self, m, op):
+        self.skip(m, self.registers[m, op >> 8 & 0xF] != self.registers[m, op >> 4 & 0xF])
+
+    def set_register_const(self, m, op):
+        self.registers[m, op >> 8 & 0xF] = op & 0xFF
+        self.pc[m] += 2
+
+    def add_register_const(self, m, op):
+        x = op >> 8 & 0xF
+        self.registers[m, x] = (self.registers[m, x].astype(np.int64) + (op & 0xFF)) & 0xFF
+        self.pc[m] += 2
+
+    def set_register_register(self, m, op):
+        self.registers[m, op >> 8 & 0xF] = self.registers[m, op >> 4 & 0xF]
+        self.pc[m] += 2
+
+    def or_registers(self, m, op):
+        x = op >> 8 & 0xF
+        self.registers[m, x] |= self.registers[m, op >> 4 & 0xF]
+        self.pc[m] += 2
+
+    def and_registers(self, m, op):
+        x = op >> 8 & 0xF
+        self.registers[m, x] &= self.registers[m, op >> 4 & 0xF]
+        self.pc[m] += 2
+
+    def xor_registers(self, m, op):
+        x = op >> 8 & 0xF
+        self.registers[m, x] ^= self.registers[m, op >> 4 & 0xF]
+        self.pc[m] += 2
+
+    def add_registers(self, m, op):
+        x = op >> 8 & 0xF
+        result = self.registers[m, x].astype(np.int64) + self.registers[m, op >> 4 & 0xF]
+        self.registers[m, x] = result & 0xFF
+        self.registers[m, 15] = result > 0xFF
+        self.pc[m] += 2
+
+    def sub_registers(self, m, op):
+        x = op >> 8 & 0xF
+        result = self.registers[m, x].astype(np.int64) - self.registers[m, op >> 4 & 0xF]
+        self.registers[m, x] = result & 0xFF
+        self.registers[m, 15] = result >= 0
+        self.pc[m] += 2
+
+    def shift_right(self, m, op):
+        x = op >> 8 & 0xF
+        value = self.registers[m, x]
+        self.registers[m, 15] = value & 1
+        self.registers[m, x] = value >> 1
+        self.pc[m] += 2
+
+    def shift_left(self, m, op):
+        x = op >> 8 & 0xF
+        value = self.registers[m, x]
+        self.registers[m, 15] = value >> 7
+        self.registers[m, x] = value << 1
+        self.pc[m] += 2
+
+    def set_index(self, m, op):
+        self.index[m] = op & 0x0FFF
+        self.pc[m] += 2
+
+    def set_register_random(self, m, op):
+        if self.rngs is None:
+            values = self.np_rng.integers(0, 256, size=len(m))
+        else:
+            values = np.array([self.rngs[n].randint(0, 255) for n in m], dtype=np.int64)
+        self.registers[m, op >> 8 & 0xF] = values & op & 0xFF
+        self.pc[m] += 2
+
+    def draw_sprite(self, m, op):
+        x = (self.registers[m, op >> 8 & 0xF] % DISPLAY_WIDTH).astype(np.uint64)
+        y = self.registers[m, op >> 4 & 0xF].astype(np.int64) % DISPLAY_HEIGHT
+        height = np.minimum(op & 0xF, DISPLAY_HEIGHT - y)
+        m, keep = self.fault(m, (height > 0) & (self.index[m] + height > MEMORY_SIZE))
+        x, y, height = x[keep], y[keep], height[keep]
+
+        collision = np.zeros(len(m), dtype=bool)
+        shift = np.uint64(DISPLAY_WIDTH - 8)
+        for sprite_row in range(int(height.max(initial=0))):
+            drawing = sprite_row < height
+            machines = m[drawing]
+            rows = y[drawing] + sprite_row
+            line = (self.memory[machines, self.index[machines] + sprite_row].astype(np.uint64) << shift) >> x[drawing]
+            current = self.display[machines, rows]
+            collision[drawing] |= (current & line) != 0
+            self.display[machines, rows] = current ^ line
+
+        self.registers[m, 15] = collision
+        self.pc[m] += 2
+
+    # Without hires mode DXY0 draws nothing, like any other DXYN with N = 0.
+    draw_large_sprite = draw_sprite
+
+    def key_pressed(self, m, op):
+        """ Shared by the key skips: returns the machines, their key and whether it's pressed. """
+        key = self.registers[m, op >> 8 & 0xF].astype(np.int64)
+        m, keep = self.fault(m, key > 15)
+        key = key[keep]
+        return m, key, self.keys[m, key]
+
+    def skip_if_pressed(self, m, op):
+        m, key, pressed = self.key_pressed(m, op)
+        self.skip(m, pressed)
+
+    def skip_if_not_pressed(self, m, op):
+        m, key, pressed = self.key_pressed(m, op)
+        self.skip(m, ~pressed)
+
+    def wait_for_key(self, m, op):
+        self.key_wait[m] = op >> 8 & 0xF
+
+    def set_register_timer(self, m, op):
+        self.registers[m, op >> 8 & 0xF] = self.delay_timer[m]
+        self.pc[m] += 2
+
+    def set_delay_timer(self, m, op):
+        self.delay_timer[m] = self.registers[m, op >> 8 & 0xF]
+        self.pc[m] += 2
+
+    def set_sound_timer(self, m, op):
+        self.sound_timer[m] = self.registers[m, op >> 8 & 0xF]
+        self.pc[m] += 2
+
+    def add_index(self, m, op):
+        result = self.index[m] + self.registers[m, op >> 8 & 0xF]
+        self.index[m] = result & 0xFFFF
+        self.registers[m, 15] = result > 0xFFFF
+        self.pc[m] += 2
+
+    def set_index_to_sprite(self, m, op):
+        self.index[m] = self.registers[m, op >> 8 & 0xF].astype(np.int64) * 5
+        self.pc[m] += 2
+
+    def store_bcd(self, m, op):
+        m, keep = self.fault(m, self.index[m] + 3 > MEMORY_SIZE)
+        value = self.registers[m, op[keep] >> 8 & 0xF]
+        index = self.index[m]
+        self.memory[m, index] = value // 100
+        self.memory[m, index + 1] = value % 100 // 10
+        self.memory[m, index + 2] = value % 10
+        self.pc[m] += 2
+
+    def mem_dump(self, m, op):
+        x = op >> 8 & 0xF
+        m, keep = self.fault(m, self.index[m] + x + 1 > MEMORY_SIZE)
+        x = x[keep]
+        for register in range(16):
+            copying = register <= x
+            machines = m[copying]
+            self.memory[machines, self.index[machines] + register] = self.registers[machines, register]
+        self.pc[m] += 2
+
+    def mem_read(self, m, op):
+        x = op >> 8 & 0xF
+        m, keep = self.fault(m, self.index[m] + x + 1 > MEMORY_SIZE)
+        x = x[keep]
+        for register in range(16):
+            copying = register <= x
+            machines = m[copying]
+            self.registers[machines, register] = self.memory[machines, self.index[machines] + register]
+        self.pc[m] += 2
+
+    def not_implemented_instr(self, m, op):
+        self.pc[m] += 2
+
+
+def state_of(chip):
+    return (
+        bytes(chip.registers), chip.index, chip.pc, list(chip.stack), chip.stack_pointer,
+        chip.delay_timer, chip.sound_timer, bytes(chip.memory), list(chip.display),
+    )
+
+
+def verify(rom_files, cycles=10000, seed=0):
+    """
+    Run every rom on both the scalar Chip8 and one VectorChip8 holding all of them, and return
+    the roms whose final state differs. Roms that raise in the scalar interpreter must be faulted in the vector one.
+    """
+    import contextlib
+    import io
+
+    chips = [Chip8(rom_file, seed=seed) for rom_file in rom_files]
+    engine = VectorChip8.from_chips(chips)
+    engine.run(cycles)
+
+    mismatched = []
+    # Unimplemented opcodes get reported on stdout by the scalar interpreter.
+    with contextlib.redirect_stdout(io.StringIO()):
+        for n, chip in enumerate(chips):
+            try:
+                chip.run(cycles=cycles)
+                crashed = False
+            except (IndexError, ValueError):
+                crashed = True
+            if chip.display_width != DISPLAY_WIDTH or chip.display_height != DISPLAY_HEIGHT:
+                # A hires display isn't supported by the vector engine, so there's nothing to compare.
+                continue
+            if crashed != engine.faulted[n] or (not crashed and state_of(chip) != engine.machine_state(n)):
+                mismatched.append(rom_files[n])
+    return mismatched
+
+
+if __name__ == "__main__":
+    import glob
+    import sys
+    import time
+
+    roms = sys.argv[1:] or sorted(glob.glob("roms/*.ch8"))
+    start = time.perf_counter()
+    mismatched = verify(roms)
+    print(f"Verified {len(roms)} roms in {time.perf_counter() - start:.2f}s, {len(mismatched)} mismatched.")
+    for rom in mismatched:
+        print(f"  {rom}")